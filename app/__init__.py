@@ -30,7 +30,7 @@ def create_app():
     Session(app)
 
     # interface to database connections (for prod: '3.131.117.61')
-    app.database_controller = DatabaseController(live_path='data/live', saved_path='data/saved', public_ip='localhost')
+    app.database_controller = DatabaseController(live_path='data/live', saved_path='data/saved', public_ip='localhost', archive=True)
     app.interface = interface  # allow the app to access to the customized interface object
 
     # register blueprints and sockets
@@ -6,6 +6,7 @@ from time import sleep, time
 import os
 
 from lib.database import DatabaseError, DatabaseBusyLoadingError, DatabaseTimeoutError, DatabaseConnectionError
+from lib.archive import ARCHIVE_EXT
 
 from app.main import socketio
 
@@ -70,6 +71,7 @@ def stop():
             error("Failed automatic database export.")
             raise e
         info('Session Exported to file: {}'.format(filename))
+        current_app.database_controller.prewarm(filename)  # most likely to be reviewed next
     else:  # playback
         log('Paused Playback')
     refresh()
@@ -139,7 +141,7 @@ def load(filename):
     set_database(filename)  # set a playback database for the given file
 
     n = 0
-    while True:
+    while not filename.endswith(ARCHIVE_EXT):  # archives are read straight from disk - nothing to wait for
         sleep(1)
         n += 1
         try:  # check if available
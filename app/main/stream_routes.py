@@ -96,6 +96,7 @@ def plot_update():
     """ Returns the json to update a bokeh plot """
     request_id = request.args.get('id')
     request_format = request.args.get('format')
+    etag = None  # snapshot requests are conditional on the ID of the newest snapshot
 
     try:
         database = get_database()
@@ -103,10 +104,13 @@ def plot_update():
         if not database:
             return "Database not found for this session", 503
         if not request_format or request_format == 'series':
-            data = database.read_data(request_id, to_json=True, max_time=5, downsample=True)
+            data = database.read_data(request_id, to_json=True, max_time=5, downsample=True, points=1000)
             #print("READ TIME: ", time()-start)
             #print()
         elif request_format == 'snapshot':
+            etag = database.snapshot_etag(request_id)
+            if etag and etag in request.if_none_match:  # browser already has the newest snapshot
+                return "", 304
             data = database.read_snapshot(request_id, to_json=True)
         else:
             err = 'Bokeh request for data specified an unknown request format: {}'.format(request_format)
@@ -123,7 +127,11 @@ def plot_update():
 
     if data:
         resp = Response(response=data, content_type='application/json')
-        resp.headers['Cache-Control'] = 'no-store'
+        if etag:  # keep the snapshot, but check with the server before using it
+            resp.set_etag(etag)
+            resp.headers['Cache-Control'] = 'no-cache'
+        else:  # series data is only sent once - must never be reused
+            resp.headers['Cache-Control'] = 'no-store'
         return resp
     else:
         return "", 304  # not modified (no new data)
@@ -8,10 +8,11 @@ from traceback import print_exc, format_exception
 from time import sleep, time, strftime, localtime
 
 from os import listdir, system
-from os.path import isfile, join
+from os.path import isfile, isdir, join
 
 from app.main import socketio
 from lib.database import DatabaseError, DatabaseTimeoutError, DatabaseBusyLoadingError, DatabaseConnectionError
+from lib.archive import ARCHIVE_EXT
 
 # todo: make the logs in the browser reflect an actual log file on the server, and add the ability to download it.
 LOG_FILE = 'local/logs/server.log'
@@ -240,8 +241,9 @@ def update_files(room=None):
     data_path = 'data/saved'
     files = []
     for file in listdir(data_path):
-        # if a valid file and doesn't start with a period (hidden files)
-        if isfile(join(data_path, file)) and not file.startswith('.'):
+        # if a valid file (or session archive directory) and doesn't start with a period (hidden files)
+        valid = isfile(join(data_path, file)) or (file.endswith(ARCHIVE_EXT) and isdir(join(data_path, file)))
+        if valid and not file.startswith('.'):
             files.append(file)
 
     if not room:  # if room not given, send to room ID of current request
@@ -0,0 +1,377 @@
+from array import array
+import builtins
+from fnmatch import fnmatchcase
+import json
+import os
+
+import numpy as np
+import redis
+
+
+# Session archives are directories with this extension in the saved data directory
+ARCHIVE_EXT = '.osa'
+ARCHIVE_VERSION = 1
+
+# Stream entry IDs are stored as single integers: (ms << SEQ_BITS) | seq
+SEQ_BITS = 20
+SEQ_MASK = (1 << SEQ_BITS) - 1
+
+
+def id_to_key(redis_id):
+    """ Converts a full redis stream ID 'ms-seq' (str or bytes) to the integer used in the archive index """
+    if type(redis_id) == bytes:
+        redis_id = redis_id.decode('utf-8')
+    ms, seq = redis_id.split('-')
+    return (int(ms) << SEQ_BITS) | int(seq)
+
+
+def key_to_id(key):
+    """ Converts an integer from the archive index back to a redis stream ID string 'ms-seq' """
+    key = int(key)
+    return '{}-{}'.format(key >> SEQ_BITS, key & SEQ_MASK)
+
+
+def write_archive(red, archive_path, batch=10000):
+    """
+    Exports the whole contents of a redis database to a session archive at <archive_path>.
+    <red> redis client to read from. Must NOT decode responses.
+    <batch> number of stream entries read per XRANGE command.
+
+    Archive layout:
+        meta.json - version, strings, hashes, sets, and the directory of each stream.
+        <n>/index.npy - int64 entry IDs of stream <n> in ascending order (the time index).
+        <n>/<i>.bin - the values of field <i> of every entry, one after the other.
+        <n>/<i>.npy - int64 offsets of each entry's value in <i>.bin (one more than the number of entries).
+        <n>/<i>.mask.npy - bool array of which entries have field <i>. Only written if some entries don't.
+    Chunk entries (see Database._write_chunk) already hold packed columns, so each chunk
+        becomes a contiguous slice of the column file that can be memory-mapped.
+    """
+    os.makedirs(archive_path)
+    meta = {'version': ARCHIVE_VERSION, 'strings': {}, 'hashes': {}, 'sets': {}, 'streams': {}}
+
+    for key in red.scan_iter(count=1000):
+        kind = red.type(key)
+        name = key.decode('utf-8')
+        if kind == b'stream':
+            directory = str(len(meta['streams']))
+            fields = _write_stream(red, key, os.path.join(archive_path, directory), batch)
+            meta['streams'][name] = {'dir': directory, 'fields': fields}
+        elif kind == b'hash':
+            meta['hashes'][name] = {k.decode('utf-8'): v.decode('utf-8') for k, v in red.hgetall(key).items()}
+        elif kind == b'set':
+            meta['sets'][name] = [v.decode('utf-8') for v in red.smembers(key)]
+        elif kind == b'string':
+            meta['strings'][name] = red.get(key).decode('utf-8')
+
+    with open(os.path.join(archive_path, 'meta.json'), 'w') as file:
+        json.dump(meta, file)
+
+
+def _write_stream(red, key, directory, batch):
+    """
+    Writes all entries of stream <key> to <directory> in the archive format (see write_archive()).
+    Returns the list of field names, in the order of their file numbers.
+    """
+    os.makedirs(directory)
+    index = array('q')  # entry IDs
+    fields = []  # field names in order first seen
+    files = []  # open column files for each field
+    offsets = []  # end offsets of each entry in each column file
+    masks = []  # whether each entry has each field
+
+    last_id = '-'
+    while True:
+        response = red.xrange(key, min=last_id, count=batch)
+        if not response:
+            break
+        for redis_id, entry in response:
+            index.append(id_to_key(redis_id))
+            for field in entry.keys():
+                if field not in fields:  # new field - previous entries don't have it
+                    fields.append(field)
+                    files.append(open(os.path.join(directory, '{}.bin'.format(len(files))), 'wb'))
+                    offsets.append(array('q', [0] * len(index)))
+                    masks.append(array('b', [0] * (len(index) - 1)))
+            for i, field in enumerate(fields):
+                val = entry.get(field)
+                if val is None:
+                    masks[i].append(0)
+                    offsets[i].append(offsets[i][-1])
+                else:
+                    masks[i].append(1)
+                    files[i].write(val)
+                    offsets[i].append(offsets[i][-1] + len(val))
+        last_id = '(' + response[-1][0].decode('utf-8')  # exclusive - continue after the last entry read
+
+    np.save(os.path.join(directory, 'index.npy'), np.frombuffer(index, dtype=np.int64))
+    for i in range(len(fields)):
+        files[i].close()
+        np.save(os.path.join(directory, '{}.npy'.format(i)), np.frombuffer(offsets[i], dtype=np.int64))
+        mask = np.frombuffer(masks[i], dtype=np.int8).astype(bool)
+        if not mask.all():
+            np.save(os.path.join(directory, '{}.mask.npy'.format(i)), mask)
+    return [field.decode('utf-8') for field in fields]
+
+
+class Archive:
+    """
+    Read-only session archive written by write_archive().
+    Stream files are only memory-mapped when a stream is first read,
+        so opening an archive of any size only reads its meta.json.
+    <archive_path> path to the archive directory
+    """
+    def __init__(self, archive_path):
+        self.path = archive_path
+        with open(os.path.join(archive_path, 'meta.json')) as file:
+            meta = json.load(file)
+        if meta.get('version') != ARCHIVE_VERSION:
+            raise ValueError("Unsupported archive version: {}".format(meta.get('version')))
+        self.strings = meta['strings']
+        self.hashes = meta['hashes']
+        self.sets = meta['sets']
+        self.stream_meta = meta['streams']
+        self.streams = {}  # ArchiveStream objects of streams that have been opened
+
+    def stream(self, name):
+        """ Returns the ArchiveStream stored under key <name>, or None if there is none """
+        stream = self.streams.get(name)
+        if stream is None and name in self.stream_meta:
+            meta = self.stream_meta[name]
+            stream = ArchiveStream(os.path.join(self.path, meta['dir']), meta['fields'])
+            self.streams[name] = stream
+        return stream
+
+    def keys(self):
+        """ All keys stored in the archive """
+        return list(self.strings) + list(self.hashes) + list(self.sets) + list(self.stream_meta)
+
+    def size(self):
+        """ Total size of all opened stream files in bytes """
+        return sum(stream.size() for stream in self.streams.values())
+
+    def close(self):
+        """ Unmaps all stream files """
+        self.streams = {}
+
+
+class ArchiveStream:
+    """
+    A single memory-mapped stream of an Archive.
+    <directory> directory of the stream's files
+    <fields> field names in the order of their file numbers
+    """
+    def __init__(self, directory, fields):
+        self.fields = [field.encode('utf-8') for field in fields]
+        self.index = np.load(os.path.join(directory, 'index.npy'), mmap_mode='r')
+        self.offsets = []
+        self.columns = []
+        self.masks = []
+        for i in range(len(fields)):
+            self.offsets.append(np.load(os.path.join(directory, '{}.npy'.format(i)), mmap_mode='r'))
+            column = os.path.join(directory, '{}.bin'.format(i))
+            # numpy can't map an empty file
+            self.columns.append(np.memmap(column, dtype=np.uint8, mode='r') if os.path.getsize(column) else b'')
+            mask = os.path.join(directory, '{}.mask.npy'.format(i))
+            self.masks.append(np.load(mask, mmap_mode='r') if os.path.isfile(mask) else None)
+
+    def __len__(self):
+        return len(self.index)
+
+    def search(self, min_id='-', max_id='+'):
+        """
+        Returns the indexes (i, j) of the slice of entries between the XRANGE bounds <min_id> and <max_id>.
+        Bounds can be '-', '+', 'ms', 'ms-seq', and can be made exclusive with the '(' prefix.
+        """
+        low = self._bound(min_id, low=True)
+        high = self._bound(max_id, low=False)
+        i = int(np.searchsorted(self.index, low, side='left'))
+        j = int(np.searchsorted(self.index, high, side='right'))
+        return i, max(i, j)
+
+    def _bound(self, bound, low):
+        """ Converts an XRANGE bound to a key in the index """
+        if type(bound) == bytes:
+            bound = bound.decode('utf-8')
+        bound = str(bound)
+        if bound == '-':
+            return np.iinfo(np.int64).min
+        if bound == '+':
+            return np.iinfo(np.int64).max
+
+        exclusive = bound.startswith('(')
+        bound = bound.lstrip('(')
+        if '-' in bound:  # full ID
+            ms, seq = bound.split('-')
+            # sequence numbers beyond SEQ_MASK can't be stored, but are valid bounds (e.g. the last ID of a millisecond)
+            key = (int(ms) << SEQ_BITS) | builtins.min(int(seq), SEQ_MASK)
+        else:  # only milliseconds given - include every sequence number
+            key = int(bound) << SEQ_BITS if low else (int(bound) << SEQ_BITS) | SEQ_MASK
+        if exclusive:
+            key = key + 1 if low else key - 1
+        return key
+
+    def entries(self, i, j):
+        """ Returns a list of (ID, {field: value}) tuples for entries i up to j, as bytes """
+        output = []
+        for n in range(i, j):
+            entry = {}
+            for field, offsets, column, mask in zip(self.fields, self.offsets, self.columns, self.masks):
+                if mask is not None and not mask[n]:
+                    continue
+                entry[field] = bytes(column[offsets[n]:offsets[n+1]])
+            output.append((key_to_id(self.index[n]).encode('utf-8'), entry))
+        return output
+
+    def size(self):
+        """ Total size of the stream's files in bytes """
+        size = self.index.nbytes
+        for offsets, column in zip(self.offsets, self.columns):
+            size += offsets.nbytes + len(column)
+        return size
+
+
+class ArchiveClient:
+    """
+    Read-only stand-in for a redis.Redis client that serves an Archive,
+        so that all Database read methods work unchanged on archives.
+    Only implements the commands used by those read methods.
+    <archive> Archive object (may be shared by many clients)
+    <decode_responses> same as for redis.Redis
+    """
+    def __init__(self, archive, decode_responses=False):
+        self.archive = archive
+        self.decode_responses = decode_responses
+
+    def _out(self, data):
+        """ Decodes bytes if this client decodes responses """
+        if self.decode_responses and type(data) == bytes:
+            return data.decode('utf-8')
+        if not self.decode_responses and type(data) == str:
+            return data.encode('utf-8')
+        return data
+
+    def _entries(self, entries):
+        """ Converts a list of archive entries to the format redis-py would give """
+        if not self.decode_responses:
+            return entries
+        return [(i.decode('utf-8'), {k.decode('utf-8'): v.decode('utf-8') for k, v in d.items()}) for i, d in entries]
+
+    def _name(self, name):
+        if type(name) == bytes:
+            return name.decode('utf-8')
+        return name
+
+    def execute_command(self, *args):
+        """ Runs a command given as a string (or separate arguments), e.g. 'keys info:*' """
+        args = ' '.join(str(arg) for arg in args).split()
+        command = getattr(self, args[0].lower(), None)
+        if not command:
+            raise redis.exceptions.ResponseError("Command '{}' is not supported by session archives".format(args[0]))
+        return command(*args[1:])
+
+    def ping(self):
+        return True
+
+    def xrange(self, name, min='-', max='+', count=None):
+        stream = self.archive.stream(self._name(name))
+        if stream is None:
+            return []
+        i, j = stream.search(min, max)
+        if count:
+            j = builtins.min(j, i + count)  # min and max are shadowed by redis-py's argument names
+        return self._entries(stream.entries(i, j))
+
+    def xrevrange(self, name, max='+', min='-', count=None):
+        stream = self.archive.stream(self._name(name))
+        if stream is None:
+            return []
+        i, j = stream.search(min, max)
+        if count:
+            i = builtins.max(i, j - count)
+        return self._entries(stream.entries(i, j))[::-1]
+
+    def xread(self, streams, count=None, block=None):
+        output = []
+        for name, last_id in streams.items():
+            response = self.xrange(name, min='('+self._name(last_id), count=count)
+            if response:
+                output.append([self._out(name), response])
+        return output
+
+    def xlen(self, name):
+        stream = self.archive.stream(self._name(name))
+        return len(stream) if stream is not None else 0
+
+    def get(self, name):
+        val = self.archive.strings.get(self._name(name))
+        return self._out(val) if val is not None else None
+
+    def hget(self, name, key):
+        val = self.archive.hashes.get(self._name(name), {}).get(self._name(key))
+        return self._out(val) if val is not None else None
+
+    def hgetall(self, name):
+        return {self._out(k): self._out(v) for k, v in self.archive.hashes.get(self._name(name), {}).items()}
+
+    def sismember(self, name, value):
+        return self._name(value) in self.archive.sets.get(self._name(name), [])
+
+    def smembers(self, name):
+        return {self._out(v) for v in self.archive.sets.get(self._name(name), [])}
+
+    def exists(self, *names):
+        keys = set(self.archive.keys())
+        return sum(self._name(name) in keys for name in names)
+
+    def keys(self, pattern='*'):
+        return [self._out(key) for key in self.archive.keys() if fnmatchcase(key, self._name(pattern))]
+
+    def scan_iter(self, match='*', count=None):
+        return iter(self.keys(match))
+
+    def type(self, name):
+        name = self._name(name)
+        for kind, keys in (('string', self.archive.strings), ('hash', self.archive.hashes),
+                           ('set', self.archive.sets), ('stream', self.archive.stream_meta)):
+            if name in keys:
+                return self._out(kind)
+        return self._out('none')
+
+    def memory_usage(self, name):
+        stream = self.archive.stream(self._name(name))
+        return stream.size() if stream is not None else None
+
+    def info(self, section=None):
+        # memory-mapped files only use resident memory for the pages being read
+        return {
+            'used_memory': self.archive.size(),
+            'total_system_memory': os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+        }
+
+    def pipeline(self, transaction=True):
+        return ArchivePipeline(self)
+
+    def __getattr__(self, name):
+        """ Any other command would write to the archive """
+        def read_only(*args, **kwargs):
+            raise redis.exceptions.ResponseError("Session archives are read-only (command: {})".format(name))
+        return read_only
+
+
+class ArchivePipeline:
+    """ Stand-in for a redis pipeline on an ArchiveClient. Commands are simply run on execute(). """
+    def __init__(self, client):
+        self.client = client
+        self.commands = []
+
+    def __getattr__(self, name):
+        command = getattr(self.client, name)
+
+        def queue(*args, **kwargs):
+            self.commands.append((command, args, kwargs))
+            return self
+        return queue
+
+    def execute(self):
+        commands, self.commands = self.commands, []
+        return [command(*args, **kwargs) for command, args, kwargs in commands]
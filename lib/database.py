@@ -1,13 +1,22 @@
 from multiprocessing import Lock
+from collections import OrderedDict
+import threading
+import socket
 from time import time, sleep, strftime, localtime
 import functools
 import json
-from os import system, path
+import zlib
+from os import system, path, sysconf, sep, remove, rename
+import shutil
 from traceback import print_exc, print_stack
 from numpy import ndarray, float64, float32
+import numpy as np
 
 import redis
 
+from lib.utils import minmax_envelope
+from lib.archive import Archive, ArchiveClient, write_archive, ARCHIVE_EXT
+
 from datetime import timedelta
 
 def h(ms):
@@ -39,9 +48,64 @@ class DatabaseBusyLoadingError(DatabaseError):
     """
 
 
-def get_time_filename():
-    """ Return human readable time for file names """
-    return strftime("%Y-%m-%d_%H:%M:%S.rdb", localtime())
+# bucket sizes (ms) of the min/max/mean rollup levels kept for numerical streams.
+# Each level must divide the next, because each level is built from the one below it.
+ROLLUP_LEVELS = (10, 100, 1000, 10000)
+
+# largest sequence number of a redis stream ID, for the last possible ID of a millisecond
+MAX_SEQ = 2**64 - 1
+
+# time (s) a stream stays marked as displayed after a page last read it. See Database.mark_viewing().
+VIEWING_TTL = 10
+
+# returns only the ID of the newest entry of a stream, so that its data never leaves the server
+LAST_ID_SCRIPT = """
+local entry = redis.call('XREVRANGE', KEYS[1], '+', '-', 'COUNT', 1)[1]
+if entry then return entry[1] end
+return false
+"""
+
+# Expands packed columns into stream entries, in the same format as the entries written one at a time.
+# KEYS[1] stream key
+# ARGV[1], ARGV[2] millisecond and sequence number of the last ID written to the stream ('' if unknown)
+# ARGV[3] multiplication factor of the fixed-point values (10^decimal_cap)
+# ARGV[4] number of entries, ARGV[5] position of the 'time' column
+# ARGV[6..] names of the columns, followed by one buffer of little-endian float64 values for each
+# Returns the millisecond and sequence number of the last ID written.
+INSERT_SCRIPT = """
+local n = tonumber(ARGV[4])
+local time_col = tonumber(ARGV[5])
+local columns = (#ARGV - 5) / 2
+local scale = tonumber(ARGV[3])
+local last = tonumber(ARGV[1])
+local seq = tonumber(ARGV[2]) or 0
+for i = 1, n do
+    local entry = {}
+    local t
+    for c = 1, columns do
+        local val = struct.unpack('<d', ARGV[5+columns+c], (i-1)*8 + 1)
+        if c == time_col then t = val end
+        val = val * scale
+        if val >= 0 then val = math.floor(val) else val = math.ceil(val) end
+        entry[2*c-1] = ARGV[5+c]
+        entry[2*c] = string.format('%.0f', val)
+    end
+    local ms = math.floor(t)
+    if last and ms <= last then
+        seq = seq + 1
+    else
+        last = ms
+        seq = 0
+    end
+    redis.call('XADD', KEYS[1], string.format('%.0f-%d', last, seq), unpack(entry))
+end
+return {string.format('%.0f', last), seq}
+"""
+
+
+def get_time_filename(ext='.rdb'):
+    """ Return human readable time for file names, with extension <ext> """
+    return strftime("%Y-%m-%d_%H:%M:%S", localtime()) + ext
 
 
 def catch_database_errors(method):
@@ -70,7 +134,13 @@ def catch_database_errors(method):
 
 class DatabaseController:
     """ Handles connections to multiple different Database instances """
-    def __init__(self, live_path, saved_path, public_ip):
+    def __init__(self, live_path, saved_path, public_ip, archive=False, playback_memory=None):
+        """
+        <archive> Whether live sessions are saved as columnar session archives (see lib/archive.py)
+            instead of copies of the RDB file. Both can be loaded for playback.
+        <playback_memory> Memory budget (bytes) of all redis-server instances serving RDB files for playback.
+            If None, half of the system memory. See PlaybackPool.
+        """
         # index of Database objects
         # keys are ID numbers for each database
         self.sessions = {}
@@ -80,55 +150,54 @@ class DatabaseController:
         self.live_path = live_path  # directory of live database dump files
         self.live_file = 'live.rdb'
         self.live_pass = 'thisisthepasswordtotheredisserver'
+        self.archive = archive  # whether to save live sessions as archives
 
-        # index of ports used for playback files and how many Database object connected
-        self.playback_ports = {port: {'file': None, 'count': 0} for port in [7000, 7001, 7002]}
         self.playback_ip = '127.0.0.1'
         self.playback_pass = 'thisisthepasswordtotheredisplaybackserver'  # todo: just randomize this I guess
         self.save_path = saved_path
 
+        # redis-server instances serving RDB files for playback, shared by all sessions viewing the same file
+        self.playback = PlaybackPool(self.playback_ip, self.playback_pass, self.save_path, playback_memory)
+
+        # plot updates of the live database, shared by all live sessions. Created with the first one.
+        self.live_cache = None
+
     def new_live(self, ID):
         """ Creates and returns a new liveDatabase instance for the given ID key """
         if self.sessions.get(ID):  # Database already associated
             self.remove(ID)  # remove and disconnect
         self.start_live_server()  # start a new redis instance if necessary
+        if not self.live_cache:
+            reader = LiveDatabase(
+                ip=self.live_ip, port=self.live_port, password=self.live_pass,
+                file=self.live_file, live_path=self.live_path, save_path=self.save_path
+            )
+            self.live_cache = LiveReadCache(reader)
         self.sessions[ID] = LiveDatabase(
             ip=self.live_ip, port=self.live_port, password=self.live_pass,
-            file=self.live_file, live_path=self.live_path, save_path=self.save_path
+            file=self.live_file, live_path=self.live_path, save_path=self.save_path,
+            archive=self.archive, cache=self.live_cache
         )
 
     def new_playback(self, file, ID):
         """ Creates and returns a new PlaybackDatabase instance for the given ID key """
-        # iterate through index of ports
-        port = None
-        for p, info in self.playback_ports.items():
-            if not info['file']:  # this port is available
-                port = p
-            elif info['file'] == file:  # the port is already associated with the given file
-                port = p
-                print("FOUND A PORT ALREADY ASSOCIATED FOR PLAYBACK: {}".format(p))
-                break  # done
-
-        else:  # no port was associated with this file already
-            if port is None:  # no ports available
-                raise DatabaseError("Could not create new playback server - no ports available")
-            else:  # a port is available
-                self.start_playback_server(file=file, port=port)
-
-        self.playback_ports[port]['file'] = file  # set the file for this port if not already
-        self.playback_ports[port]['count'] += 1  # increment count of Database classes connecting to this port
-
-        if self.playback_ports[port]['count'] <= 0:
-            raise DatabaseError("Error creating playback database - number of redis instances for port {} was negative".format(port))
-
         if self.sessions.get(ID):  # Database already associated
             self.remove(ID)  # remove and disconnect
 
+        if file.endswith(ARCHIVE_EXT):  # served straight from disk - no redis server needed
+            self.sessions[ID] = ArchiveDatabase(file=file, save_path=self.save_path)
+            return
+
+        port = self.playback.acquire(file)  # start a redis instance for this file if necessary
         self.sessions[ID] = PlaybackDatabase(
             ip=self.playback_ip, port=port, password=self.playback_pass, file=file
         )
 
-        count = self.playback_ports[port]['count']
+    def prewarm(self, *files):
+        """ Starts loading the given RDB files for playback ahead of time, as far as the memory budget allows """
+        for file in files:
+            if file and not file.endswith(ARCHIVE_EXT):  # archives don't need loading
+                self.playback.prewarm(file)
 
     def get(self, ID):
         """ Get database by ID """
@@ -143,38 +212,53 @@ class DatabaseController:
             if db.live:
                 return
 
-            # playback database
-            info = self.playback_ports[db.port]
-            if not info:
+            # archive playback database - no redis server to shut down
+            if db.port is None:
+                db.shutdown()
+                del self.sessions[ID]
                 return
-            if info['file'] and info['count'] > 1:  # still some left
-                self.playback_ports[db.port]['count'] -= 1  # decrement
-
-            # if a no more databases using this port
-            elif info['file'] and info['count'] <= 1:
-                try:
-                    db.shutdown()  # shut down this redis server
-                except DatabaseError as e:
-                    raise DatabaseError("Failed to shutdown current database. {}: {}".format(e.__class__.__name__, e))
-                self.playback_ports[db.port]['count'] = 0
-                self.playback_ports[db.port]['file'] = None  # un-associate file from port
+
+            # playback database - the instance is kept running until it needs to be evicted
+            self.playback.release(db.file)
 
             del self.sessions[ID]  # remove from session index
 
+    def bare_name(self, filename):
+        """ Whether <filename> is a plain file name, without any path to another directory """
+        return bool(filename) and sep not in filename and '/' not in filename and '..' not in filename
+
+    def save_file(self, filename):
+        """
+        Returns the path of the save <filename>, or None if it isn't the name of an existing save.
+        Only accepts a bare file name (names come from the browser): an RDB file, or an archive directory.
+        """
+        if not self.bare_name(filename):
+            return None
+        file_path = path.join(self.save_path, filename)
+        if filename.endswith(ARCHIVE_EXT):
+            return file_path if path.isdir(file_path) else None
+        return file_path if path.isfile(file_path) else None
+
     def rename_save(self, filename, newname):
         """ renames an old save file """
         if not filename:
             raise Exception("Could not rename file - no file given to rename")
+        old_path = self.save_file(filename)
+        if not old_path:
+            raise Exception("Could not rename file - file does not exist")
+        ext = ARCHIVE_EXT if filename.endswith(ARCHIVE_EXT) else '.rdb'  # keep the same file type
         if not newname:
-            newname = get_time_filename()
-        if not newname.endswith('.rdb'):
-            newname += '.rdb'
-        if path.isfile(self.save_path + '/' + newname):
+            newname = get_time_filename(ext)
+        if not newname.endswith(ext):
+            newname += ext
+        if not self.bare_name(newname):
+            raise Exception("Could not rename file - invalid new file name")
+        new_path = path.join(self.save_path, newname)
+        if path.exists(new_path):
             raise Exception("Could not rename file - new file name already exists")
-        if not path.isfile(self.save_path + '/' + filename):
-            raise Exception("Could not rename file - file does not exist")
+        self.playback.discard(filename)  # the instance serving it would be left under the old name
         try:
-            system("mv {0}/{1} {0}/{2}".format(self.save_path, filename, newname))
+            rename(old_path, new_path)
         except Exception as e:
             raise DatabaseError("Failed to rename file: {}".format(e))
 
@@ -182,10 +266,15 @@ class DatabaseController:
         """ Remove an old stored file """
         if not filename:
             return
-        if not path.isfile(self.save_path+'/'+filename):
+        file_path = self.save_file(filename)
+        if not file_path:
             raise Exception("Could not delete file - file does not exist")
+        self.playback.discard(filename)
         try:
-            system('rm {}/{}'.format(self.save_path, filename))
+            if path.isdir(file_path):  # archives are directories
+                shutil.rmtree(file_path)
+            else:
+                remove(file_path)
         except Exception as e:
             raise DatabaseError("Failed to delete file: {}".format(e))
 
@@ -193,9 +282,263 @@ class DatabaseController:
         """ Start a new Redis server instance initialized from the live database file """
         system("redis-server config/live_redis.conf")
 
-    def start_playback_server(self, file, port):
-        """ Start a new local Redis server instance initialized from <file> on port <port> """
-        system("redis-server --bind 127.0.0.1 --daemonize yes --dir {} --dbfilename {} --port {} --requirepass {}".format(self.save_path, file, port, self.playback_pass))
+
+class PlaybackPool:
+    """
+    Redis-server instances serving saved RDB files for playback.
+    Each file has at most one instance, shared by all sessions viewing it, on a port allocated dynamically.
+    Instances that no session is using any more are kept running, so re-opening a recording is instant,
+        until their memory is needed: when a new file would exceed the memory budget,
+        the least recently used idle instances are shut down first.
+    <ip>, <password> address and password of all instances
+    <save_path> directory of the saved RDB files
+    <memory_budget> maximum total memory (bytes) of all instances. If None, half of the system memory.
+    """
+    def __init__(self, ip, password, save_path, memory_budget=None):
+        self.ip = ip
+        self.password = password
+        self.save_path = save_path
+        if memory_budget is None:
+            memory_budget = sysconf('SC_PAGE_SIZE') * sysconf('SC_PHYS_PAGES') // 2
+        self.memory_budget = memory_budget
+
+        self.instances = OrderedDict()  # file: PlaybackInstance, least recently used first
+        self.lock = threading.Lock()
+
+    def acquire(self, file):
+        """
+        Returns the port of the instance serving <file>, starting one if necessary.
+        Each call must be matched by a call to release() once the session is done with it.
+        """
+        with self.lock:
+            instance = self._get(file)
+            instance.count += 1
+            return instance.port
+
+    def release(self, file):
+        """ Marks one session as done with the instance serving <file>. The instance is kept running while idle. """
+        with self.lock:
+            instance = self.instances.get(file)
+            if instance and instance.count > 0:
+                instance.count -= 1
+
+    def discard(self, file):
+        """ Shuts down the instance serving <file>, if any. Raises a DatabaseError if a session is still using it. """
+        with self.lock:
+            instance = self.instances.get(file)
+            if not instance:
+                return
+            if instance.count:
+                raise DatabaseError("'{}' is currently open for playback".format(file))
+            instance.shutdown()
+            del self.instances[file]
+
+    def prewarm(self, file):
+        """
+        Starts an instance for <file> ahead of time (without acquiring it),
+            but only if it fits in the memory budget without evicting anything.
+        """
+        with self.lock:
+            if file in self.instances:
+                return
+            if self.used_memory() + self._file_size(file) > self.memory_budget:
+                return
+            self._get(file)
+
+    def used_memory(self):
+        """ Total memory (bytes) of all instances """
+        return sum(instance.memory() for instance in self.instances.values())
+
+    def _get(self, file):
+        """ Returns the (most recently used) instance serving <file>, starting one if necessary """
+        instance = self.instances.get(file)
+        if instance and not instance.alive():  # killed or crashed - start it again
+            del self.instances[file]
+            instance = None
+
+        if not instance:
+            self._evict(file, self._file_size(file))
+            instance = PlaybackInstance(self.ip, self._free_port(), self.password, self.save_path, file)
+            self.instances[file] = instance
+
+        self.instances.move_to_end(file)  # most recently used
+        return instance
+
+    def _evict(self, file, size):
+        """
+        Shuts down the least recently used idle instances until <size> more bytes fit in the memory budget,
+            to make room for <file>.
+        """
+        used = self.used_memory()
+        for name, instance in list(self.instances.items()):
+            if used + size <= self.memory_budget:
+                return
+            if instance.count:  # still in use
+                continue
+            used -= instance.memory()
+            instance.shutdown()
+            del self.instances[name]
+
+        if used + size > self.memory_budget:
+            raise DatabaseError("Could not load '{}' for playback - not enough memory. Close some other recordings first.".format(file))
+
+    def _file_size(self, file):
+        """ Size of an RDB file on disk, as an estimate of the memory needed to load it """
+        try:
+            return path.getsize(self.save_path+'/'+file)
+        except OSError:
+            raise DatabaseError("Could not load '{}' for playback - file does not exist".format(file))
+
+    def _free_port(self):
+        """ Asks the OS for a port that is not in use """
+        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+            sock.bind((self.ip, 0))
+            return sock.getsockname()[1]
+
+
+class PlaybackInstance:
+    """
+    A single redis-server instance serving an RDB file for playback. Used by PlaybackPool.
+    Starts the server when created.
+    """
+    def __init__(self, ip, port, password, save_path, file):
+        self.port = port
+        self.file = file
+        self.count = 0  # number of sessions using this instance
+        self.size = path.getsize(save_path+'/'+file)  # memory estimate until the file is loaded
+
+        # connection used to manage the server - sessions get their own
+        self.database = PlaybackDatabase(ip=ip, port=port, password=password, file=file)
+        system("redis-server --bind {} --daemonize yes --dir {} --dbfilename {} --port {} --requirepass {}".format(ip, save_path, file, port, password))
+
+    def alive(self):
+        """ Whether the server is still running (it may still be loading the file) """
+        try:
+            self.database.ping()
+            return True
+        except DatabaseBusyLoadingError:
+            return True
+        except DatabaseError:
+            return False
+
+    def memory(self):
+        """ Memory used by the server in bytes, or the size of its file while it is loading """
+        try:
+            self.size = max(self.size, self.database.memory_usage())
+        except DatabaseError:  # still loading, or not running
+            pass
+        return self.size
+
+    def shutdown(self):
+        """ Shuts down the server """
+        try:
+            self.database.shutdown()
+        except DatabaseError as e:
+            print("Failed to shutdown playback database on port {}. {}: {}".format(self.port, e.__class__.__name__, e))
+
+
+class LiveReadCache:
+    """
+    Shares the downsampled reads of live plot updates between all sessions viewing the live database.
+    Each (stream, points) pair is read from redis by a single reader at most once every <ttl> seconds,
+        and each read is kept as a numbered batch for <window> seconds.
+    Each session keeps a cursor (the number of the last batch it was given) in its own bookmark
+        of the stream, and is given all batches since then, so the load on redis stays
+        the same no matter how many sessions are viewing.
+    Used by LiveDatabase.read_data(). Created by DatabaseController.new_live().
+    <reader> LiveDatabase used only for the shared reads.
+    """
+    def __init__(self, reader, ttl=0.5, window=5):
+        self.reader = reader
+        self.ttl = ttl  # time (s) a shared read is served for before reading again
+        self.window = window  # time (s) batches are kept for. Maximum <max_time> of a session's read.
+        self.entries = {}  # (stream, points): SharedRead
+        self.seq = 0  # number of the last batch read of any stream
+        self.lock = threading.Lock()
+
+    def read(self, bookmark, stream, max_time, points, to_json=False):
+        """
+        Returns the downsampled data of <stream> that the session with <bookmark> hasn't been given yet,
+            in the same format as Database.read_data(), or None if there is nothing new.
+        Like a direct read, the first read of a stream only marks the read position.
+        <max_time> maximum time window (s) to return (at most the <window> of this cache).
+        <points> maximum number of data points to return.
+        """
+        entry = self._get(stream, points)
+        with entry.lock:  # other sessions wait for the read in progress instead of starting their own
+            now = time()
+            if now - entry.updated >= self.ttl:
+                self._refresh(entry, stream, points, now)
+            oldest = now - min(max_time, self.window)
+            batches = [data for seq, read_time, data in entry.batches if seq > (bookmark.cursor or 0) and read_time > oldest]
+            first_read = bookmark.cursor is None
+            bookmark.cursor = self.seq
+
+        if first_read or not batches:
+            return None
+
+        output = self._merge(batches, points)
+        if to_json:
+            return json.dumps(output)
+        return output
+
+    def clear(self):
+        """ Drops all shared reads, e.g. when the live database is stopped or restarted """
+        with self.lock:
+            self.entries = {}
+            self.reader.bookmarks.clear()
+            self.reader.start_time = self.reader.get_start_time() or self.reader.time()
+
+    def _get(self, stream, points):
+        """ Returns the SharedRead of (<stream>, <points>), and drops those no session has asked for in a while """
+        with self.lock:
+            now = time()
+            for key in [key for key, entry in self.entries.items() if now - entry.accessed > self.window]:
+                del self.entries[key]
+            entry = self.entries.get((stream, points))
+            if not entry:
+                entry = SharedRead()
+                self.entries[(stream, points)] = entry
+            entry.accessed = now
+            return entry
+
+    def _refresh(self, entry, stream, points, now):
+        """ Reads the new data of <stream> into a new batch of <entry>, and drops its batches older than <window> """
+        if not self.reader.bookmarks[stream]:  # first shared read of this stream
+            self.reader.start_time = self.reader.get_start_time() or self.reader.start_time
+        data = self.reader.read_data(stream, max_time=self.window, downsample=True, points=points)
+        entry.updated = now
+        entry.batches = [batch for batch in entry.batches if batch[1] > now - self.window]
+        if data:
+            with self.lock:
+                self.seq += 1
+                entry.batches.append((self.seq, now, data))
+
+    def _merge(self, batches, points):
+        """ Joins a list of read_data() results, reducing them to a min/max envelope of <points> if needed """
+        output = {key: [val for data in batches for val in data.get(key, [])] for key in batches[0].keys()}
+        if len(output['time']) <= points:
+            return output
+
+        columns = [key for key in output.keys() if key != 'time']
+        try:
+            times, data = minmax_envelope(np.asarray(output['time'], dtype=float64),
+                                          np.asarray([output[key] for key in columns], dtype=float64), points)
+        except (ValueError, TypeError):  # non-numerical values
+            step = -(-len(output['time']) // points)  # rounded up
+            return {key: val[::step] for key, val in output.items()}
+        output = {name: data[i].tolist() for i, name in enumerate(columns)}
+        output['time'] = times.tolist()
+        return output
+
+
+class SharedRead:
+    """ Batches of a single (stream, points) pair in a LiveReadCache """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.batches = []  # list of (number, read time (s), read_data() output)
+        self.updated = 0  # time (s) of the last read from redis
+        self.accessed = 0  # time (s) a session last asked for this pair
 
 
 class Database:
@@ -206,26 +549,55 @@ class Database:
         which is enough for visual inspection. However the 'time' data column is the
         measurement-accurate timestamp for a given data point.
     """
-    def __init__(self, ip, port, password):
+    def __init__(self, ip, port, password, chunked=False, chunk_dtype='<f8', rollup=False,
+                 packed_snapshots=False, snapshot_dtype='<f4', snapshot_maxlen=None, snapshot_max_age=None, shared=None):
+        """
+        <chunked> Whether write_data() stores each batch of time series data as a single
+            entry of packed binary columns rather than one entry per data point.
+        <chunk_dtype> numpy dtype that non-time columns are packed as when <chunked> is True.
+            The 'time' column is always packed as little-endian float64.
+        <rollup> Whether write_data() also keeps min/max/mean buckets of numerical streams
+            at each of ROLLUP_LEVELS, so that zoomed-out reads don't have to scan every data point.
+        <packed_snapshots> Whether write_snapshot() stores numerical columns as packed binary arrays,
+            and static or non-numerical columns in a header that is only written when it changes.
+        <snapshot_dtype> numpy dtype that snapshot columns are packed as when <packed_snapshots> is True.
+        <snapshot_maxlen> Maximum number of snapshots kept in each snapshot stream (approximately).
+        <snapshot_max_age> Maximum age (s) of the snapshots kept in each snapshot stream,
+            relative to the newest one (approximately). Ignored if <snapshot_maxlen> is given.
+        <shared> Another Database connected to the same server, whose connection pools are used
+            instead of new ones (e.g. by all workers of an AsyncClient). Bookmarks are not shared.
+        """
         self.ip = ip  # ip of database
         self.port = port  # database port
         self.password = password  # database password
 
-        # options for the redis.ConnectionPool
-        options = {
-            'host': ip,
-            'port': port,
-            'password': password,
-            'socket_timeout': 2,
-            'socket_connect_timeout': 5
-        }
-        # Separate redis pools for reading decoded data or reading raw bytes data.
-        pool = redis.ConnectionPool(decode_responses=True, **options)
-        bytes_pool = redis.ConnectionPool(decode_responses=False, **options)
-
-        # Redis connection client
-        self.redis = redis.Redis(connection_pool=pool)
-        self.bytes_redis = redis.Redis(connection_pool=bytes_pool)
+        self.chunked = chunked  # whether to write time series batches as single chunk entries
+        self.chunk_dtype = np.dtype(chunk_dtype).newbyteorder('<').str  # always little-endian
+        self.rollup = rollup  # whether to write rollup levels of numerical time series
+        self.packed_snapshots = packed_snapshots  # whether to write snapshots as packed binary arrays
+        self.snapshot_dtype = np.dtype(snapshot_dtype).newbyteorder('<').str  # always little-endian
+        self.snapshot_maxlen = snapshot_maxlen  # number of snapshots to keep in each stream
+        self.snapshot_max_age = snapshot_max_age  # time (s) to keep snapshots for
+
+        if shared:  # Redis connection clients of the other Database
+            self.redis = shared.redis
+            self.bytes_redis = shared.bytes_redis
+        else:
+            # options for the redis.ConnectionPool
+            options = {
+                'host': ip,
+                'port': port,
+                'password': password,
+                'socket_timeout': 2,
+                'socket_connect_timeout': 5
+            }
+            # Separate redis pools for reading decoded data or reading raw bytes data.
+            pool = redis.ConnectionPool(decode_responses=True, **options)
+            bytes_pool = redis.ConnectionPool(decode_responses=False, **options)
+
+            # Redis connection client
+            self.redis = redis.Redis(connection_pool=pool)
+            self.bytes_redis = redis.Redis(connection_pool=bytes_pool)
 
         self.exit = False  # flag to determine when to stop running if looping
         self.start_time = time()*1000  # real time that streaming is started (ms)
@@ -237,6 +609,14 @@ class Database:
 
         # Index to track last read/write position in the database for each data column
         self.bookmarks = Bookmarks()
+        self._indexed = False  # whether the metadata index sets are known to exist. See indexed().
+        self._last_id_script = None  # registered LAST_ID_SCRIPT (False if scripting isn't available)
+        self._insert_script = None  # registered INSERT_SCRIPT (False if scripting isn't available)
+
+        # (group, consumer) names if reading as a member of a redis consumer group. See use_group().
+        self.consumer = None
+        self.claim_idle = 30000  # time (ms) after which another consumer's unacknowledged entries are taken over
+        self.claim_interval = 5  # minimum time (s) between checks for such entries
 
     def time(self):
         """ returns the current time in milliseconds """
@@ -257,7 +637,11 @@ class Database:
         """
         Validates a redis timestamp generated by time_to_redis()
         to make sure that no two timestamps written are the same
+        When reading as part of a consumer group, returns '*' so that redis assigns the ID (see use_group()).
         """
+        if self.consumer:  # replicas in a consumer group share output streams - let redis order their writes
+            return '*'
+
         bookmark = self.bookmarks.get(stream)
         if not bookmark.write:  # hasn't written before
             bookmark.write = int(redis_id)  # set new last write ID
@@ -271,6 +655,48 @@ class Database:
             bookmark.write = int(redis_id)  # set new last write ID
         return redis_id
 
+    def batch_redis_ids(self, stream, times):
+        """
+        Vectorized version of time_to_redis() followed by validate_redis_time() for a whole batch.
+        Returns a list of redis IDs (ms-seq) for the unix times (ms) in <times>, strictly increasing
+            and continuing from the last ID written to <stream>. Like validate_redis_time(),
+            a time that isn't later than the previous one gets the previous millisecond with the next sequence number.
+        When reading as part of a consumer group, all IDs are '*' (assigned by redis, see use_group()).
+        """
+        if self.consumer:  # replicas in a consumer group share output streams - let redis order their writes
+            return ['*'] * len(times)
+
+        ms = np.floor(np.asarray(times, dtype=float64)).astype(np.int64)
+        if not len(ms):
+            return []
+
+        bookmark = self.bookmarks.get(stream)
+        last = bookmark.write if bookmark.write else -1  # last written millisecond
+        ms = np.maximum.accumulate(np.maximum(ms, last))  # never go back in time
+
+        # sequence number is the position in each run of the same millisecond
+        new_run = np.empty(len(ms), dtype=bool)
+        new_run[0] = ms[0] != last
+        new_run[1:] = ms[1:] != ms[:-1]
+        index = np.arange(len(ms))
+        seq = index - np.maximum.accumulate(np.where(new_run, index, 0))
+        if not new_run[0]:  # first run continues the millisecond last written
+            seq[ms == last] += (bookmark.seq or 0) + 1
+
+        bookmark.write = int(ms[-1])
+        bookmark.seq = int(seq[-1])
+        return np.char.add(np.char.add(ms.astype(str), '-'), seq.astype(str)).tolist()
+
+    def column_to_redis(self, column):
+        """
+        Vectorized version of data_to_redis() for a whole column of values.
+        Returns a list of values to be stored in redis.
+        """
+        array = np.asarray(column)
+        if array.dtype.kind in 'iuf':  # numerical
+            return np.trunc(array.astype(float64) * (10**self.decimal_cap)).astype(np.int64).tolist()
+        return [self.data_to_redis(val) for val in column]
+
     @catch_database_errors
     def ping(self):
         """
@@ -290,6 +716,19 @@ class Database:
             return False
         return False
 
+    @catch_database_errors
+    def mark_viewing(self, stream):
+        """
+        Marks <stream> as displayed on a page for the next VIEWING_TTL seconds.
+        Analyzers running in a Pipeline only write their streams to the database while they are marked.
+        """
+        self.redis.set('VIEWING:'+stream, 1, ex=VIEWING_TTL)
+
+    @catch_database_errors
+    def is_viewing(self, stream):
+        """ Whether <stream> is marked as displayed on a page (see mark_viewing()) """
+        return bool(self.redis.exists('VIEWING:'+stream))
+
     def valid_list(self, data):
         """ Checks if the given data is in a valid 'listy' format for ordered data """
         # todo: can this be more robust? Other possible formats?
@@ -301,6 +740,85 @@ class Database:
         """ Checks if the given data list is all a valid numerical data type """
         return all(isinstance(val, (int, float, float64)) for val in data)
 
+    def valid_array(self, data):
+        """ Checks if the given data list can be packed into a numerical numpy array """
+        try:
+            return np.asarray(data).dtype.kind in 'biuf'  # bool, int, unsigned int, float
+        except Exception:
+            return False
+
+    def is_binary(self, stream):
+        """
+        Checks whether stream:<stream> holds entries of packed binary columns.
+        Writers add such streams to the 'BINARY' set before their first entry.
+        The result is only cached in the stream's bookmark once the stream exists,
+            so a reader that checks before the first write will check again later.
+        """
+        bookmark = self.bookmarks.get(stream)
+        if bookmark.binary is None:
+            pipe = self.redis.pipeline()
+            pipe.sismember('BINARY', stream)
+            pipe.xlen('stream:'+stream)
+            binary, exists = pipe.execute()
+            if not exists:  # nothing written yet - don't cache
+                return bool(binary)
+            bookmark.binary = bool(binary)
+        return bookmark.binary
+
+    def has_rollups(self, stream):
+        """
+        Checks whether rollup levels are kept for stream:<stream>.
+        Writers add such streams to the 'ROLLUP' set. Cached the same way as is_binary().
+        """
+        bookmark = self.bookmarks.get(stream)
+        if bookmark.rolled_up is None:
+            pipe = self.redis.pipeline()
+            pipe.sismember('ROLLUP', stream)
+            pipe.xlen('stream:'+stream)
+            rolled_up, exists = pipe.execute()
+            if not exists:  # nothing written yet - don't cache
+                return bool(rolled_up)
+            bookmark.rolled_up = bool(rolled_up)
+        return bookmark.rolled_up
+
+    def rollup_key(self, stream, level):
+        """ Returns the redis key of the rollup stream of stream:<stream> with buckets of <level> ms """
+        return 'rollup:{}:{}'.format(level, stream)
+
+    def rollup_level(self, stream, window, points):
+        """
+        Returns the coarsest rollup level (ms) of stream:<stream> that still gives
+            at least <points> data points over a time <window> (ms).
+        Each bucket gives two data points (its min and max).
+        Returns None if the raw data should be read instead.
+        """
+        if not points or not self.has_rollups(stream):
+            return None
+        levels = [level for level in ROLLUP_LEVELS if window / level >= points / 2]
+        return levels[-1] if levels else None
+
+    def last_read_id(self, response, level=None):
+        """
+        Returns the ID of the raw stream to continue reading from after <response>.
+        Entries of a rollup <level> are indexed by the start of their bucket, but cover the raw data
+            up to its end, so reads continue after the last millisecond of the last bucket
+            (rollups only hold completed buckets). Otherwise, continues after the last entry read.
+        """
+        last_id = self.decode(response[-1][0])
+        if level:
+            end = int(self.redis_to_time(last_id)) + level - 1  # last millisecond of the bucket
+            last_id = '{}-{}'.format(end, MAX_SEQ)
+        return last_id
+
+    def _redis(self, stream, decode=True):
+        """
+        Returns the redis client used to read from stream:<stream>.
+        Streams holding packed binary entries can only be read as raw bytes, regardless of <decode>.
+        """
+        if decode and not self.is_binary(stream):
+            return self.redis
+        return self.bytes_redis
+
     def decode(self, data):
         """ Decodes data if necessary """
         if type(data) == bytes:
@@ -326,11 +844,33 @@ class Database:
         except:
             return string
 
+    def unpack_chunk(self, entry):
+        """
+        Unpacks a chunk entry written by _write_chunk() into a dictionary of numpy arrays.
+        <entry> is the data dict of the entry, read with bytes_redis.
+        The arrays are read-only views on the bytes of the response.
+        """
+        dtype = self.decode(entry[b'_dtype'])
+        columns = {}
+        for key, val in entry.items():
+            k = self.decode(key)
+            if k.startswith('_'):  # chunk metadata
+                continue
+            columns[k] = np.frombuffer(val, dtype='<f8' if k == 'time' else dtype)
+        return columns
+
     def convert_response(self, response):
         """ Converts a response from Redis to a python dictionary of lists of floats """
         output = {}
         for data in response:
             d = data[1]  # data dict. data[0] is the timestamp ID
+            if b'_chunk' in d:  # packed chunk of many data points
+                for k, column in self.unpack_chunk(d).items():
+                    if output.get(k):
+                        output[k].extend(column.tolist())
+                    else:
+                        output[k] = column.tolist()
+                continue
             for key in d.keys():
                 k = self.decode(key)  # key might not be decoded (if using bytes_redis), but it needs to be regardless
                 if output.get(k):
@@ -339,6 +879,49 @@ class Database:
                     output[k] = [self.redis_to_data(d[key])]
         return output
 
+    def convert_array(self, response, columns=None, dtype=float64):
+        """
+        Converts a response from Redis (read as bytes) to a tuple of numpy arrays (time, data).
+        See read_array() for the format and arguments.
+        Decodes in bulk: chunk entries are unpacked as whole arrays, and runs of single data points
+            are parsed from their truncated integer format by numpy all at once.
+        """
+        if columns is None:  # all columns in the order they were written
+            columns = self.data_columns(response[0][1])
+        keys = ['time'] + list(columns)
+
+        blocks = []  # 2-D arrays of shape (len(keys), samples)
+        points = []  # run of consecutive entries that each hold a single data point
+        for entry in response:
+            d = entry[1]
+            if b'_chunk' not in d:
+                points.append(d)
+                continue
+            if points:
+                blocks.append(self._convert_points(points, keys))
+                points = []
+            chunk = self.unpack_chunk(d)
+            blocks.append(np.vstack([chunk[key] for key in keys]))
+        if points:
+            blocks.append(self._convert_points(points, keys))
+
+        block = blocks[0] if len(blocks) == 1 else np.concatenate(blocks, axis=1)
+        return block[0].astype(float64, copy=False), block[1:].astype(dtype, copy=False)
+
+    def data_columns(self, entry):
+        """ Returns the names of the data columns (other than 'time') in an entry data dict, in the order written """
+        return [key for key in map(self.decode, entry.keys()) if key != 'time' and not key.startswith('_')]
+
+    def _convert_points(self, entries, keys):
+        """
+        Converts a list of entry data dicts holding single data points (read as bytes)
+            into a 2-D float64 array with one row for each of <keys>.
+        Not meant to be called directly. Used by convert_array().
+        """
+        byte_keys = [key.encode() for key in keys]
+        raw = np.array([[d[key] for key in byte_keys] for d in entries])  # array of byte strings
+        return raw.T.astype(np.int64) / (10**self.decimal_cap)  # decompress from truncated integer format
+
     @catch_database_errors
     def get_elapsed_time(self, stream):
         """ Gets the current length of time that a database has been playing for in seconds """
@@ -357,13 +940,72 @@ class Database:
         return (current_time - start_time)/1000  # ms to s
 
     @catch_database_errors
-    def write_data(self, stream, data):
+    def write_data(self, stream, data, chunked=None, channels=None, time_row=None, time_scale=1):
         """
         Writes time series <data> to stream:<stream>.
         If <data> is a dictionary of items where keys are column names.
         Items must either all be iterable or all non-iterable.
         All Items (if iterable) must be of same length.
         Must include a 'time' column with unix time stamps in milliseconds.
+        <data> may instead be a 2-D numpy array with a row for each channel (like a BrainFlow board buffer).
+            The rows are written straight from the array (see array_columns()).
+        <chunked> Whether to write the whole batch as a single chunk entry (see _write_chunk).
+            If None, uses self.chunked. Ignored for single data points and non-numerical data.
+        <channels>, <time_row>, <time_scale> Only used if <data> is an array. See array_columns().
+        """
+        if isinstance(data, ndarray):
+            data = self.array_columns(data, channels, time_row, time_scale)
+        pipe = self.redis.pipeline()  # pipeline queues a series of commands at once
+        insert = self._queue_data(stream, data, chunked, pipe)
+        results = pipe.execute()
+        self._inserted(stream, insert, results)
+
+    @catch_database_errors
+    def write_batch(self, batches):
+        """
+        Writes several batches of time series data to their streams in a single round trip.
+        <batches> list of (stream, data) tuples, each as given to write_data().
+        """
+        pipe = self.redis.pipeline()
+        inserts = [(stream, self._queue_data(stream, data, None, pipe)) for stream, data in batches]
+        results = pipe.execute()
+        for stream, insert in inserts:
+            self._inserted(stream, insert, results)
+
+    def array_columns(self, array, channels, time_row, time_scale=1):
+        """
+        Returns the columns of a 2-D <array> of shape (rows, samples) as a dictionary of rows, to be written by write_data().
+        The rows are views on the array, so nothing is copied until they are written.
+        <channels> dictionary of column name: row index.
+        <time_row> index of the row of unix time stamps.
+        <time_scale> factor to convert the time stamps to milliseconds (e.g. 1000 for seconds).
+        """
+        if array.ndim != 2:
+            raise DatabaseError("Data array must be 2-D (rows, samples). Got shape {}".format(array.shape))
+        if time_row is None or not channels:
+            raise DatabaseError("Writing a data array requires a time row and a map of channel names to rows.")
+        times = array[time_row]
+        columns = {'time': times * time_scale if time_scale != 1 else times}
+        for name, row in channels.items():
+            columns[name] = array[row]
+        return columns
+
+    def pack_column(self, column, dtype):
+        """
+        Returns the buffer of <column> as little-endian <dtype>.
+        Arrays that are already of that dtype and contiguous are given as a memoryview, without copying.
+        """
+        array = np.asarray(column)
+        if array.dtype == np.dtype(dtype) and array.flags.c_contiguous:
+            return memoryview(array).cast('B')
+        return np.ascontiguousarray(array, dtype=dtype).tobytes()
+
+    def _queue_data(self, stream, data, chunked, pipe):
+        """
+        Queues the commands to write time series <data> to stream:<stream> on <pipe>.
+        Not meant to be called directly. Used by write_data() and write_batch(), which take the same arguments.
+        Returns the position of the result of a scripted insert in the pipeline (see _insert_columns()),
+            or None if the data isn't written by the script.
         """
         if data.get('time') is None:  # check for time key
             raise DatabaseError("Data input dictionary must contain a 'time' key.")
@@ -380,28 +1022,188 @@ class Database:
         elif len(sizes) == 0:  # no data?
             raise DatabaseError("Data input contained no data columns? : {}".format(data))
 
+        if chunked is None:
+            chunked = self.chunked
+
+        insert = None  # position of the result of a scripted insert in the pipeline
         if self.valid_list(list(data.values())[0]):  # if an iterable sequence of data points
-            pipe = self.redis.pipeline()  # pipeline queues a series of commands at once
-            length = len(list(data.values())[0])  # length of data (all must be the same)
-
-            # add data to the Redis database one data point at a time
-            #  because there isn't a mass-insert-to-stream command
-            for i in range(length):
-                d = {}
-                for key in data.keys():
-                    d[key] = self.data_to_redis(data[key][i])
-                time_id = self.time_to_redis(data['time'][i])  # redis time stamp in which to insert
-                redis_id = self.validate_redis_time(time_id, stream)
-                pipe.xadd('stream:'+stream, d, id=redis_id)
-
-            pipe.execute()
+            numerical = (chunked or self.rollup) and all(self.valid_array(val) for val in data.values())
+
+            if chunked and numerical:
+                self._write_chunk(stream, data, pipe)
+            elif not self.consumer and self.insert_script() and self.packable(data):
+                insert = len(pipe)
+                self._insert_columns(stream, data, pipe)
+            else:
+                # IDs and values for the whole batch are converted at once
+                redis_ids = self.batch_redis_ids(stream, data['time'])
+                keys = list(data.keys())
+                columns = [self.column_to_redis(data[key]) for key in keys]
+
+                # add data to the Redis database one data point at a time
+                #  because there isn't a mass-insert-to-stream command
+                for redis_id, values in zip(redis_ids, zip(*columns)):
+                    pipe.xadd('stream:'+stream, dict(zip(keys, values)), id=redis_id)
+
+            if self.rollup and numerical:
+                self._write_rollups(stream, data, pipe)
         else:  # assume this is a single data point
             time_id = self.time_to_redis(data['time'])  # redis time stamp in which to insert
             redis_id = self.validate_redis_time(time_id, stream)
-            self.redis.xadd('stream:' + stream, {key: self.data_to_redis(data[key]) for key in data.keys()}, id=redis_id)
+            pipe.xadd('stream:' + stream, {key: self.data_to_redis(data[key]) for key in data.keys()}, id=redis_id)
+
+        self._index_stream(stream, pipe)
+        return insert
+
+    def _inserted(self, stream, insert, results):
+        """ Continues the bookmark of <stream> from the last ID written by a scripted insert, if any """
+        if insert is not None:
+            bookmark = self.bookmarks.get(stream)
+            bookmark.write, bookmark.seq = int(results[insert][0]), int(results[insert][1])
+
+    def insert_script(self):
+        """
+        Returns INSERT_SCRIPT registered with the server, or None if the server can't run scripts.
+        The script is loaded once, so that pipelines can run it by its hash.
+        """
+        if self._insert_script is None:
+            try:
+                self.redis.script_load(INSERT_SCRIPT)
+                self._insert_script = self.redis.register_script(INSERT_SCRIPT)
+            except redis.exceptions.ResponseError:  # scripting disabled on this server
+                self._insert_script = False
+        return self._insert_script or None
+
+    def packable(self, data):
+        """ Checks whether all columns of a batch of <data> can be packed as float64 for INSERT_SCRIPT """
+        return all(np.asarray(val).dtype.kind in 'iuf' for val in data.values())
+
+    def _insert_columns(self, stream, data, pipe):
+        """
+        Queues INSERT_SCRIPT to write a batch of numerical time series <data> to stream:<stream>.
+        Not meant to be called directly. Used by write_data() for batches that aren't written as chunks.
+        The column names are sent once, and each column as a single buffer of float64 values.
+        The entries and their IDs are the same as if written one at a time,
+            and the bookmark of the stream is updated from the result once <pipe> is executed.
+        <pipe> redis pipeline to queue the script on.
+        """
+        bookmark = self.bookmarks.get(stream)
+        keys = list(data.keys())
+        args = [
+            bookmark.write if bookmark.write else '',
+            bookmark.seq or 0,
+            10**self.decimal_cap,
+            len(data['time']),
+            keys.index('time') + 1  # lua is 1-indexed
+        ]
+        args += keys
+        args += [self.pack_column(data[key], '<f8') for key in keys]
+        self._insert_script(keys=['stream:'+stream], args=args, client=pipe)
+
+    def _index_stream(self, stream, pipe):
+        """
+        Adds <stream> to the index set STREAMS:<ID> of all streams derived from the same ID,
+            where the ID is the last colon-separated part of the stream name (i.e. prefix:ID).
+        Queued with every write, which is as cheap as checking whether it's already there.
+        <pipe> redis pipeline to queue the command on.
+        """
+        pipe.sadd('STREAMS:'+stream.split(':')[-1], stream)
+
+    def _write_chunk(self, stream, data, pipe):
+        """
+        Writes a whole batch of time series <data> to stream:<stream> as a single entry.
+        Not meant to be called directly. Used by write_data() when writing in chunked mode.
+        Each column is packed into a little-endian buffer of self.chunk_dtype
+            (the 'time' column is always float64), and the entry also holds the
+            start time, sample count, and dtype of the chunk under the keys
+            '_start', '_chunk', and '_dtype'.
+        The entry ID is taken from the last timestamp in the batch, so a chunk
+            is never read before all of its data points are due.
+        Chunk entries are decoded transparently by convert_response().
+        <pipe> redis pipeline to queue the write on.
+        """
+        times = np.asarray(data['time'], dtype='<f8')
+        if not len(times):  # nothing to write
+            return
+
+        entry = {
+            '_chunk': len(times),  # number of data points
+            '_start': repr(float(times[0])),  # time of the first data point
+            '_dtype': self.chunk_dtype,  # dtype of all non-time columns
+            'time': self.pack_column(times, '<f8')
+        }
+        for key, val in data.items():
+            if key == 'time':
+                continue
+            entry[key] = self.pack_column(val, self.chunk_dtype)
+
+        time_id = self.time_to_redis(float(times[-1]))  # redis time stamp in which to insert
+        redis_id = self.validate_redis_time(time_id, stream)
+
+        pipe.sadd('BINARY', stream)  # mark this stream as holding binary entries
+        pipe.xadd('stream:'+stream, entry, id=redis_id)
+
+    def _write_rollups(self, stream, data, pipe):
+        """
+        Adds a batch of numerical time series <data> to the rollup levels of <stream>.
+        Not meant to be called directly. Used by write_data() when <rollup> is set.
+        Each level is a binary stream at rollup_key() holding chunk entries of completed buckets,
+            with the columns '<name>:min', '<name>:max' and '<name>:mean' for each data column,
+            the start time of each bucket as the 'time' column, and the bucket size (ms) under '_level'.
+        The last bucket of each level is only written once data arrives for the next one.
+        <pipe> redis pipeline to queue the writes on.
+        """
+        columns = [key for key in data.keys() if key != 'time']
+        bookmark = self.bookmarks.get(stream)
+        if not bookmark.rollup or bookmark.rollup.columns != columns:  # first write, or columns changed
+            bookmark.rollup = Rollup(columns)
+
+        times = np.asarray(data['time'], dtype=float64)
+        values = np.array([data[key] for key in columns], dtype=float64)
+        for level, start, count, total, low, high in bookmark.rollup.add(times, values):
+            entry = {
+                '_chunk': len(start),  # number of buckets
+                '_start': repr(float(start[0])),  # start time of the first bucket
+                '_dtype': self.chunk_dtype,
+                '_level': level,  # bucket size (ms)
+                'time': start.astype('<f8').tobytes()
+            }
+            mean = total / count
+            for i, key in enumerate(columns):
+                entry[key+':min'] = low[i].astype(self.chunk_dtype).tobytes()
+                entry[key+':max'] = high[i].astype(self.chunk_dtype).tobytes()
+                entry[key+':mean'] = mean[i].astype(self.chunk_dtype).tobytes()
+
+            # bucket start times are whole milliseconds and only ever increase
+            pipe.xadd(self.rollup_key(stream, level), entry, id=self.time_to_redis(float(start[-1])))
+        pipe.sadd('ROLLUP', stream)  # mark this stream as having rollup levels
+
+    def _read_chunks(self, red, stream, count):
+        """
+        Reads the newest entries of stream:<stream> until they hold at least <count> data points.
+        Not meant to be called directly. Used in place of XREVRANGE COUNT by other read methods,
+            because an entry in a binary stream may be a chunk of many data points.
+        Returns the entries in the same (ascending) order as XRANGE.
+        """
+        response = []
+        samples = 0  # number of data points read so far
+        max_id = '+'
+        while samples < count:
+            batch = red.xrevrange('stream:'+stream, max=max_id, count=16)
+            if not batch:  # reached the beginning of the stream
+                break
+            for entry in batch:
+                response.append(entry)
+                samples += int(entry[1].get(b'_chunk', 1))
+                if samples >= count:
+                    break
+            max_id = '(' + self.decode(batch[-1][0])  # exclusive - continue before the oldest entry read
+
+        response.reverse()  # revrange gives a reversed list
+        return response
 
     @catch_database_errors
-    def read_data(self, stream, count=None, max_time=None, to_json=False, decode=True, downsample=False):
+    def read_data(self, stream, count=None, max_time=None, to_json=False, decode=True, downsample=False, points=1000):
         """
         Gets newest data for <reader> from data column <stream>.
         <stream> is some ID that identifies the stream in the database.
@@ -415,6 +1217,234 @@ class Database:
         <decode> Whether to decode the result into strings.
             If False, only values will remain as bytes. Keys will still be decoded.
         <to_json> whether to convert to json string. if False, uses dictionary of lists.
+        <downsample> whether to reduce the data to a min/max envelope for plotting (ignored if <count> is given).
+        <points> maximum number of data points to return when downsampling.
+        """
+        downsample = downsample and not count
+        # downsampled data is read as bytes so that it can be converted in bulk
+        response = self._read(stream, count=count, max_time=max_time, decode=decode and not downsample,
+                              downsample=downsample, points=points)
+        if not response:
+            return None
+
+        # convert redis response to python dict
+        if downsample:
+            output = self._downsample(response, points, decode)
+        else:
+            output = self.convert_response(response)
+            if count:  # chunk entries may have given more than COUNT data points
+                output = {key: val[-count:] for key, val in output.items()}
+
+        if to_json:
+            return json.dumps(output)
+        return output
+
+    @catch_database_errors
+    def read_array(self, stream, count=None, max_time=None, t0=None, t1=None, columns=None, dtype=float64):
+        """
+        NumPy version of read_data().
+        Returns a tuple (time, data), or None if there is no data to read.
+            - time is a 1-D float64 array of unix time stamps in milliseconds.
+            - data is a 2-D array of shape (channels, samples) with one row for each of <columns>.
+        <count>, <max_time> same as read_data(), and uses the same read position.
+        <t0>, <t1> If either is given, reads all data between these unix times (ms) instead,
+            regardless of the last read position. If one is None, the range is open on that side.
+        <columns> list of data column names giving the order of the rows of data.
+            If None, uses all columns other than 'time' in the order they were written.
+        <dtype> numpy dtype of data (float64 or float32).
+        """
+        if t0 is not None or t1 is not None:
+            response = self._read_range(stream, t0, t1)
+        else:
+            response = self._read(stream, count=count, max_time=max_time, decode=False)
+        if not response:
+            return None
+
+        time, data = self.convert_array(response, columns, dtype)
+        if count:  # chunk entries may have given more than COUNT data points
+            time, data = time[-count:], data[:, -count:]
+        elif t0 is not None or t1 is not None:  # chunk entries may extend past the range
+            keep = np.ones(len(time), dtype=bool)
+            if t0 is not None:
+                keep &= time >= t0
+            if t1 is not None:
+                keep &= time <= t1
+            time, data = time[keep], data[:, keep]
+        return time, data
+
+    @catch_database_errors
+    def read_columns(self, stream):
+        """
+        Returns the names of the data columns (other than 'time') of stream:<stream>, in the order written,
+            from its newest entry. None if the stream is empty. Gives the row order of read_array() with columns=None.
+        """
+        response = self.bytes_redis.xrevrange('stream:'+stream, count=1)
+        if not response:
+            return None
+        return self.data_columns(response[0][1])
+
+    def _read_range(self, stream, t0=None, t1=None):
+        """
+        Returns the raw redis response (read as bytes) of all entries in stream:<stream>
+            containing data between unix times <t0> and <t1> (ms).
+        Not meant to be called directly. Used by read_array(). Does not use the stream's bookmark.
+        """
+        min_id = '-' if t0 is None else self.time_to_redis(t0)
+        max_id = '+' if t1 is None else self.time_to_redis(t1)
+        response = self.bytes_redis.xrange('stream:'+stream, min=min_id, max=max_id)
+
+        # chunk entries are indexed by their last data point, so the first chunk after the range may also overlap it
+        if t1 is not None and self.is_binary(stream):
+            response += self.bytes_redis.xrange('stream:'+stream, min='('+max_id, count=1)
+        return response
+
+    @catch_database_errors
+    def read_overview(self, stream, t0=None, t1=None, points=1000, to_json=False):
+        """
+        Reads data from stream:<stream> between unix times <t0> and <t1> (ms),
+            reduced to a min/max envelope of at most <points> data points.
+        Returns the same format as read_data() with downsample=True, or None if there is no data.
+        Does not use or move the stream's read position, so can be used for whole-session overview plots.
+        <t0>, <t1> If None, uses the start or end of the stream.
+        For streams with rollup levels, reads from the coarsest level that still gives <points>
+            data points, so the cost doesn't depend on how many data points were recorded.
+        """
+        if t0 is None or t1 is None:  # get the time range of the whole stream
+            pipe = self.bytes_redis.pipeline()
+            pipe.xrange('stream:'+stream, count=1)
+            pipe.xrevrange('stream:'+stream, count=1)
+            first, last = pipe.execute()
+            if not first:
+                return None
+            if t0 is None:
+                t0 = self.redis_to_time(first[0][0])
+            if t1 is None:
+                t1 = self.redis_to_time(last[0][0])
+
+        level = self.rollup_level(stream, t1 - t0, points)
+        key = self.rollup_key(stream, level) if level else 'stream:'+stream
+        response = self.bytes_redis.xrange(key, min=self.time_to_redis(t0), max=self.time_to_redis(t1))
+        if not response:
+            return None
+
+        output = self._downsample(response, points)
+        if to_json:
+            return json.dumps(output)
+        return output
+
+    @catch_database_errors
+    def wait(self, streams, timeout=1):
+        """
+        Blocks until any of <streams> has data newer than its read position, or until <timeout> (s) passes.
+        Returns the list of streams with new data (empty if timed out).
+        Doesn't read any data or move any read positions - follow with read_data() or read_array().
+        A stream that hasn't been read yet counts as having new data as soon as it has any.
+        When reading as part of a consumer group (see use_group()), waits for data written after this call.
+        """
+        last_ids = {}
+        for stream in streams:
+            if stream is None:
+                continue
+            bookmark = self.bookmarks.get(stream)
+            if self.consumer:  # the group's position isn't known here, so wait for anything newer than now
+                last_ids['stream:'+stream] = '$'
+            else:
+                last_ids['stream:'+stream] = bookmark.last_id or '0-0'
+        if not last_ids:
+            sleep(timeout)
+            return []
+
+        # the socket timeout is 2s, so block for less than that
+        block = max(1, int(min(timeout, 1.5)*1000))
+        response = self.bytes_redis.xread(last_ids, count=1, block=block)
+        return [self.decode(name)[len('stream:'):] for name, entries in response]
+
+    def use_group(self, group, consumer):
+        """
+        Makes all following reads of new data (without a count) read as consumer <consumer>
+            of the redis consumer group <group> on each stream, instead of from the stream's own read position.
+        Each entry is only delivered to one consumer in a group, so many processes can share the work of
+            a stream, and the group's position in the stream is kept in redis rather than in this object.
+        Delivered entries stay pending until ack() is called. The same consumer name gets them again
+            if it reads again, and other consumers take them over once idle for self.claim_idle ms.
+            Group and consumer names of replicas (see lib.lib.Analyzer.replicas()) come from the analyzer's ID,
+            which is new on every run of the client (as are the IDs of the target streams),
+            so pending entries are only recovered within a single run, not after restarting the client.
+        Trade-off: writes use IDs assigned by redis from its own clock, since other consumers write to the same streams
+            and a stream's IDs must always increase. So the IDs of entries written by a consumer are the time they
+            were written rather than the time of their data, and the entries of different consumers are in the order
+            they were written, not in data time order. Anything that takes the ID as the data time
+            (playback, read_time_segment(), the downsampled windows of read_data() and rollups) sees the data shifted
+            by the processing delay, and slightly out of order between consumers. The 'time' column is always exact.
+        """
+        self.consumer = (group, consumer)
+
+    @catch_database_errors
+    def create_group(self, stream, group, start='0'):
+        """
+        Creates consumer group <group> on stream:<stream> (and the stream if it doesn't exist yet).
+        Does nothing if the group already exists.
+        <start> ID after which the group starts reading. '0' for all data, '$' for only new data.
+        """
+        try:
+            self.redis.xgroup_create('stream:'+stream, group, id=start, mkstream=True)
+        except redis.exceptions.ResponseError as e:
+            if 'BUSYGROUP' not in str(e):  # group already exists
+                raise
+
+    @catch_database_errors
+    def ack(self):
+        """ Acknowledges all entries delivered to this consumer by reads since the last call (see use_group()) """
+        if not self.consumer:
+            return
+        group = self.consumer[0]
+        pipe = self.redis.pipeline()
+        for stream, bookmark in list(self.bookmarks.bookmarks.items()):
+            if bookmark.pending:
+                pipe.xack('stream:'+stream, group, *bookmark.pending)
+                bookmark.pending = []
+        pipe.execute()
+
+    def _read_group(self, red, stream, bookmark):
+        """
+        Returns the raw redis response of the next entries of stream:<stream> for this consumer.
+        Not meant to be called directly. Used by _read() after use_group().
+        Assumes the lock of <bookmark> has been acquired.
+        In order of priority, reads:
+            - On the first read, this consumer's own entries that were never acknowledged (e.g. before a crash)
+            - Entries of other consumers that have not been acknowledged for self.claim_idle ms
+            - New entries
+        """
+        group, consumer = self.consumer
+        key = 'stream:'+stream
+        response = []
+
+        if not bookmark.group:  # first read from this stream
+            self.create_group(stream, group)
+            bookmark.group = group
+            pending = red.xreadgroup(group, consumer, {key: '0'})  # ID 0 gives this consumer's pending entries
+            if pending:
+                response = [entry for entry in pending[0][1] if entry[1]]  # deleted entries have no data
+
+        if not response and time() - bookmark.last_claim > self.claim_interval:
+            bookmark.last_claim = time()
+            claimed = red.xautoclaim(key, group, consumer, self.claim_idle, start_id='0-0', count=100)
+            response = [entry for entry in claimed[1] if entry[1]]
+
+        if not response:
+            new = red.xreadgroup(group, consumer, {key: '>'})
+            if new:
+                response = new[0][1]
+
+        bookmark.pending.extend(self.decode(entry[0]) for entry in response)
+        return response
+
+    def _read(self, stream, count=None, max_time=None, decode=True, downsample=False, points=None):
+        """
+        Returns the raw redis response of the newest data in stream:<stream>, and moves its read position.
+        Not meant to be called directly. Used by read_data() and read_array(),
+            which take the same arguments and only differ in how the response is converted.
+        When downsampling, reads from the coarsest rollup level that still gives <points> data points.
         """
         if stream is None:
             return
@@ -424,15 +1454,21 @@ class Database:
         if not bookmark.lock(block=False):  # attempt to acquire lock
             return  # return if already locked
 
-        if decode:
-            red = self.redis
-        else:
-            red = self.bytes_redis
+        red = self._redis(stream, decode)
+        level = None  # rollup level read from, if downsampled
+
+        if self.consumer and not count:  # only read this consumer's share of new data
+            response = self._read_group(red, stream, bookmark)
+            bookmark.release()  # release lock
+            return response
 
         if count:  # get COUNT data regardless of last read
-            response = red.xrevrange('stream:'+stream, count=count)
-            if response:
-                response.reverse()  # revrange gives a reversed list
+            if self.is_binary(stream):  # entries may hold many data points each
+                response = self._read_chunks(red, stream, count)
+            else:
+                response = red.xrevrange('stream:'+stream, count=count)
+                if response:
+                    response.reverse()  # revrange gives a reversed list
 
         else:
             if not bookmark.last_id or not bookmark.last_time:  # no last read spot exists
@@ -458,14 +1494,17 @@ class Database:
                 new_last_time = self.redis_to_time(last_read_id) + (time_since_last-max_time*1000)
                 last_read_id = self.time_to_redis(new_last_time)  # convert back to redis timestamp
 
-            if downsample:  # get downsampled response
+            if downsample:  # read everything up to now in one range, to be reduced by read_data()
                 # calculate max ID by how much real time has passed between now and beginning (ms)
                 first_read_id = bookmark.first_id  # first read ID
                 first_read_time = bookmark.first_time  # first read real time
                 time_since_first = self.time() - first_read_time  # time diff until now
                 max_timestamp = self.redis_to_time(first_read_id) + time_since_first  # redis timestamp max time
                 max_read_id = self.time_to_redis(max_timestamp)  # redis timestamp max ID
-                response = self._downsample(stream, last_read_id, max_read_id)
+                level = self.rollup_level(stream, max_timestamp - self.redis_to_time(last_read_id), points)
+                key = self.rollup_key(stream, level) if level else 'stream:'+stream
+                # Redis uses the prefix "(" to represent an exclusive interval for XRANGE
+                response = red.xrange(key, min='('+last_read_id, max=max_read_id)
             else:
                 response = red.xread({'stream:' + stream: last_read_id})
 
@@ -483,7 +1522,7 @@ class Database:
 
         # set last-read info
         bookmark.last_time = self.time()
-        bookmark.last_id = self.decode(response[-1][0])  # store last timestamp
+        bookmark.last_id = self.last_read_id(response, level)  # store last timestamp
 
         # set first-read info if not already set
         if not bookmark.first_time:
@@ -492,16 +1531,8 @@ class Database:
             bookmark.release()  # release lock
             return  # return nothing. first data point was read for reference.
 
-        # convert redis response to python dict
-        output = self.convert_response(response)
-
-        if to_json:
-            result = json.dumps(output)
-        else:
-            result = output
-
         bookmark.release()  # release lock
-        return result
+        return response
 
     @catch_database_errors
     def read_time_segment(self, stream, time_length, decode=True):
@@ -516,10 +1547,7 @@ class Database:
         if not bookmark.lock(block=False):  # acquire lock
             return  # return if not acquired
 
-        if decode:
-            red = self.redis
-        else:
-            red = self.bytes_redis
+        red = self._redis(stream, decode)
 
         time_length = time_length * 1000  # convert to ms
 
@@ -555,32 +1583,190 @@ class Database:
         return output
 
     @catch_database_errors
-    def write_snapshot(self, stream, data):
+    def write_snapshot(self, stream, data, static=()):
         """
         Writes a snapshot of data <data> to stream:<stream>.
         <data> must be a dictionary of lists, where keys are data column names.
         Note that this method is for data which is not consecutive (like time series would be).
         It is for data that is meant to be viewed a chunk at a time.
-        It places each list of data values as a comma separated list under one key.
+        It places each list of data values as a comma separated list under one key,
+            or as a packed binary array if <packed_snapshots> is set (see _pack_snapshot()).
         Must include a 'time' column with a single unix timestamp in milliseconds
+        <static> names of columns that rarely change between snapshots (like the x/y positions in a plot).
+            Only used with <packed_snapshots>, where they are kept in the header instead of each entry.
+        Older snapshots are trimmed according to <snapshot_maxlen> or <snapshot_max_age>.
         """
         if data.get('time') is None:  # check for time key
             raise DatabaseError("Data input dictionary must contain a 'time' key.")
         if type(data['time']) not in [int, float]:
             raise DatabaseError("Time of this snapshot must be an integer or float.")
 
-        new_data = {}
-        for key in data.keys():
-            if key == 'time':
-                new_data['time'] = round(data['time'], self.decimal_cap)
-            elif self.valid_numerical(data[key]):  # all can be rounded
-                new_data[key] = ','.join(str(round(val, self.decimal_cap)) for val in data[key])
-            else:
-                new_data[key] = ','.join(str(val) for val in data[key])
-
         time_id = self.time_to_redis(data['time'])  # redis time stamp in which to insert
         redis_id = self.validate_redis_time(time_id, stream)
-        self.redis.xadd('stream:' + stream, new_data, id=redis_id)
+        pipe = self.redis.pipeline()
+
+        if self.packed_snapshots:
+            new_data = self._pack_snapshot(stream, data, static, pipe)
+        else:
+            new_data = {}
+            for key in data.keys():
+                if key == 'time':
+                    new_data['time'] = round(data['time'], self.decimal_cap)
+                elif self.valid_numerical(data[key]):  # all can be rounded
+                    new_data[key] = ','.join(str(round(val, self.decimal_cap)) for val in data[key])
+                else:
+                    new_data[key] = ','.join(str(val) for val in data[key])
+
+        # cap the history of snapshots
+        trim = {}
+        if self.snapshot_maxlen:
+            trim = {'maxlen': self.snapshot_maxlen, 'approximate': True}
+        elif self.snapshot_max_age:
+            oldest = self.redis_to_time(redis_id) - self.snapshot_max_age*1000
+            trim = {'minid': self.time_to_redis(max(oldest, 0)), 'approximate': True}
+
+        pipe.xadd('stream:' + stream, new_data, id=redis_id, **trim)
+        self._index_stream(stream, pipe)
+        pipe.execute()
+
+    def _pack_snapshot(self, stream, data, static, pipe):
+        """
+        Returns the entry of a snapshot of <data> packed as binary arrays.
+        Not meant to be called directly. Used by write_snapshot() when <packed_snapshots> is set.
+        Numerical columns are packed as self.snapshot_dtype. Columns in <static> and non-numerical columns
+            go into a json header at header:<stream>:<tag>, which is only written when it changes.
+        The entry holds the time as a string, and the dtype and header tag under the keys '_dtype' and '_header'.
+        Snapshot entries are decoded by convert_snapshot().
+        <pipe> redis pipeline to queue the writes on.
+        """
+        header = {}
+        for key, val in data.items():
+            if key != 'time' and (key in static or not self.valid_array(val)):
+                header[key] = val.tolist() if isinstance(val, ndarray) else list(val)
+        header_json = json.dumps(header, sort_keys=True)
+        tag = '{:08x}'.format(zlib.crc32(header_json.encode('utf-8')))
+
+        bookmark = self.bookmarks.get(stream)
+        if not bookmark.header or bookmark.header[0] != tag:  # header not yet written by this writer
+            pipe.set('header:{}:{}'.format(stream, tag), header_json)
+            bookmark.header = (tag, header)
+
+        entry = {
+            'time': repr(float(data['time'])),
+            '_dtype': self.snapshot_dtype,
+            '_header': tag
+        }
+        for key, val in data.items():
+            if key == 'time' or key in header:
+                continue
+            entry[key] = np.asarray(val, dtype=self.snapshot_dtype).tobytes()
+
+        pipe.sadd('BINARY', stream)  # mark this stream as holding binary entries
+        return entry
+
+    def convert_snapshot(self, stream, entry, to_json=False):
+        """
+        Converts a single snapshot <entry> (ID, data dict) of stream:<stream> into a dictionary of lists.
+        <to_json> whether to give a json string instead, without the 'time' column.
+            The json string of the last entry converted is kept in the stream's bookmark,
+            and given again without converting while the same entry is asked for.
+        """
+        bookmark = self.bookmarks.get(stream)
+        ID = self.decode(entry[0])
+        if to_json and bookmark.snapshot and bookmark.snapshot[0] == ID:  # already encoded
+            return bookmark.snapshot[1]
+
+        data = entry[1]  # data dict
+        if b'_header' in data:  # packed by _pack_snapshot()
+            tag = self.decode(data[b'_header'])
+            if not bookmark.header or bookmark.header[0] != tag:  # header not yet read
+                header = self.redis.get('header:{}:{}'.format(stream, tag))
+                bookmark.header = (tag, json.loads(header) if header else {})
+            dtype = self.decode(data[b'_dtype'])
+
+            output = {'time': [float(data[b'time'])]}
+            for key, val in data.items():
+                key = self.decode(key)
+                if key != 'time' and not key.startswith('_'):
+                    output[key] = np.frombuffer(val, dtype=dtype).astype(float64).tolist()
+            output.update(bookmark.header[1])
+
+        else:
+            keys = data.keys()  # get keys from data dict
+            output = {key: [] for key in keys}
+            for key in keys:
+                vals = data[key].split(',')
+                output[key] = [self.redis_to_data(val, False) for val in vals]
+
+        if to_json:
+            del output['time']  # remove time column for json format
+            result = json.dumps(output)
+            bookmark.snapshot = (ID, result)
+            return result
+        return output
+
+    @catch_database_errors
+    def read_snapshot_history(self, stream, column, count=None, t0=None, t1=None, dtype=float64):
+        """
+        Reads the history of column <column> of the snapshots in stream:<stream>.
+        Returns a tuple (time, data), or None if there are no snapshots.
+            - time is a 1-D float64 array of the time of each snapshot.
+            - data is a 2-D array of shape (snapshots, values) of <dtype>.
+        Only the most recent run of snapshots with the same number of values is given,
+            in case it changed (like the number of frequencies when the FFT window changes).
+        <count> number of most recent snapshots to read. If None, reads all of them.
+        <t0>, <t1> unix times (ms) to read between. If one is None, the range is open on that side.
+        Does not move the read position of the stream.
+        """
+        red = self._redis(stream, decode=False)
+        start = '-' if t0 is None else self.time_to_redis(t0)
+        end = '+' if t1 is None else self.time_to_redis(t1)
+        if count:
+            response = red.xrevrange('stream:'+stream, max=end, min=start, count=count)
+            response.reverse()  # revrange gives a reversed list
+        else:
+            response = red.xrange('stream:'+stream, min=start, max=end)
+        if not response:
+            return None
+
+        key = column.encode('utf-8')
+        times, rows = [], []
+        for ID, data in response:
+            if key not in data:  # static column kept in the header
+                raise DatabaseError("Column '{}' is not stored in each snapshot of stream '{}'".format(column, stream))
+            if b'_dtype' in data:  # packed by _pack_snapshot()
+                row = np.frombuffer(data[key], dtype=self.decode(data[b'_dtype']))
+            else:
+                row = np.array(data[key].split(b','), dtype=float64)
+            if rows and len(row) != len(rows[-1]):  # shape changed - start over from here
+                times, rows = [], []
+            times.append(float(data[b'time']))
+            rows.append(row)
+
+        return np.array(times, dtype=float64), np.vstack(rows).astype(dtype, copy=False)
+
+    @catch_database_errors
+    def last_id(self, stream):
+        """
+        Returns the ID of the newest entry in stream:<stream> without reading its data,
+            or None if the stream doesn't exist.
+        """
+        if self._last_id_script is None:
+            self._last_id_script = self.redis.register_script(LAST_ID_SCRIPT)
+        if self._last_id_script:
+            try:
+                return self._last_id_script(keys=['stream:'+stream])
+            except redis.exceptions.ResponseError:  # scripting disabled on this server
+                self._last_id_script = False
+        response = self.redis.xrevrange('stream:'+stream, count=1)
+        return response[0][0] if response else None
+
+    def snapshot_etag(self, stream):
+        """
+        Returns a tag that changes whenever read_snapshot(<stream>) would give a different result,
+            or None if there is no snapshot to read. Costs a single ID lookup.
+        """
+        return self.last_id(stream)
 
     @catch_database_errors
     def read_snapshot(self, stream, to_json=False, decode=True):
@@ -591,6 +1777,8 @@ class Database:
             - Also note that this removes the 'time' data column. This is for
                 plotting purposes - plotting software requires that all columns
                 be of same length, and the time column only has one entry.
+            - The json string of the last snapshot read is kept, and given again
+                without decoding while it is still the newest one.
         Since this is a snapshot (not time series), gets last 1 data point from redis.
         """
         if not stream:
@@ -601,10 +1789,7 @@ class Database:
         if not bookmark.lock(block=False):  # attempt to acquire lock
             return  # return if already locked
 
-        if decode:
-            red = self.redis
-        else:
-            red = self.bytes_redis  # not implemented for this method
+        red = self._redis(stream, decode)  # packed snapshots can only be read as bytes
 
         # read most recent snapshot - don't care about last read position
         response = red.xrevrange('stream:'+stream, count=1)
@@ -622,63 +1807,88 @@ class Database:
         bookmark.last_time = self.time()
         bookmark.last_id = self.decode(response[0][0])  # store last timestamp
 
-        data = response[0][1]  # data dict
-        keys = data.keys()  # get keys from data dict
-        output = {key: [] for key in keys}
-
-        for key in keys:
-            vals = data[key].split(',')
-            output[key] = [self.redis_to_data(val, False) for val in vals]
-
-        if to_json:
-            del output['time']  # remove time column for json format
-            result = json.dumps(output)
-        else:
-            result = output
+        result = self.convert_snapshot(stream, response[0], to_json)
         bookmark.release()  # release lock
         return result
 
-    @catch_database_errors
-    def _downsample(self, stream, last_id, max_id):
+    def _downsample(self, response, points, decode=True):
         """
-        Returns the raw redis response from <last_id> to <max_id> (not including last_id),
-            but downsampled to a maximum of 500Hz
-        Not meant to be called directly. Used by other read_data() methods.
-        Assumes that the bookmark for this stream already exists and it's lock has been acquired.
-        Assumes that normal redis is being used (not bytes_redis).
+        Converts a raw redis response (read as bytes) to a python dictionary of lists,
+            reduced to a min/max envelope of at most <points> data points (see minmax_envelope()).
+        Not meant to be called directly. Used by read_data().
+        The whole response is converted at once, so this costs a single read no matter the sample rate.
+        Non-numerical data can't be enveloped, so every n-th entry is kept instead.
+        Rollup entries (see _write_rollups()) give two data points for each bucket: its min and max.
         """
-        # integer milliseconds of the given redis IDs
-        last_id_time = self.redis_to_time(last_id)
-        max_id_time = self.redis_to_time(max_id)
+        columns = self.data_columns(response[0][1])
+        if b'_level' in response[0][1]:  # read from a rollup level
+            columns = [key[:-len(':min')] for key in columns if key.endswith(':min')]
+            times, data = self.convert_array(response, [key+stat for key in columns for stat in (':min', ':max')])
+
+            # each bucket's min then max, half a bucket apart
+            times = np.repeat(times, 2)
+            times[1::2] += float(response[0][1][b'_level']) / 2
+            data = data.reshape(len(columns), 2, -1).transpose(0, 2, 1).reshape(len(columns), -1)
+            if points:
+                times, data = minmax_envelope(times, data, points)
+            output = {name: data[i].tolist() for i, name in enumerate(columns)}
+            output['time'] = times.tolist()
+            return output
 
-        # for 500Hz, each data chunk is 2ms
-        bucket_size = 2  # bucket size in ms
+        try:
+            times, data = self.convert_array(response, columns)
+        except (ValueError, KeyError):  # non-numerical values, or columns differ between entries
+            step = -(-len(response) // points) if points else 1  # rounded up
+            output = self.convert_response(response[::step])
+            if decode:  # values are still bytes
+                output = {key: [self.decode(v) for v in val] for key, val in output.items()}
+            return output
+
+        if points:
+            times, data = minmax_envelope(times, data, points)
+        output = {name: data[i].tolist() for i, name in enumerate(columns)}
+        output['time'] = times.tolist()
+        return output
 
-        pipe = self.redis.pipeline()  # pipeline queues a series of commands at once
-        while last_id_time < max_id_time:
-            start_id = self.time_to_redis(last_id_time)  # start of bucket range
-            last_id_time += bucket_size  # increment by bucket size
-            end_id = self.time_to_redis(last_id_time)  # end of bucket range
-            pipe.xrevrange('stream:'+stream, min='('+start_id, max=end_id, count=1)  # read last item in range
-
-        # list of lists of tuples
-        raw_response = pipe.execute()
-        response = []
-        for lst in raw_response:
-            if lst:  # pick out only results with data
-                response.append(lst[0])  # put the single data point into the response list
+    def indexed(self):
+        """
+        Checks whether the database maintains the INFO, GROUPS and STREAMS:<ID> index sets.
+        Sessions saved before they were introduced don't, so their metadata has to be found with a SCAN.
+        Only a positive result is cached, because a new live database is empty until the first set_info().
+        """
+        if not self._indexed:
+            self._indexed = bool(self.redis.exists('INFO'))
+        return self._indexed
 
-        # response is now in same format as if read by a single XRANGE command
-        return response
+    def _index_members(self, index, pattern):
+        """
+        Returns the members of the index set <index>, or if this database isn't indexed,
+            the names of all keys matching <pattern> (found incrementally so as not to block redis).
+        Keys are returned without the part of <pattern> before the wildcard.
+        """
+        if self.indexed():
+            return list(self.redis.smembers(index))
+        prefix = pattern[:pattern.find('*')]
+        return [key[len(prefix):] for key in self.redis.scan_iter(match=pattern, count=1000)]
+
+    def _get_hashes(self, keys):
+        """ Gets the contents of all hashes in <keys> in one round trip. Missing hashes are left out. """
+        pipe = self.redis.pipeline()
+        for key in keys:
+            pipe.hgetall(key)
+        return [data for data in pipe.execute() if data]
 
     @catch_database_errors
     def set_info(self, key, data):
         """
-        Writes <data> to info:<key>
+        Writes <data> to info:<key> and adds <key> to the INFO index set
         <data> must be a dictionary of key-value pairs.
         <key> is the key for this data set
         """
-        self.redis.hmset('info:'+key, data)
+        pipe = self.redis.pipeline()
+        pipe.hmset('info:'+key, data)
+        pipe.sadd('INFO', key)
+        pipe.execute()
 
     @catch_database_errors
     def get_info(self, ID, name=None):
@@ -695,19 +1905,19 @@ class Database:
     @catch_database_errors
     def get_all_info(self):
         """ Gets a list of dictionaries containing info for all connected streams """
-        info = []
-        for key in self.redis.execute_command('keys info:*'):
-            info.append(self.redis.hgetall(key))
-        return info
+        return self._get_hashes('info:'+ID for ID in self._index_members('INFO', 'info:*'))
 
     @catch_database_errors
     def set_group(self, key, data):
         """
-        Writes <data> to group:<key>
+        Writes <data> to group:<key> and adds <key> to the GROUPS index set
         <data> must be a dictionary of key-value pairs.
         <key> is the key for this data set
         """
-        self.redis.hmset('group:'+key, data)
+        pipe = self.redis.pipeline()
+        pipe.hmset('group:'+key, data)
+        pipe.sadd('GROUPS', key)
+        pipe.execute()
 
     @catch_database_errors
     def get_group(self, name, stream=None):
@@ -726,8 +1936,10 @@ class Database:
         else:  # no stream name specified - get whole group
             data = {}  # name: {stream info dict}
             group = self.redis.hgetall('group:'+name)  # name:ID
-            for key in group.keys():  # for each stream name
-                info = self.get_info(group[key])
+            pipe = self.redis.pipeline()
+            for ID in group.values():
+                pipe.hgetall('info:'+ID)
+            for key, info in zip(group.keys(), pipe.execute()):  # for each stream name
                 if info:
                     data[key] = info
             return data
@@ -735,10 +1947,7 @@ class Database:
     @catch_database_errors
     def get_all_groups(self):
         """ Gets a list of dictionaries containing name and ID info for all groups in the database """
-        info = []
-        for key in self.redis.execute_command('keys group:*'):
-            info.append(self.redis.hgetall(key))
-        return info
+        return self._get_hashes('group:'+name for name in self._index_members('GROUPS', 'group:*'))
 
     @catch_database_errors
     def get_streams(self, group):
@@ -761,20 +1970,206 @@ class Database:
         #  stream:prefix:full_stream_id
         data = {}  # name: ID
         group = self.redis.hgetall('group:'+group)  # name:ID
-        for key, ID in group.items():
-            # get all streams from this ID with an extra prefix
-            extra_ids = self.redis.keys("stream:*{}".format(ID))
+        if self.indexed():  # all streams from each ID, with or without a prefix, in one round trip
+            pipe = self.redis.pipeline()
+            for ID in group.values():
+                pipe.smembers('STREAMS:'+ID)
+            streams = pipe.execute()
+        else:
+            streams = [self._index_members(None, "stream:*{}".format(ID)) for ID in group.values()]
+
+        for key, extra_ids in zip(group.keys(), streams):
             for extra in extra_ids:
-                i = extra.find(":")+1  # first colon
-                j = extra[i:].find(":")  # second colon
-                if j == -1:  # no second colon (thus no prefix)
+                j = extra.find(":")  # colon after the prefix
+                if j == -1:  # no prefix
                     name = key
                 else:
-                    name = key+':'+extra[i:i+j]
-                data[name] = extra[i:]
+                    name = key+':'+extra[:j]
+                data[name] = extra
         return data
 
 
+class StreamHandoff:
+    """
+    Passes time series between the analyzers of a Pipeline (see lib.lib.Pipeline) in memory.
+    Data written to each of <streams> is kept as chunks of numpy columns for the last <keep> seconds,
+        numbered by the total number of data points written so far, so that each reader
+        (a PipelineDatabase) can keep its own read position, like a Bookmark.
+    """
+    def __init__(self, streams, keep=30):
+        self.streams = set(streams)  # streams passed in memory
+        self.keep = keep  # time (s) of data kept for each stream
+        self.chunks = {}  # stream: list of (number of the first data point, dict of columns)
+        self.written = {}  # stream: total number of data points written
+        self.cond = threading.Condition()  # notified on every write
+
+    def handles(self, stream):
+        """ Whether <stream> is passed in memory """
+        return stream in self.streams
+
+    def put(self, stream, data):
+        """ Adds time series <data>, in the same format as Database.write_data() """
+        columns = {key: np.atleast_1d(np.array(val)) for key, val in data.items()}  # copied, as the caller may reuse its arrays
+        with self.cond:
+            chunks = self.chunks.setdefault(stream, [])
+            chunks.append((self.written.get(stream, 0), columns))
+            self.written[stream] = self.written.get(stream, 0) + len(columns['time'])
+
+            # drop chunks that ended more than <keep> seconds before the newest data point
+            oldest = columns['time'][-1] - self.keep*1000
+            while len(chunks) > 1 and chunks[0][1]['time'][-1] < oldest:
+                chunks.pop(0)
+            self.cond.notify_all()
+
+    def read(self, stream, position=None, count=None, max_time=None):
+        """
+        Returns a tuple (columns, position) of the data of <stream> after <position>
+            (the number of data points already read, or None to read everything kept),
+            and the position to read from next time. Columns is None if there is nothing new.
+        <count>, <max_time> same as Database.read_data().
+        """
+        with self.cond:
+            chunks = self.chunks.get(stream)
+            if not chunks:
+                return None, position
+            end = self.written[stream]
+            if count:  # last COUNT data points regardless of last read
+                start = max(end - count, chunks[0][0])
+            else:
+                start = max(position or 0, chunks[0][0])
+                if start >= end:
+                    return None, position
+            parts = [(first, columns) for first, columns in chunks if first + len(columns['time']) > start]
+
+        # chunks are never modified once added, so they are joined outside of the lock
+        output = {}
+        for key in parts[-1][1].keys():
+            output[key] = np.concatenate([columns[key][max(start - first, 0):] for first, columns in parts])
+        if max_time and not count:  # only the last <max_time> seconds
+            keep = output['time'] >= output['time'][-1] - max_time*1000
+            output = {key: column[keep] for key, column in output.items()}
+        return output, end
+
+    def columns(self, stream):
+        """ Returns the names of the data columns (other than 'time') of <stream> in its newest chunk, or None """
+        with self.cond:
+            chunks = self.chunks.get(stream)
+            if not chunks:
+                return None
+            return [key for key in chunks[-1][1].keys() if key != 'time']
+
+    def wait(self, positions, streams, timeout=1):
+        """
+        Blocks until any of <streams> has data after its position in <positions>, or until <timeout> (s) passes.
+        Returns the list of streams with new data.
+        """
+        def new():
+            return [stream for stream in streams if self.written.get(stream, 0) > (positions.get(stream) or 0)]
+        with self.cond:
+            self.cond.wait_for(new, timeout)
+            return new()
+
+
+class PipelineDatabase(Database):
+    """
+    Database connection of an analyzer running as a stage of a Pipeline (see lib.lib.Pipeline).
+    Streams that one stage writes and another reads go through a StreamHandoff shared by all stages,
+        so the next stage gets them as numpy arrays without anything being serialized or read back.
+    Time series and snapshots are only written to the database while they are displayed
+        on a page (see mark_viewing()), or if they belong to a stage in <durable>.
+    Reads of time ranges (t0, t1) are always from the database.
+    <handoff> StreamHandoff shared by all stages of the pipeline.
+    <durable> IDs of the stages whose streams are always written to the database.
+    <viewing_interval> time (s) for which whether a stream is displayed is cached.
+    Other keyword options are passed to Database.
+    """
+    def __init__(self, ip, port, password, handoff, durable=(), viewing_interval=1, **options):
+        super().__init__(ip, port, password, **options)
+        self.handoff = handoff
+        self.durable = set(durable)
+        self.viewing_interval = viewing_interval
+        self.positions = {}  # stream: number of data points already read from the handoff
+        self._viewing = {}  # stream: (whether displayed, time it was checked)
+
+    def persist(self, stream):
+        """ Whether writes to <stream> go to the database """
+        if stream.split(':')[-1] in self.durable:  # with or without a prefix
+            return True
+        viewing, checked = self._viewing.get(stream, (False, 0))
+        if time() - checked > self.viewing_interval:
+            viewing = self.is_viewing(stream)
+            self._viewing[stream] = (viewing, time())
+        return viewing
+
+    def write_data(self, stream, data, chunked=None, channels=None, time_row=None, time_scale=1):
+        """ Extends write_data() to hand the data to the other stages, and only write it to the database if needed """
+        if isinstance(data, ndarray):
+            data = self.array_columns(data, channels, time_row, time_scale)
+        if self.handoff.handles(stream):
+            self.handoff.put(stream, data)
+        if self.persist(stream):
+            super().write_data(stream, data, chunked)
+
+    def write_batch(self, batches):
+        """ Extends write_batch() in the same way as write_data() """
+        for stream, data in batches:
+            if self.handoff.handles(stream):
+                self.handoff.put(stream, data)
+        batches = [(stream, data) for stream, data in batches if self.persist(stream)]
+        if batches:
+            super().write_batch(batches)
+
+    def write_snapshot(self, stream, data, static=()):
+        """ Extends write_snapshot() to only write snapshots that are displayed """
+        if self.persist(stream):
+            super().write_snapshot(stream, data, static)
+
+    def read_data(self, stream, count=None, max_time=None, to_json=False, decode=True, downsample=False, points=1000):
+        """ Extends read_data() to read streams of other stages from the handoff """
+        if not self.handoff.handles(stream):
+            return super().read_data(stream, count, max_time, to_json, decode, downsample, points)
+        columns = self._take(stream, count, max_time)
+        if columns is None:
+            return None
+        output = {key: column.tolist() for key, column in columns.items()}
+        if to_json:
+            return json.dumps(output)
+        return output
+
+    def read_array(self, stream, count=None, max_time=None, t0=None, t1=None, columns=None, dtype=float64):
+        """ Extends read_array() to read streams of other stages from the handoff """
+        if not self.handoff.handles(stream) or t0 is not None or t1 is not None:
+            return super().read_array(stream, count, max_time, t0, t1, columns, dtype)
+        output = self._take(stream, count, max_time)
+        if output is None:
+            return None
+        if columns is None:  # all columns other than 'time' in the order they were written
+            columns = [key for key in output.keys() if key != 'time']
+        data = np.array([output[key] for key in columns], dtype=dtype)
+        return output['time'].astype(float64, copy=False), data
+
+    def read_columns(self, stream):
+        """ Extends read_columns() to get the columns of streams of other stages from the handoff """
+        if not self.handoff.handles(stream):
+            return super().read_columns(stream)
+        return self.handoff.columns(stream)
+
+    def wait(self, streams, timeout=1):
+        """
+        Extends wait() to wait for the streams of other stages in the handoff.
+        If any of <streams> are in the handoff, the others aren't waited for.
+        """
+        internal = [stream for stream in streams if stream is not None and self.handoff.handles(stream)]
+        if not internal:
+            return super().wait(streams, timeout)
+        return self.handoff.wait(self.positions, internal, timeout)
+
+    def _take(self, stream, count=None, max_time=None):
+        """ Reads <stream> from the handoff and moves its read position. Returns a dict of columns, or None. """
+        columns, self.positions[stream] = self.handoff.read(stream, self.positions.get(stream), count, max_time)
+        return columns
+
+
 class ServerDatabase(Database):
     """
     Base class to handle a connection to a database on the server where the database is hosted.
@@ -814,10 +2209,13 @@ class LiveDatabase(ServerDatabase):
         functionality to control the state of the database.
     Created only by DatabaseController.new_live()
     """
-    def __init__(self, ip, port, password, file, live_path, save_path):
+    def __init__(self, ip, port, password, file, live_path, save_path, archive=False, cache=None):
         super().__init__(ip, port, password, file)
         self.live_path = live_path  # path to live directory
         self.save_path = save_path  # path to save directory
+        self.archive = archive  # whether to save as a session archive instead of a copy of the RDB file
+        self.cache = cache  # LiveReadCache shared with the other live sessions, if any
+        self.marked = {}  # stream: time it was last marked as displayed. See viewing().
         self.start_time = self.get_start_time()  # get start time from database
         # todo: if two sessions are viewing the same live database, and one session
         #  stops and restarts the streams, the other session does not update its own
@@ -831,6 +2229,39 @@ class LiveDatabase(ServerDatabase):
     def live(self):
         return True
 
+    def viewing(self, stream):
+        """ Marks <stream> as displayed (see mark_viewing()), at most a few times every VIEWING_TTL seconds """
+        if time() - self.marked.get(stream, 0) > VIEWING_TTL/3:
+            self.marked[stream] = time()
+            self.mark_viewing(stream)
+
+    @catch_database_errors
+    def read_data(self, stream, count=None, max_time=None, to_json=False, decode=True, downsample=False, points=1000):
+        """
+        Extends read_data() to serve downsampled reads of recent data from the
+            LiveReadCache shared by all live sessions, if there is one.
+        """
+        self.viewing(stream)
+        if self.cache and downsample and max_time and decode and not count:
+            bookmark = self.bookmarks.get(stream)
+            if not bookmark.lock(block=False):  # another read of this stream is in progress in this session
+                return None
+            try:
+                return self.cache.read(bookmark, stream, max_time, points, to_json)
+            finally:
+                bookmark.release()
+        return super().read_data(stream, count, max_time, to_json, decode, downsample, points)
+
+    def snapshot_etag(self, stream):
+        """ Extends snapshot_etag() to mark the stream as displayed, since the page may not need to read it """
+        self.viewing(stream)
+        return super().snapshot_etag(stream)
+
+    def read_snapshot(self, stream, to_json=False, decode=True):
+        """ Extends read_snapshot() to mark the stream as displayed """
+        self.viewing(stream)
+        return super().read_snapshot(stream, to_json, decode)
+
     @catch_database_errors
     def start(self):
         """
@@ -843,12 +2274,16 @@ class LiveDatabase(ServerDatabase):
             self.redis.set('START_TIME', self.start_time)  # set start time to be read by others
 
         self.redis.set('STREAMING', 1)  # set STREAMING
+        if self.cache:
+            self.cache.clear()
 
     @catch_database_errors
     def stop(self):
         """ Removes "STREAMING" key in database """
         self.bookmarks.clear()  # clear all bookmarks when live stream is stopped.
         self.redis.delete('STREAMING')  # unset STREAMING key
+        if self.cache:  # shared reads of the stopped stream would be served to other sessions
+            self.cache.clear()
 
     @catch_database_errors
     def wipe(self):
@@ -871,6 +2306,46 @@ class LiveDatabase(ServerDatabase):
         <save> whether to save the file in the storage directory,
             and returns the full filename used (may not be the same as given)
         """
+        if self.archive:
+            filename = self._save_archive(filename)
+        else:
+            filename = self._save_rdb(filename)
+
+        try:  # clear contents of live dump file
+            self.wipe()
+        except Exception as e:
+            raise DatabaseError("Failed to flush database file '{}': {}".format(filename, e))
+
+        if shutdown:
+            try:
+                self.redis.shutdown()
+            except Exception as e:
+                raise DatabaseError("Failed to shut down database: {}".format(e))
+
+        return filename
+
+    @catch_database_errors
+    def _save_archive(self, filename=None):
+        """
+        Exports the current database in memory to a session archive in the storage directory.
+        Returns the full filename used (may not be the same as given).
+        """
+        if filename and filename.endswith('.rdb'):
+            filename = filename[:-len('.rdb')]
+        # if file name not given or already exists
+        if not filename or path.exists(self.save_path+'/'+filename) or path.exists(self.save_path+'/'+filename+ARCHIVE_EXT):
+            filename = get_time_filename(ARCHIVE_EXT)
+        if not filename.endswith(ARCHIVE_EXT):
+            filename += ARCHIVE_EXT
+
+        write_archive(self.bytes_redis, self.save_path+'/'+filename)
+        return filename
+
+    def _save_rdb(self, filename=None):
+        """
+        Saves the current database in memory to disk and copies the RDB file to the storage directory.
+        Returns the full filename used (may not be the same as given).
+        """
         # Todo: Make this more robust to possible errors.
         #  Check redis's last update time before and after to check if it changed, indicating a successful save
 
@@ -910,17 +2385,6 @@ class LiveDatabase(ServerDatabase):
         if not path.isfile("{}/{}".format(self.save_path, filename)):
             raise DatabaseError("Failed to save database file to '{}'. Aborting database wipe.".format(filename))
 
-        try:  # clear contents of live dump file
-            self.wipe()
-        except Exception as e:
-            raise DatabaseError("Failed to flush database file '{}': {}".format(filename, e))
-
-        if shutdown:
-            try:
-                self.redis.shutdown()
-            except Exception as e:
-                raise DatabaseError("Failed to shut down database: {}".format(e))
-
         return filename
 
     @catch_database_errors
@@ -1058,23 +2522,30 @@ class PlaybackDatabase(ServerDatabase):
         """ Not allowed """
         raise DatabaseError("Cannot write to read-only playback database")
 
+    def wait(self, streams, timeout=1):
+        """
+        Nothing is ever written during playback - data just becomes due as the playback time passes.
+        Waits a short time and returns all <streams>.
+        """
+        sleep(min(timeout, 0.1))
+        return [stream for stream in streams if stream is not None]
+
     def write_snapshot(self, *args, **kwargs):
         """ Not allowed """
         raise DatabaseError("Cannot write to read-only playback database")
 
-    @catch_database_errors
-    def read_data(self, stream, count=None, max_time=None, to_json=False, decode=True, downsample=False):
+    def _read(self, stream, count=None, max_time=None, decode=True, downsample=False, points=None):
         """
-        Gets newest data for <reader> from data column <stream>.
-        <stream> is some ID that identifies the stream in the database.
-        <reader> is some ID that will keep track of it's own read head position.
+        Returns the raw redis response of the newest data in stream:<stream> relative
+            to the playback time, and moves its read position.
+        Not meant to be called directly. Used by read_data() and read_array().
         <count> Not implemented in playback mode.
+        <downsample> Whether to read from the coarsest rollup level that still gives <points> data points.
+            The whole range is read at once either way, and read_data() reduces it.
         <max_time> maximum time window (s) to read.
             - If None, read as much as possible (guarantees all data read)
-        <numerical>  Whether the data needs to be converted python float type
         <decode> Whether to decode the result into strings.
             If False, only values will remain as bytes. Keys will still be decoded.
-        <to_json> whether to convert to json string. if False, uses dictionary of lists.
         """
         if not stream:
             return
@@ -1084,10 +2555,7 @@ class PlaybackDatabase(ServerDatabase):
         if not bookmark.lock(block=False):  # acquire lock
             return  # return if not acquired
 
-        if decode:
-            red = self.redis
-        else:
-            red = self.bytes_redis
+        red = self._redis(stream, decode)
 
         if not bookmark.last_id or not bookmark.last_time:  # no last read spot exists
             first_read = red.xrange('stream:' + stream, count=1)  # read first data point
@@ -1119,11 +2587,15 @@ class PlaybackDatabase(ServerDatabase):
             new_last_time = self.redis_to_time(last_read_id) + (time_since_last-max_time*1000)
             last_read_id = self.time_to_redis(new_last_time)  # convert back to redis timestamp
 
-        if downsample and self.playback_speed > 1:  # get downsampled response if playing at high multiplier
-            response = self._downsample(stream, last_read_id, max_read_id)
-        else:
-            # Redis uses the prefix "(" to represent an exclusive interval for XRANGE
-            response = red.xrange('stream:'+stream, min='('+last_read_id, max=max_read_id)
+        key = 'stream:'+stream
+        level = None  # rollup level read from
+        if downsample:  # at high playback speeds this saves scanning every data point
+            level = self.rollup_level(stream, max_timestamp - self.redis_to_time(last_read_id), points)
+            if level:
+                key = self.rollup_key(stream, level)
+
+        # Redis uses the prefix "(" to represent an exclusive interval for XRANGE
+        response = red.xrange(key, min='('+last_read_id, max=max_read_id)
 
         if not response:
             bookmark.release()
@@ -1132,18 +2604,14 @@ class PlaybackDatabase(ServerDatabase):
         # response is a list of tuples. First is the redis timestamp ID, second is the data dict.
         # set last-read info
         bookmark.last_time = self.time()
-        bookmark.last_id = self.decode(response[-1][0])  # store last timestamp
-
-        # convert redis response to python dict
-        output = self.convert_response(response)
-
-        if to_json:
-            result = json.dumps(output)
-        else:
-            result = output
+        bookmark.last_id = self.last_read_id(response, level)  # store last timestamp
 
         bookmark.release()  # release lock
-        return result
+        return response
+
+    def snapshot_etag(self, stream):
+        """ Snapshots depend on the playback time, and read_snapshot() already gives nothing when none is new """
+        return None
 
     @catch_database_errors
     def read_snapshot(self, stream, to_json=False, decode=True):
@@ -1164,10 +2632,7 @@ class PlaybackDatabase(ServerDatabase):
         if not bookmark.lock(block=False):  # acquire lock
             return  # return if already locked
 
-        if decode:
-            red = self.redis
-        else:
-            red = self.bytes_redis  # not implemented for this method
+        red = self._redis(stream, decode)  # packed snapshots can only be read as bytes
 
         if bookmark.last_id and bookmark.last_time:  # last read spot exists
             last_read_id = bookmark.last_id
@@ -1195,66 +2660,36 @@ class PlaybackDatabase(ServerDatabase):
         bookmark.last_time = self.time()
         bookmark.last_id = self.decode(response[0][0])  # store last timestamp
 
-        data = response[0][1]  # data dict (only one data point)
-        keys = data.keys()  # get keys from data dict
-        output = {key: [] for key in keys}
-
-        for key in keys:
-            vals = data[key].split(',')
-            output[key] = [self.redis_to_data(val, False) for val in vals]
-
-        if to_json:
-            del output['time']  # remove time column for json format
-            result = json.dumps(output)
-        else:
-            result = output
+        result = self.convert_snapshot(stream, response[0], to_json)
         bookmark.release()  # release lock
         return result
 
-    @catch_database_errors
-    def _downsample(self, stream, last_id, max_id):
-        """
-        Returns the raw redis response from <last_id> to <max_id> (not including last_id),
-            but downsampled according to the current playback speed.
-        Not meant to be called directly. Used by other read_data() methods.
-        Assumes that the bookmark for this stream already exists and it's lock has been acquired.
-        Assumes that normal redis is being used (not bytes_redis).
-        If no 'sample_rate' key is found for this stream, assumes 100Hz.
-            - This will over-downsample streams over 100Hz,
-                under-downsample streams between 100Hz/playback_speed and 100Hz,
-                and streams under 100Hz/playbackspeed will be unaffected (I think).
-        """
-        bookmark = self.bookmarks[stream]
-        if not bookmark.sample_rate:  # if no sample rate, find it
-            bookmark.sample_rate = self.get_info(stream, 'sample_rate')
-            if not bookmark.sample_rate:  # no sample rate given in info data column
-                bookmark.sample_rate = 100*self.playback_speed  # downsample to 100Hz
-            else:
-                bookmark.sample_rate = int(bookmark.sample_rate)
 
-        # time in ms of downsampled data chunk
-        bucket_size = 1000*self.playback_speed / bookmark.sample_rate
+class ArchiveDatabase(PlaybackDatabase):
+    """
+    Playback database served straight from a session archive on disk (see lib/archive.py),
+        instead of from a redis-server that has to load a whole RDB file into memory first.
+    Reads go through ArchiveClient objects in place of the redis clients, so all
+        read methods of PlaybackDatabase work unchanged.
+    Stream files are memory-mapped, so opening is immediate and only the data being read is paged in.
+    Created only by DatabaseController.new_playback()
+    """
+    def __init__(self, file, save_path):
+        super().__init__(ip=None, port=None, password=None, file=file)
+        self.archive = Archive(save_path+'/'+file)
+        self.redis = ArchiveClient(self.archive, decode_responses=True)
+        self.bytes_redis = ArchiveClient(self.archive, decode_responses=False)
 
-        # integer milliseconds of the given redis IDs
-        last_id_time = self.redis_to_time(last_id)
-        max_id_time = self.redis_to_time(max_id)
+    def __repr__(self):
+        return "Archive, {}".format(self.file)
 
-        pipe = self.redis.pipeline()  # pipeline queues a series of commands at once
-        while last_id_time < max_id_time:
-            start_id = self.time_to_redis(last_id_time)  # start of bucket range
-            last_id_time += bucket_size  # increment by bucket size
-            end_id = self.time_to_redis(last_id_time)  # end of bucket range
-            pipe.xrevrange('stream:'+stream, min='('+start_id, max=end_id, count=1)
-
-        # list of lists of tuples
-        raw_response = pipe.execute()
-        response = []
-        for lst in raw_response:
-            if lst:  # pick out only results with data
-                response.append(lst[0])  # put the single data point into the response list
+    def kill(self):
+        """ No server process to kill """
+        self.shutdown()
 
-        # response is now in same format as if read by a single XRANGE command
-        return response
+    def shutdown(self):
+        """ Closes the archive files """
+        self.archive.close()
 
 
 class Bookmarks:
@@ -1297,6 +2732,16 @@ class Bookmark:
         self.end_id = None    # last database timestamp ID in the whole stream
 
         self.sample_rate = None  # sample rate of a given stream, if applicable
+        self.binary = None  # whether the stream holds packed binary entries (None if not yet known)
+        self.rolled_up = None  # whether rollup levels are kept for the stream (None if not yet known)
+        self.rollup = None  # Rollup accumulating the buckets of the stream, if writing with rollups
+
+        self.group = None  # consumer group this stream has been read as part of, if any
+        self.pending = []  # IDs delivered through the consumer group that have not been acknowledged
+        self.last_claim = 0  # real time (s) of the last check for other consumers' idle entries
+        self.cursor = None  # number of the last batch given to this session by a LiveReadCache
+        self.snapshot = None  # (ID, json string) of the last snapshot read as json
+        self.header = None  # (tag, columns) of the last snapshot header written or read
 
         self.write = None  # last written database time in INTEGER MILLISECONDS
         self.seq = 0    # last written database SEQUENCE NUMBER
@@ -1323,14 +2768,76 @@ class Bookmark:
         self.end_time = None
         self.ms = None
         self.seq = None
+        self.binary = None
+        self.rolled_up = None
+        self.cursor = None
+        self.snapshot = None
+        self.header = None
 
 
+class Rollup:
+    """
+    Used by Database.write_data() to accumulate min/max/mean buckets of a numerical stream
+        at each of ROLLUP_LEVELS.
+    Each level is fed the completed buckets of the level below it, so the raw data is only scanned once.
+    The last bucket of each level is held back until data for a later bucket arrives.
+    <columns> names of the data columns, giving the order of the rows of data.
+    """
+    def __init__(self, columns):
+        self.columns = columns
+        self.pending = {level: None for level in ROLLUP_LEVELS}  # incomplete last bucket of each level
 
+    def add(self, times, data):
+        """
+        Adds a batch of data points.
+        <times> 1-D array of unix time stamps (ms)
+        <data> 2-D array of shape (columns, samples)
+        Returns a list of (level, start, count, total, low, high) for each level with newly completed buckets.
+            start and count are 1-D arrays of the start time and number of data points in each bucket,
+            and total, low, high are 2-D arrays of the sum, min and max of each column in each bucket.
+        """
+        count = np.ones(len(times))
+        buckets = (times, count, data, data, data)
+        completed = []
+        for level in ROLLUP_LEVELS:
+            buckets = self._bucket(level, *buckets)
+            if buckets is None:  # no coarser level can have completed a bucket either
+                break
+            completed.append((level,) + buckets)
+        return completed
 
-
-
-
-
-
-
-
+    def _bucket(self, level, times, count, total, low, high):
+        """
+        Groups the given buckets (or data points) into buckets of <level> ms.
+        Returns the completed buckets in the same format as the arguments, or None if there are none.
+        """
+        if not len(times):
+            return None
+        index = np.floor(times / level).astype(np.int64)  # bucket number of each input
+        starts = np.concatenate(([0], np.flatnonzero(np.diff(index)) + 1))  # first input of each bucket
+        b_index = index[starts]
+        b_count = np.add.reduceat(count, starts)
+        b_total = np.add.reduceat(total, starts, axis=1)
+        b_low = np.minimum.reduceat(low, starts, axis=1)
+        b_high = np.maximum.reduceat(high, starts, axis=1)
+
+        pending = self.pending[level]
+        if pending is not None:
+            p_index, p_count, p_total, p_low, p_high = pending
+            if p_index >= b_index[0]:  # more data for the held back bucket
+                b_count[0] += p_count
+                b_total[:, 0] += p_total
+                b_low[:, 0] = np.minimum(b_low[:, 0], p_low)
+                b_high[:, 0] = np.maximum(b_high[:, 0], p_high)
+            else:  # held back bucket is complete
+                b_index = np.concatenate(([p_index], b_index))
+                b_count = np.concatenate(([p_count], b_count))
+                b_total = np.column_stack((p_total, b_total))
+                b_low = np.column_stack((p_low, b_low))
+                b_high = np.column_stack((p_high, b_high))
+
+        # hold back the last bucket, which may still get more data
+        self.pending[level] = (b_index[-1], b_count[-1], b_total[:, -1], b_low[:, -1], b_high[:, -1])
+        if len(b_index) == 1:
+            return None
+        return (b_index[:-1] * level).astype(float64), b_count[:-1], b_total[:, :-1], b_low[:, :-1], b_high[:, :-1]
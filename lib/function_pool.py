@@ -0,0 +1,264 @@
+"""
+Pool of worker processes to run user functions (like the custom pipelines of a FunctionAnalyzer)
+    with a deadline and CPU/memory limits on each call.
+The workers are separate python processes (python -m lib.function_pool) rather than multiprocessing children,
+    since workers are run on daemonic processes, which aren't allowed to have children.
+
+User functions take and return a dictionary of lists, one for each column (including 'time').
+Functions decorated with @block_function instead take a Block of numpy arrays, and return either
+    a 2-D array (channels x samples) with the same times and channel names, a new Block, or None to write nothing:
+
+    from lib.function_pool import block_function
+
+    @block_function
+    def rectify(block):
+        return np.abs(block.data)
+
+A generator function decorated with @block_function keeps its state from one block to the next.
+    It is sent each block, and yields its output for it:
+
+    @block_function
+    def smooth():
+        last = None
+        block = yield
+        while True:
+            ...
+            block = yield output
+"""
+from concurrent.futures import Future
+from multiprocessing.connection import wait
+from collections import namedtuple
+from itertools import count
+from threading import Thread
+import subprocess
+import inspect
+import importlib
+import resource
+import pickle
+import queue
+import time
+import sys
+import os
+
+import numpy as np
+
+# Input and output of block functions (see block_function()).
+# <time> 1-D array of unix times (ms), <data> 2-D array of shape (channels, samples),
+# <channels> list of channel names (one for each row of data), <sample_rate> sampling rate (Hz) if known, or None.
+Block = namedtuple('Block', ['time', 'data', 'channels', 'sample_rate'])
+
+
+def block_function(func):
+    """
+    Decorator marking a user function as taking a Block rather than a dictionary of lists.
+    If <func> is a generator function, one generator is kept for each target stream,
+        so that it can carry state (like filter initial conditions) from one block to the next.
+    """
+    func.block = True
+    return func
+
+
+def to_block(data):
+    """ Converts a dictionary of columns to a Block """
+    channels = [key for key in data.keys() if key != 'time']
+    return Block(np.asarray(data['time'], dtype=float), np.array([data[key] for key in channels], dtype=float), channels, None)
+
+
+def to_columns(block, lists=False):
+    """ Converts a Block to a dictionary of columns, which are rows of the block (or lists if <lists>) """
+    columns = {'time': block.time}
+    columns.update(zip(block.channels, block.data))
+    if lists:
+        columns = {key: np.asarray(column).tolist() for key, column in columns.items()}
+    return columns
+
+
+def block_output(block, output):
+    """ Converts the output of a block function for <block> to a Block, or None if there is nothing to write """
+    if output is None or isinstance(output, Block):
+        return output
+    if isinstance(output, tuple):  # (time, data)
+        time, data = output
+    else:  # same times
+        time, data = block.time, output
+    data = np.asarray(data)
+    if data.ndim == 1:  # single channel
+        data = data[np.newaxis, :]
+    channels = block.channels if len(data) == len(block.channels) else ['ch{}'.format(i) for i in range(len(data))]
+    return Block(np.asarray(time), data, channels, block.sample_rate)
+
+
+class FunctionError(Exception):
+    """ Raised by the Future of a call that ran past its deadline or limits, or whose worker process failed """
+
+
+class FunctionPool:
+    """
+    Runs calls of user functions on a pool of worker processes, so that a slow, stuck or greedy
+        function can't hold up or take down the process that uses it.
+    Each call runs its data through a list of functions in order, given by module and function name,
+        which are imported in the worker process.
+    Workers run at a lower priority than the caller. A worker whose call runs past its deadline
+        or its limits is killed and replaced (losing the state of its generator functions).
+    Calls with the same key always run on the same worker, in order, so that generator functions keep their state.
+    <processes> number of worker processes (and so of calls run at the same time).
+    <timeout> wall-clock deadline (s) of each call.
+    <cpu_limit> CPU time (s) each call may use. None for no limit.
+    <memory_limit> maximum address space (bytes) of each worker process. None for no limit.
+    <nice> niceness added to the worker processes.
+    """
+    def __init__(self, processes=2, timeout=5, cpu_limit=None, memory_limit=None, nice=10):
+        self.timeout = timeout
+        self.args = [str(cpu_limit or 0), str(memory_limit or 0), str(nice)]  # passed to serve()
+        self.queues = [queue.Queue() for _ in range(processes)]  # (Future, calls, data, key) waiting for each worker
+        self.next = count()  # for spreading calls without a key over the workers
+        for i, jobs in enumerate(self.queues):
+            Thread(target=self._run, args=(jobs,), name='FunctionPool-{}'.format(i), daemon=True).start()
+
+    def submit(self, calls, data, key=None):
+        """
+        Queues <data> (a dictionary of lists, or a Block) to be run through <calls>,
+            a list of (module, function name) tuples in order.
+        <key> identifies the series of data (e.g. the target stream) that generator functions keep state for.
+        Returns a Future of a tuple (data, timing, errors):
+            - data is the output of the last function. A function that raises is skipped.
+            - timing is a dict of the time (s) each function took, by module.
+            - errors is a dict of the error raised by any function, by module.
+        The Future raises FunctionError if the call ran past its deadline or limits.
+        """
+        future = Future()
+        index = hash(key) if key is not None else next(self.next)
+        self.queues[index % len(self.queues)].put((future, calls, data, key))
+        return future
+
+    def close(self):
+        """ Stops all worker processes once their current calls are done. Queued calls are dropped. """
+        for jobs in self.queues:
+            while True:
+                try:
+                    jobs.get_nowait()[0].cancel()
+                except queue.Empty:
+                    break
+            jobs.put(None)
+
+    def _start(self):
+        """ Starts a worker process, which imports modules from the same paths as this one """
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join(path for path in sys.path if path))
+        return subprocess.Popen([sys.executable, '-m', 'lib.function_pool', *self.args],
+                                stdin=subprocess.PIPE, stdout=subprocess.PIPE, env=env)
+
+    def _run(self, jobs):
+        """ Sends the calls in <jobs> to one worker process, and replaces the process if a call fails """
+        process = None
+        while True:
+            job = jobs.get()
+            if job is None:  # closed
+                break
+            future, calls, data, key = job
+            if not future.set_running_or_notify_cancel():
+                continue
+            if not process or process.poll() is not None:
+                process = self._start()
+
+            names = ', '.join(name for _, name in calls)
+            try:
+                pickle.dump((calls, data, key), process.stdin)
+                process.stdin.flush()
+                if not wait([process.stdout], self.timeout):
+                    raise FunctionError("Call of [{}] ran for more than {} seconds".format(names, self.timeout))
+                result = pickle.load(process.stdout)
+            except FunctionError as e:
+                self._kill(process)
+                process = None
+                future.set_exception(e)
+            except (EOFError, OSError, pickle.UnpicklingError):  # killed for running past its CPU or memory limit
+                code = self._kill(process)
+                process = None
+                future.set_exception(FunctionError("Worker process running [{}] exited with code {}".format(names, code)))
+            else:
+                future.set_result(result)
+
+        if process:
+            self._kill(process)
+
+    def _kill(self, process):
+        """ Kills a worker process. Returns its exit code. """
+        process.kill()
+        return process.wait()
+
+
+def serve(cpu_limit, memory_limit, nice):
+    """
+    Main loop of a worker process. Reads pickled (calls, data, key) from stdin and writes pickled results to stdout.
+    See FunctionPool.submit() for the format.
+    Data is converted between a dictionary of lists and a Block as each function needs.
+    """
+    output = os.fdopen(os.dup(1), 'wb')  # results are sent on the original stdout
+    os.dup2(2, 1)  # anything the functions print goes to stderr instead
+    sys.stdout = sys.stderr
+    os.nice(nice)
+    if memory_limit:
+        resource.setrlimit(resource.RLIMIT_AS, (memory_limit, memory_limit))
+
+    functions = {}  # (module, name): imported function
+    generators = {}  # (key, module, name): running generator of a generator block function
+    while True:
+        try:
+            calls, data, key = pickle.load(sys.stdin.buffer)
+        except EOFError:  # pool closed
+            return
+
+        if cpu_limit:  # limit is on the total CPU time of the process, so move it to <cpu_limit> from now
+            usage = resource.getrusage(resource.RUSAGE_SELF)
+            hard = resource.getrlimit(resource.RLIMIT_CPU)[1]
+            resource.setrlimit(resource.RLIMIT_CPU, (int(usage.ru_utime + usage.ru_stime + cpu_limit) + 1, hard))
+
+        timing, errors = {}, {}
+        for module, name in calls:
+            if data is None:  # a block function gave nothing to pass on
+                break
+            start = time.perf_counter()
+            try:
+                if (module, name) not in functions:
+                    functions[(module, name)] = getattr(importlib.import_module(module), name)
+                func = functions[(module, name)]
+                if not getattr(func, 'block', False):
+                    data = func(to_columns(data, lists=True) if isinstance(data, Block) else data)
+                else:
+                    block = data if isinstance(data, Block) else to_block(data)
+                    if inspect.isgeneratorfunction(func):
+                        data = block_output(block, run_generator(generators, (key, module, name), func, block))
+                    else:
+                        data = block_output(block, func(block))
+            except Exception as e:
+                errors[module] = "{}: {}".format(e.__class__.__name__, e)
+            timing[module] = time.perf_counter() - start
+
+        try:
+            result = pickle.dumps((data, timing, errors))
+        except Exception as e:
+            errors['result'] = "Output can't be sent back. {}: {}".format(e.__class__.__name__, e)
+            result = pickle.dumps((None, timing, errors))
+        output.write(result)
+        output.flush()
+
+
+def run_generator(generators, key, func, block):
+    """ Sends <block> to the generator of <func> for <key>, starting it if needed. Returns what it yields. """
+    generator = generators.get(key)
+    if generator is None:
+        generator = func()
+        next(generator)  # run up to the first yield
+        generators[key] = generator
+    try:
+        return generator.send(block)
+    except BaseException:  # finished or failed - start again with the next block
+        del generators[key]
+        raise
+
+
+if __name__ == '__main__':
+    # run the imported copy of this module, so that Blocks pickled by the pool (and made by user functions)
+    # are instances of the same class as the one serve() checks for
+    from lib.function_pool import serve
+    serve(float(sys.argv[1]), int(sys.argv[2]), int(sys.argv[3]))
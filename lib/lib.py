@@ -1,17 +1,26 @@
 from multiprocessing import Process, current_process, Pipe, Lock, Condition, Event
 from threading import Thread, current_thread
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import asyncio
 
 from datetime import datetime
 import functools
+from copy import deepcopy
 from uuid import uuid4
 import json
 import traceback
 import time
 import os
+import resource
 
 import socketio
+import numpy as np
 
 from lib.database import Database, DatabaseError, DatabaseBusyLoadingError, DatabaseTimeoutError, DatabaseConnectionError
+from lib.database import PipelineDatabase, StreamHandoff
+from lib.shared_ring import SharedDatabase, remove_segments
+from lib.utils import import_times
 
 
 class Base:
@@ -253,8 +262,11 @@ class Client(Base):
     Worker connections are started on new processed and communicated with using pipes.
     <workers> list of worker classes to run
     <config> path to config file
+    <shared_memory> Whether workers pass time series to each other through shared memory
+        rather than through the database, which still gets a copy of everything (see lib/shared_ring.py).
+        Only for workers that use a plain Database.
     """
-    def __init__(self, workers, name, server_ip, port, db_port, db_pass, debug=0):
+    def __init__(self, workers, name, server_ip, port, db_port, db_pass, debug=0, shared_memory=False):
         super().__init__()
         self.workers = workers
         self.name = name
@@ -264,6 +276,8 @@ class Client(Base):
         self.db_pass = db_pass
         self.set_debug(debug)
         self.pipes = {}   # index of Pipe objects, each connecting to a WorkerNode
+        self.shared_memory = shared_memory
+        self.shm_prefix = 'osp' + uuid4().hex[:8]  # prefix of the names of this client's shared memory segments
 
     def __repr__(self):
         return self.name
@@ -276,6 +290,9 @@ class Client(Base):
         """
         for worker in self.workers:
             worker.set_info(self)  # give worker some of the config params
+            if self.shared_memory and getattr(worker, 'db_class', None) is Database:
+                worker.db_class = SharedDatabase
+                worker.db_options['prefix'] = self.shm_prefix
             self.run_worker(worker)  # run on a parallel process
 
         self.log("All workers initialized.")
@@ -297,14 +314,14 @@ class Client(Base):
         # process for new worker
         worker_process = Process(target=worker.run, args=(worker_pipe,), name=worker, daemon=True)
 
-        # host knows worker name and process. Pipe is indexed by the worker ID
-        self.pipes[worker.id] = PipeHandler(worker, worker_conn, worker_process)
+        # host knows worker name and process. Pipe is indexed by the worker's pipe ID
+        self.pipes[worker.pipe_id] = PipeHandler(worker, worker_conn, worker_process)
 
         # new thread to act as main thread for the worker process
         Thread(target=worker_process.start, name='WorkerMainThread', daemon=True).start()
 
         # read from this pipe on a new thread
-        Thread(target=self._run_pipe, args=(worker.id,), name=self.name+'-PIPE', daemon=True).start()
+        Thread(target=self._run_pipe, args=(worker.pipe_id,), name=self.name+'-PIPE', daemon=True).start()
 
     def remove_worker(self, pipe_id):
         """
@@ -347,9 +364,114 @@ class Client(Base):
         for pipe in list(self.pipes.values()):  # force as iterator because items are removed from the dictionary
             pipe.send('SHUTDOWN')  # signal all workers to shutdown
             pipe.terminate()  # terminate the process if not already
+        if self.shared_memory:  # rings of workers that were terminated before closing them
+            remove_segments(self.shm_prefix)
         self.debug("All worker nodes terminated on Host '{}'".format(self.name), 1)
 
 
+class AsyncClient(Client):
+    """
+    Alternative to Client which runs all of its workers in this one process, rather than a process each.
+    Each Streamer runs as an asyncio task. Its loop() and other blocking calls (drivers, database operations)
+        are pushed to a shared thread pool, so a worker only holds a thread while it's working.
+    All workers share a single socketIO connection and a single pool of database connections,
+        so memory and the number of connections stay flat as workers are added.
+    Takes the same arguments as Client, plus:
+    <threads> size of the shared thread pool. Defaults to one for each worker, plus two for socketIO messages.
+    <idle_interval> time (s) between checks of whether a stopped worker has been started.
+    """
+    def __init__(self, workers, name, server_ip, port, db_port, db_pass, debug=0, threads=None, idle_interval=0.1):
+        super().__init__(workers, name, server_ip, port, db_port, db_pass, debug)
+        self.threads = threads or len(workers) + 2
+        self.idle_interval = idle_interval
+        self.socket = socketio.Client()  # socketIO connection shared by all workers
+        self.database = None  # Database whose connection pools are shared by all workers
+        self.executor = None  # ThreadPoolExecutor running all blocking calls
+        self.loop = None  # asyncio event loop running the workers
+
+    def run(self):
+        """
+        Main entry point. Runs all workers until they stop or the process is interrupted.
+        Must be called on the main thread of a process.
+        """
+        self.executor = ThreadPoolExecutor(max_workers=self.threads, thread_name_prefix=self.name)
+        self.database = Database(self.ip, self.db_port, self.db_pass)  # connects lazily, only lends its pools
+
+        index = {}  # namespace: list of workers connected to it
+        for worker in self.workers:
+            worker.set_info(self)  # give worker some of the config params
+            worker.runtime = self
+            worker.socket = self.socket
+            worker.db_options['shared'] = self.database
+            for namespace in worker.namespaces:
+                index.setdefault(namespace, []).append(worker)
+        for namespace, workers in index.items():
+            self.socket.register_namespace(SharedNamespace(workers, self.executor, namespace))
+        self.connect_socket()
+
+        try:
+            asyncio.run(self._run_workers())
+        except KeyboardInterrupt:
+            self.log("Manual Termination")
+        finally:
+            self.cleanup()
+
+    def connect_socket(self):
+        """ Attempt to get the shared socketIO connection. Loop indefinitely if unsuccessful (see Streamer.connect_socket()). """
+        while not self.exit:
+            try:
+                protocol = 'http' if self.ip == 'localhost' else 'https'
+                self.socket.connect(f'{protocol}://{self.ip}:{self.port}')
+                self.debug("Connected to server socketIO")
+                return True
+            except Exception as e:
+                self.debug("Failed to connect to server socketIO: {}".format(e), 1)
+            time.sleep(5)
+
+    async def _run_workers(self):
+        """ Runs every worker as a task until they have all exited """
+        self.loop = asyncio.get_running_loop()
+        await asyncio.gather(*[self._run_worker(worker) for worker in self.workers])
+        self.debug("No workers left - shutting down '{}'".format(self.name))
+
+    async def _run_worker(self, worker):
+        """ Same as Streamer._run(), with the blocking calls run on the thread pool """
+        try:
+            await self.call(worker.init)  # initialize database connection
+            await self.call(worker.update)  # send info to database
+
+            # start immediately if database is already streaming
+            if await self.call(worker.database.is_streaming):
+                await self.call(worker._start)
+
+            while not (worker.exit or self.exit):  # run until exit
+                if not worker.streaming.is_set():  # idle without holding a thread
+                    await asyncio.sleep(self.idle_interval)
+                    continue
+                await self.call(worker._step)
+        except Exception as e:
+            self.debug("Worker '{}' stopped. {}: {}".format(worker, e.__class__.__name__, e))
+
+    def call(self, func, *args):
+        """ Runs a blocking call on the thread pool. Returns an awaitable of its result. """
+        return self.loop.run_in_executor(self.executor, functools.partial(func, *args))
+
+    def cleanup(self):
+        """ Stop all workers and close the shared connections """
+        for worker in self.workers:
+            worker.halt()
+            try:
+                worker._stop()  # sends everything written so far
+            except Exception as e:
+                self.debug("Failed to stop worker '{}'. {}: {}".format(worker, e.__class__.__name__, e))
+        self.executor.shutdown(wait=False)
+        try:
+            self.socket.disconnect()
+        except Exception:
+            pass
+        self.debug("All workers stopped on '{}'".format(self.name), 1)
+
+
 class WorkerNode(Base):
     """
     Delegated tasks by a host node, run on it's own process.
@@ -365,6 +487,11 @@ class WorkerNode(Base):
     def __repr__(self):
         return self.name
 
+    @property
+    def pipe_id(self):
+        """ Key of this worker's pipe in the Client. Must be unique, even among replicas that share an ID """
+        return self.id
+
     def run(self, pipe):
         """
         Main entry point.
@@ -426,11 +553,17 @@ class Streamer(WorkerNode):
 
         # connection with socketio
         self.socket = socketio.Client()#logger=True, engineio_logger=True)
+        self.runtime = None  # AsyncClient hosting this worker, which shares its socket. None if run on its own process.
         self.namespaces = ['/streamers', '/'+self.id]  # list of namespaces to connect to
 
         # connection to database
         self.database = None  # Database object
+        self.db_class = Database  # class of the Database object (e.g. BufferedDatabase on devices with a flaky connection)
+        self.db_options = {}  # keyword options given to the Database object (see Database.__init__)
+        self.write_queue = None  # WriteQueue used by write()
+        self.write_options = {}  # keyword options given to the WriteQueue (see WriteQueue.__init__)
         self.info = {}  # info dict to be written to the database
+        self.startup = {}  # time (s) taken by each step of starting up. See report_startup().
 
         # flags and events
         self.streaming = Event()  # threading event flag set to activate stream
@@ -464,15 +597,23 @@ class Streamer(WorkerNode):
 
         while not self.exit:  # run until exit
             self.streaming.wait()  # block until streaming event is set
-            try:
-                self.loop()  # call inherited main execution loop
-            except (DatabaseConnectionError, DatabaseTimeoutError, DatabaseBusyLoadingError):
-                self.connect_database()  # ping database, may continue or stop the loop
-            except Exception as e:  # non-database related error
-                self.throw("Unhandled Exception in main loop", trace=True)
-                self._stop()
-                self.socket.emit('error', "[{}] stopped unexpectedly".format(self), namespace='/streamers')
-                raise e
+            self._step()
+
+    def _step(self):
+        """ Runs one iteration of the main execution loop, handling its errors """
+        try:
+            self._loop()  # call inherited main execution loop
+        except (DatabaseConnectionError, DatabaseTimeoutError, DatabaseBusyLoadingError):
+            self.connect_database()  # ping database, may continue or stop the loop
+        except Exception as e:  # non-database related error
+            self.throw("Unhandled Exception in main loop", trace=True)
+            self._stop()
+            self.socket.emit('error', "[{}] stopped unexpectedly".format(self), namespace='/streamers')
+            raise e
+
+    def _loop(self):
+        """ Runs one iteration of the main execution loop. May be extended, but not overwritten. """
+        self.loop()
 
     def loop(self):
         """
@@ -511,7 +652,7 @@ class Streamer(WorkerNode):
         Try to ping the database and return only when the ping is successful.
         """
         if not self.database:
-            self.database = Database(self.ip, self.db_port, self.db_pass)
+            self.database = self.db_class(self.ip, self.db_port, self.db_pass, **self.db_options)
 
         start = time.time()
         while True:
@@ -548,15 +689,50 @@ class Streamer(WorkerNode):
 
     def init(self):
         """ Initialize connections """
-        # register each namespace
-        for namespace in self.namespaces:
-            self.register_namespace(Namespace, namespace)
+        start = time.time()
+        if not self.runtime:  # otherwise the runtime's socket is already connected
+            # register each namespace
+            for namespace in self.namespaces:
+                self.register_namespace(Namespace, namespace)
 
-        # get connection to server socketIO
-        self.connect_socket()
+            # get connection to server socketIO
+            self.connect_socket()
+            self.startup['socket'] = time.time() - start
 
         # get connection to database
+        db_start = time.time()
         self.connect_database()
+        self.startup['database'] = time.time() - db_start
+
+        # writes from the main loop are sent on a separate thread
+        self.write_queue = WriteQueue(self.database, log=self.debug, **self.write_options)
+        self.startup['init'] = time.time() - start
+        self.report_startup()
+
+    def report_startup(self):
+        """
+        Displays how long each step of starting up took, the modules imported on first use so far
+            (see lib.utils.lazy_import()) and the peak memory of the process.
+        Called once connections are initialized, and again after the first start() (which loads the drivers).
+        """
+        steps = ', '.join("{} {:.2f}s".format(step, t) for step, t in self.startup.items())
+        imports = ', '.join("{} {:.2f}s".format(name, t) for name, t in import_times.items()) or 'none'
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024  # kB on Linux
+        self.debug("Startup: {}. Lazy imports: {}. Peak RSS {:.1f} MB".format(steps, imports, rss))
+
+    def write(self, stream, data, **options):
+        """
+        Writes time series <data> to stream:<stream> without waiting for the database.
+        Takes the same arguments as Database.write_data(), including 2-D arrays with
+            their <channels>, <time_row> and <time_scale> (see Database.array_columns()).
+        The data is sent shortly after by the WriteQueue, together with other writes.
+        """
+        if isinstance(data, np.ndarray):  # rows are queued as views on the array
+            data = self.database.array_columns(data, **options)
+        if self.write_queue:
+            self.write_queue.put(stream, data)
+        else:
+            self.database.write_data(stream, data)
 
     def update(self):
         """ Send info to database and signal update to server """
@@ -586,6 +762,7 @@ class Streamer(WorkerNode):
         """
         if self.streaming.is_set():  # already running
             return
+        start = time.time()
         try:
             self.start()  # call subclassed start method
         except Exception as e:
@@ -595,6 +772,9 @@ class Streamer(WorkerNode):
             return
         self.streaming.set()  # set streaming, which starts the main execution while loop
         self.debug("Started".format(self))
+        if 'start' not in self.startup:  # first start
+            self.startup['start'] = time.time() - start
+            self.report_startup()
         self.socket.emit('log', "[{}] Started".format(self), namespace='/streamers')
         self.update()
 
@@ -614,6 +794,10 @@ class Streamer(WorkerNode):
             return
         self.streaming.clear()  # stop streaming, stopping the main execution while loop
         self.stop()  # call subclassed stop method
+        if self.write_queue:  # send everything written before stopping
+            self.write_queue.flush()
+        if isinstance(self.database, SharedDatabase):  # its own writes are also sent in the background
+            self.database.flush()
         self.debug("Stopped".format(self))
         self.socket.emit('log', "[{}] Stopped".format(self), namespace='/streamers')
         self.update()
@@ -630,6 +814,171 @@ class Streamer(WorkerNode):
         self.debug("Received JSON: {}".format(self.name, dic))
         pass
 
+    def cleanup(self):
+        """ Extends cleanup() to close the shared memory rings of a SharedDatabase, so that readers stop using them """
+        if isinstance(self.database, SharedDatabase):
+            self.database.flush()
+            self.database.close()
+        super().cleanup()
+
+
+class WriteQueue:
+    """
+    Collects the writes of a Streamer and sends them to the database on a separate I/O thread,
+        so that the main loop never waits on a round trip to the database.
+    Writes to each stream are joined into a single batch until it holds <max_bytes>,
+        or its oldest data has waited <max_delay> seconds. All batches that are due
+        are then sent together with Database.write_batch().
+    If the database can't be reached, batches are kept and sent again later, up to
+        <max_backlog> bytes for each stream (the oldest data is dropped beyond that).
+    Created by Streamer.init(). Written to by Streamer.write().
+    <log> function to report errors with.
+    """
+    def __init__(self, database, max_bytes=64*1024, max_delay=0.1, max_backlog=64*2**20, log=print):
+        self.database = database
+        self.max_bytes = max_bytes
+        self.max_delay = max_delay
+        self.max_backlog = max_backlog
+        self.log = log
+
+        self.pending = {}  # stream: PendingWrites
+        self.sending = False  # whether batches taken from self.pending are being sent
+        self.force = False  # whether to send all pending batches regardless of size and age
+        self.cond = threading.Condition()
+        Thread(target=self._run, name='WriteQueue', daemon=True).start()
+
+    def put(self, stream, data):
+        """ Adds <data> to the batch of <stream>. Same format as Database.write_data(). """
+        size = self._size(data)
+        with self.cond:
+            pending = self.pending.get(stream)
+            if not pending:
+                pending = PendingWrites()
+                self.pending[stream] = pending
+            pending.add(data, size)
+            if pending.size >= self.max_bytes or len(pending.items) == 1:  # full, or a new deadline to wait for
+                self.cond.notify_all()
+
+    def flush(self, timeout=5):
+        """ Sends all pending batches now, and waits up to <timeout> seconds for them to be written """
+        end = time.time() + timeout
+        with self.cond:
+            self.force = True
+            self.cond.notify_all()
+            while (self.pending or self.sending) and time.time() < end:
+                self.cond.wait(end - time.time())
+            self.force = False
+
+    def _run(self):
+        """ I/O thread sending the batches that are due """
+        while True:
+            with self.cond:
+                due = self._due()
+                while not due:
+                    self.cond.wait(self._next_deadline())
+                    due = self._due()
+                batches = [(stream, self.pending.pop(stream)) for stream in due]
+                self.sending = True
+
+            try:
+                self.database.write_batch([(stream, data) for stream, pending in batches for data in pending.joined()])
+            except (DatabaseConnectionError, DatabaseTimeoutError, DatabaseBusyLoadingError) as e:
+                self.log("Could not write to database - trying again in 1 second. {}: {}".format(e.__class__.__name__, e))
+                self._requeue(batches)
+                time.sleep(1)
+            except Exception as e:  # database or data error - sending them again wouldn't help
+                self.log("Failed to write to database - dropped {} batches. {}: {}".format(len(batches), e.__class__.__name__, e))
+            finally:  # always, so that the thread keeps sending and flush() doesn't wait for nothing
+                with self.cond:
+                    self.sending = False
+                    self.cond.notify_all()
+
+    def _due(self):
+        """ Streams whose batches should be sent now """
+        now = time.time()
+        return [stream for stream, pending in self.pending.items()
+                if self.force or pending.size >= self.max_bytes or now - pending.since >= self.max_delay]
+
+    def _next_deadline(self):
+        """ Time (s) until the oldest batch is due, or None to wait for the next write """
+        if not self.pending:
+            return None
+        oldest = min(pending.since for pending in self.pending.values())
+        return max(oldest + self.max_delay - time.time(), 0.001)
+
+    def _requeue(self, batches):
+        """ Puts batches that could not be sent back in front of anything written since """
+        with self.cond:
+            for stream, pending in batches:
+                newer = self.pending.get(stream)
+                if newer:
+                    for data, size in zip(newer.items, newer.sizes):
+                        pending.add(data, size)
+                while pending.size > self.max_backlog and len(pending.items) > 1:  # drop the oldest data
+                    pending.drop()
+                self.pending[stream] = pending
+
+    def _size(self, data):
+        """ Approximate number of bytes of <data> """
+        size = 0
+        for val in data.values():
+            if isinstance(val, np.ndarray):
+                size += val.nbytes
+            elif isinstance(val, (bytes, str)):
+                size += len(val)
+            elif isinstance(val, (list, tuple)):
+                size += sum(len(v) if isinstance(v, (bytes, str)) else 8 for v in val)
+            else:
+                size += 8
+        return size
+
+
+class PendingWrites:
+    """ Writes to a single stream waiting to be sent by a WriteQueue """
+    def __init__(self):
+        self.items = []  # data dicts in the order they were written
+        self.sizes = []  # approximate size of each item in bytes
+        self.size = 0  # total size in bytes
+        self.since = time.time()  # time the oldest item was added
+
+    def add(self, data, size):
+        if not self.items:
+            self.since = time.time()
+        self.items.append(data)
+        self.sizes.append(size)
+        self.size += size
+
+    def drop(self):
+        """ Removes the oldest item """
+        self.items.pop(0)
+        self.size -= self.sizes.pop(0)
+
+    def joined(self):
+        """
+        Returns the items as a list of as few data dicts as possible,
+            by joining consecutive items that have the same columns.
+        Single data points are joined as lists of one point each.
+        """
+        output = []
+        for data in self.items:
+            if output and output[-1].keys() == data.keys():
+                last = output[-1]
+                for key, val in data.items():
+                    last[key].append(val)
+            else:
+                output.append({key: [val] for key, val in data.items()})
+
+        # each column is now a list of the columns (or single values) of each item
+        for data in output:
+            for key, parts in data.items():
+                if len(parts) == 1 and isinstance(parts[0], np.ndarray):  # nothing to join - don't copy
+                    data[key] = parts[0]
+                elif all(isinstance(part, np.ndarray) for part in parts):
+                    data[key] = np.concatenate(parts)
+                else:
+                    data[key] = [v for part in parts for v in (part if isinstance(part, (list, tuple, np.ndarray)) else [part])]
+        return output
+
 
 class Analyzer(Streamer):
     """
@@ -651,11 +1000,71 @@ class Analyzer(Streamer):
         # add namespace unique to analyzers
         self.namespaces.append('/analyzers')
 
+        # name of this replica in the consumer group shared by all replicas (see replicas())
+        self.consumer = None
+
+    @property
+    def pipe_id(self):
+        """ Replicas share an ID, so their pipes are indexed by consumer name """
+        return self.consumer or self.id
+
+    def replicas(self, n, factory=None):
+        """
+        Returns <n> copies of this analyzer that share its work, to be run as separate workers.
+        All replicas have the same ID, so they write to the same streams and appear as a single analyzer.
+        They read their targets as consumers of a redis consumer group (see Database.use_group()),
+            so each new entry of a target is processed by only one of them.
+        Entries are acknowledged after each successful loop, so the entries of a replica that crashes
+            are picked up by the other replicas. The group is named after this analyzer's ID, which is new
+            on every run of the client, so nothing is recovered after the client itself restarts.
+        Only suitable for analyzers that don't carry state from one read to the next (like a filter's initial conditions).
+        The entries the replicas write get IDs from the redis clock in the order they are written,
+            rather than from the time of their data (see Database.use_group() for what that affects),
+            so only use replicas for outputs where that offset is acceptable.
+        <factory> function returning a new analyzer configured like this one, called to make each replica.
+            If not given, each replica is a copy of this analyzer (see _replica()).
+        """
+        copies = []
+        for i in range(n):
+            replica = factory() if factory else self._replica()
+            replica.namespaces = [ns.replace('/'+replica.id, '/'+self.id) for ns in replica.namespaces]
+            replica.id = self.id
+            replica.consumer = '{}:{}'.format(self.id, i)
+            copies.append(replica)
+        return copies
+
+    def _replica(self):
+        """
+        Returns a copy of this analyzer with all of its attributes deep copied (targets, options, widgets, etc.),
+            apart from its socket and events, which are new so that the copy can run as a separate worker.
+        Raises TypeError if an attribute can't be copied (e.g. a thread), in which case a factory should be
+            given to replicas() instead.
+        """
+        replica = self.__class__.__new__(self.__class__)
+        Analyzer.__init__(replica, self.name, self.group)  # new socket and events, whatever the arguments of the subclass
+        for key, value in vars(self).items():
+            if key in ('socket', 'streaming', 'looking', 'exit_condition', 'shutdown_condition'):
+                continue
+            try:
+                setattr(replica, key, deepcopy(value))
+            except (TypeError, RuntimeError) as e:  # threads, locks, etc.
+                raise TypeError("Can't copy '{}' of [{}] for its replicas - pass a factory to replicas(). {}: {}".format(
+                    key, self, e.__class__.__name__, e))
+        return replica
+
     def init(self):
         """ Extend init to look for the target stream """
         super().init()
+        if self.consumer:  # running as one of a set of replicas
+            self.database.use_group(self.id, self.consumer)
         self.get_target()  # check for target stream
 
+    def _loop(self):
+        """ Acknowledges entries read through the consumer group once the loop has processed them """
+        super()._loop()
+        if self.consumer:
+            self.database.ack()
+
     def target(self, name, group=None):
         """ Add a streamer to target with this analyzer """
         if group is None:  # same as own group
@@ -730,6 +1139,20 @@ class Analyzer(Streamer):
                     if info.get('id'):
                         self.debug("Targeting [{}:{}]".format(group_name, stream_name))
 
+    def wait_for_data(self, *streams, timeout=1):
+        """
+        Parks the loop until any of the given stream IDs has new data, or <timeout> seconds pass.
+        Meant to be called from loop() when a read returns nothing, so that the analyzer wakes up
+            as soon as its target writes instead of after a fixed sleep, and uses no CPU while idle.
+        Returns the list of streams with new data.
+        """
+        try:
+            return self.database.wait(streams, timeout)
+        except DatabaseError as e:
+            self.debug("Failed to wait for new data: {}: {}".format(e.__class__.__name__, e), 3)
+            time.sleep(timeout)  # don't spin while the database is unreachable
+            return []
+
     def _start(self):
         """ Checks for any target streams before running """
         groups = self.targets.values()
@@ -744,6 +1167,62 @@ class Analyzer(Streamer):
             self.debug("Not started - did not find any target streams.".format(self))
 
 
+class Pipeline(WorkerNode):
+    """
+    Runs a set of analyzers that feed each other (like a filter and a fourier transform of its output)
+        together as a single worker, instead of as a process each.
+    Streams written by one stage and read by another are passed in memory as numpy arrays (see StreamHandoff),
+        so they aren't serialized, written to the database and read back again between stages.
+    Streams are only written to the database while they are displayed on a page,
+        unless their stage is one of <durable> (see PipelineDatabase).
+    The stages run as the tasks of an AsyncClient in the pipeline's process, so each keeps its own loop, info and widgets.
+    <stages> list of Analyzers, which target each other by group and name as usual.
+    <durable> list of stages whose streams are always written to the database (e.g. to be saved with the session).
+    <keep> time (s) of each stream passed between stages kept in memory.
+    """
+    def __init__(self, stages, durable=(), keep=30):
+        super().__init__()
+        self.stages = stages
+        self.durable = [stage.id for stage in durable]
+        self.keep = keep
+        self.name = "Pipeline[{}]".format(', '.join(str(stage) for stage in stages))
+        self.runtime = None  # AsyncClient running the stages. Created in set_info().
+
+    def set_info(self, parent):
+        """ Takes the parameters of the parent Client for the runtime of the stages """
+        self.runtime = AsyncClient(self.stages, parent.name, parent.ip, parent.port, parent.db_port, parent.db_pass,
+                                   debug=Base.debug_level)
+
+    def handoff_streams(self):
+        """ IDs of the stages whose output is read by another stage """
+        producers = {(stage.group, stage.name): stage.id for stage in self.stages}
+        return {producers[(group, name)]
+                for stage in self.stages for group, names in stage.targets.items()
+                for name in names if (group, name) in producers}
+
+    def run(self, pipe):
+        """
+        Main entry point. Runs all stages until they exit or the host signals to shut down.
+        Should be run on it's own Process's Main Thread.
+        """
+        self.pipe = pipe
+        handoff = StreamHandoff(self.handoff_streams(), self.keep)
+        for stage in self.stages:
+            stage.db_class = PipelineDatabase
+            stage.db_options.update(handoff=handoff, durable=self.durable)
+
+        self.debug("{} initialized".format(self), 2)
+        Thread(target=self._run_pipe, name='PIPE', daemon=True).start()
+        self.runtime.run()  # blocks until all stages have exited
+        self.pipe.send('SHUTDOWN')  # Signal to the host that this worker has shut down
+
+    def halt(self):
+        """ Extends halt() to stop all stages """
+        super().halt()
+        if self.runtime:
+            self.runtime.halt()
+
+
 class Namespace(socketio.ClientNamespace):
     """ All methods must begin with prefix "on_" followed by socketIO message name"""
     def __init__(self, streamer, *args, **kwargs):
@@ -774,4 +1253,47 @@ class Namespace(socketio.ClientNamespace):
         self.streamer._stop()
 
     def on_json(self, dic):
-        self.streamer.json(dic)
\ No newline at end of file
+        self.streamer.json(dic)
+
+
+class SharedNamespace(socketio.ClientNamespace):
+    """
+    Namespace of a socketIO connection shared by several streamers (see AsyncClient).
+    Messages are passed on to each of them on the thread pool of the AsyncClient,
+        so that a slow handler (like starting a camera) doesn't hold up the connection.
+    """
+    def __init__(self, streamers, executor, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.streamers = streamers
+        self.executor = executor
+
+    def dispatch(self, method, *args):
+        """ Calls <method> of each streamer on the thread pool """
+        for streamer in self.streamers:
+            self.executor.submit(getattr(streamer, method), *args)
+
+    def on_connect(self):
+        for streamer in self.streamers:
+            self.emit('log', '{} connected to server'.format(streamer))
+
+    def on_disconnect(self):
+        pass
+
+    def on_update(self):
+        """ Update message from server """
+        self.dispatch('update')
+
+    def on_check_database(self, stream_id):
+        """ Used to notify analyzers that a new stream has been initialized on the database """
+        self.dispatch('get_target', stream_id)
+
+    def on_start(self):
+        """ start message from server """
+        self.dispatch('_start')
+
+    def on_stop(self):
+        """ stop message from server """
+        self.dispatch('_stop')
+
+    def on_json(self, dic):
+        self.dispatch('json', dic)
@@ -1,7 +1,20 @@
-from threading import Condition
+from threading import Condition, Lock, Event, Thread
 from io import BytesIO
+from collections import deque
 import subprocess
 import os
+import mmap
+import pickle
+import struct
+import zlib
+import time
+
+import numpy as np
+
+from lib.database import Database, DatabaseError, DatabaseConnectionError, DatabaseTimeoutError, DatabaseBusyLoadingError
+
+# directory of the EdgeBuffers of all streamers on this device
+BUFFER_DIR = os.path.join(os.path.expanduser('~'), '.osprey', 'buffer')
 
 
 def configure_port(dev_path):
@@ -76,3 +89,566 @@ class BytesOutput2(BytesIO):
             return data
 
 
+class FrameBuffer:
+    """
+    Output for the H.264 encoder of a PiCamera which splits the encoded data into frames (access units).
+    Data is written into a preallocated bytearray ring and scanned for NAL unit start codes.
+        A new frame begins at the first AUD, SEI, SPS, PPS or first slice of a picture after the slices of the last one.
+    Frames are tagged as keyframes (IDR slices) and as carrying headers (SPS/PPS),
+        and are returned by read() as memoryview slices of the ring without copying.
+    The reader is only woken up once a complete frame, or with <gop> a complete group of pictures, is ready.
+    If the reader falls so far behind that the ring is full, frames are dropped until the next keyframe.
+    <capacity> size of the ring in bytes. Should hold a few GOPs.
+    <gop> whether read() waits for whole GOPs (all frames before the next keyframe) rather than single frames.
+    """
+    VCL = {1, 5}  # NAL unit types of coded slices
+    FRAME_START = {6, 7, 8, 9}  # NAL unit types which begin a new frame when they follow a slice (SEI, SPS, PPS, AUD)
+
+    def __init__(self, capacity=4*2**20, gop=False):
+        self.buffer = bytearray(capacity)
+        self.view = memoryview(self.buffer)
+        self.capacity = capacity
+        self.gop = gop
+        self.ready = Condition()  # lock for reading/writing frames
+
+        self.frames = deque()  # complete frames not yet read: (start, end, time, keyframe, headers)
+        self.waiting = 0  # number of frames at the front of self.frames which read() returns
+        self.held = None  # start of the frames returned by the last read(), which must not be overwritten yet
+        self.start = 0  # start of the current incomplete frame
+        self.end = 0  # end of the data written so far
+        self.scan = 0  # position to continue searching for start codes from
+        self.nal_types = set()  # NAL unit types in the current frame
+        self.time = None  # time the first data of the current frame was written
+        self.junk = False  # whether the current frame lost data because the ring was full
+        self.skip = False  # whether frames are being dropped until the next keyframe
+        self.dropped = 0  # number of frames dropped
+        self.closed = False
+
+    def write(self, data):
+        """ Called by the encoder with the next chunk of encoded data """
+        count = len(data)
+        with self.ready:
+            if self.closed:
+                return count
+            if self.time is None:
+                self.time = time.time()
+
+            if not self._reserve(count):  # drop the current frame and everything until the next keyframe
+                if not self.junk:
+                    self.dropped += 1
+                self.end = self.scan = self.start
+                self.nal_types = set()
+                self.junk = self.skip = True
+                return count
+
+            self.buffer[self.end:self.end+count] = data
+            self.end += count
+            self._split()
+            return count
+
+    def read(self, timeout=None):
+        """
+        Blocking operation to read the frames which are ready.
+        Returns a list of (data, time, keyframe, headers) tuples, or an empty list after <timeout> seconds.
+            <data> is a memoryview of the ring, only valid until the next call to read().
+        """
+        with self.ready:
+            self.held = None  # the frames returned last time are no longer used
+            self.ready.wait_for(lambda: self.waiting or self.closed, timeout)
+            frames = [self.frames.popleft() for _ in range(self.waiting)]
+            self.waiting = 0
+            if frames:
+                self.held = frames[0][0]
+            return [(self.view[start:end], t, keyframe, headers) for start, end, t, keyframe, headers in frames]
+
+    def flush(self):
+        """ Called by the encoder when recording stops. Completes the current frame. """
+        with self.ready:
+            if self.nal_types & self.VCL:
+                self._complete(self.end)
+            self.waiting = len(self.frames)
+            if self.waiting:
+                self.ready.notify_all()
+
+    def close(self):
+        """ Wakes up any waiting read() """
+        with self.ready:
+            self.closed = True
+            self.ready.notify_all()
+
+    def _tail(self):
+        """ Oldest position in the ring which is still in use """
+        if self.held is not None:
+            return self.held
+        if self.frames:
+            return self.frames[0][0]
+        return self.start
+
+    def _reserve(self, count):
+        """ Makes room to write <count> bytes at self.end, moving the current frame to the start of the ring if needed """
+        tail = self._tail()
+        if tail > self.start:  # the data in use wraps around the end of the ring
+            return self.end + count <= tail
+        if self.end + count <= self.capacity:
+            return True
+
+        size = self.end - self.start
+        if size + count > (self.capacity if tail == self.start else tail):
+            return False
+        self.buffer[:size] = self.buffer[self.start:self.end]  # slicing copies first, so this may overlap
+        self.scan -= self.start
+        self.start, self.end = 0, size
+        return True
+
+    def _split(self):
+        """ Searches the newly written data for NAL units which begin a new frame """
+        buf = self.buffer
+        pos = max(self.scan, self.start)
+        while True:
+            i = buf.find(b'\x00\x00\x01', pos, self.end)
+            if i < 0:
+                self.scan = max(self.end - 2, self.start)  # a start code may be split between two writes
+                return
+            if i + 5 > self.end:  # NAL header not written yet
+                self.scan = i
+                return
+
+            nal_type = buf[i+3] & 0x1F
+            if self.nal_types & self.VCL or self.junk:  # could be the start of the next frame
+                if nal_type in self.FRAME_START or (nal_type in self.VCL and buf[i+4] & 0x80):  # first_mb_in_slice == 0
+                    self._complete(i-1 if i > self.start and buf[i-1] == 0 else i)  # including the zero of a 4 byte start code
+            self.nal_types.add(nal_type)
+            pos = i + 3
+
+    def _complete(self, boundary):
+        """ Ends the current frame at <boundary> and queues it, unless it is being dropped """
+        start, types, t = self.start, self.nal_types, self.time
+        self.start, self.nal_types, self.time = boundary, set(), time.time()
+
+        if self.junk:  # lost some of its data
+            self.junk = False
+            return
+        keyframe = 5 in types
+        if self.skip and not keyframe:
+            self.dropped += 1
+            return
+        self.skip = False
+
+        self.frames.append((start, boundary, t, keyframe, bool(types & {7, 8})))
+        if not self.gop:
+            self.waiting = len(self.frames)
+        elif keyframe:  # the frames before this one make up complete GOPs
+            self.waiting = len(self.frames) - 1
+        if self.waiting:
+            self.ready.notify_all()
+
+
+class AudioRingBuffer:
+    """
+    Preallocated ring buffer of audio samples between a PortAudio callback and an encoder feeder thread.
+    Lock-free for a single writer and a single reader: the writer only ever moves self.written,
+        and the reader only ever moves self.read, each after the samples have been copied,
+        so the callback never waits on the reader.
+    If a block doesn't fit, the part that doesn't fit is dropped and counted, rather than blocking the callback.
+    <capacity> number of samples (of all channels) the buffer can hold.
+    """
+    def __init__(self, capacity, dtype='float32'):
+        self.buffer = np.zeros(capacity, dtype=dtype)
+        self.capacity = capacity
+        self.written = 0  # total number of samples written
+        self.read = 0  # total number of samples read
+
+        # overflow counters
+        self.overflows = 0  # number of blocks that didn't fit completely
+        self.dropped = 0  # number of samples dropped
+
+    def available(self):
+        """ Number of samples waiting to be read """
+        return self.written - self.read
+
+    def write(self, block):
+        """ Copies the samples of <block> into the buffer. Called from the audio callback. """
+        block = block.reshape(-1)
+        n = len(block)
+        free = self.capacity - (self.written - self.read)
+        if n > free:
+            self.overflows += 1
+            self.dropped += n - free
+            n = free
+
+        start = self.written % self.capacity
+        first = min(n, self.capacity - start)
+        self.buffer[start:start+first] = block[:first]
+        self.buffer[:n-first] = block[first:n]
+        self.written += n  # publish only once the samples are there
+
+    def peek(self):
+        """
+        Returns the waiting samples as a list of up to two views on the buffer (in case they wrap around),
+            without copying. Call consume() with their total length once they have been used.
+        """
+        n = self.available()
+        start = self.read % self.capacity
+        first = min(n, self.capacity - start)
+        views = [self.buffer[start:start+first]]
+        if n > first:
+            views.append(self.buffer[:n-first])
+        return views
+
+    def consume(self, n):
+        """ Frees <n> samples that were read with peek() """
+        self.read += n
+
+    def clear(self):
+        """ Drops all waiting samples and resets the counters. Only when neither side is running. """
+        self.written = self.read = 0
+        self.overflows = self.dropped = 0
+
+
+def buffer_path(group, name):
+    """ Directory of the EdgeBuffer of the streamer <name> in <group>. Kept across restarts of the client. """
+    safe = ''.join(c if c.isalnum() or c in '-_' else '_' for c in '{}-{}'.format(group, name))
+    return os.path.join(BUFFER_DIR, safe)
+
+
+class EdgeBuffer:
+    """
+    Persistent FIFO of records, stored in memory-mapped segment files in directory <path>.
+    Used by BufferedDatabase to keep data produced while the database can't be reached.
+    Records are appended to the newest segment, and segments are deleted once all of their records
+        have been consumed. The read position is saved in a cursor file, so records that were not consumed
+        are still there after a restart.
+    If the segments take up more than <budget> bytes, the oldest segment is dropped to make room.
+    Each record is a 4-byte length and a 4-byte crc32 followed by the pickled object.
+    <segment_size> size of each segment file in bytes. Larger records get a segment of their own.
+    """
+    def __init__(self, path, budget=256*2**20, segment_size=4*2**20):
+        self.path = path
+        self.budget = budget
+        self.segment_size = segment_size
+        self.lock = Lock()
+        self.dropped = 0  # number of segments dropped because of the budget
+
+        os.makedirs(path, exist_ok=True)
+        self.segments = sorted(int(f[:-4]) for f in os.listdir(path) if f.endswith('.seg'))
+        self.read_pos = self._load_cursor()  # (segment, offset) of the next record to read
+
+        # memory map of the newest segment, and the offset to append at
+        self.map = None
+        self.write_seg = None
+        self.write_pos = 0
+        if self.segments:
+            self._open(self.segments[-1])
+            self.write_pos = self._scan_end()
+
+    def empty(self):
+        """ Whether there are no unconsumed records """
+        with self.lock:
+            return not self.segments or (self.read_pos == (self.write_seg, self.write_pos))
+
+    def size(self):
+        """ Total size of all segment files in bytes """
+        with self.lock:
+            return sum(self._file_size(seg) for seg in self.segments)
+
+    def append(self, obj):
+        """ Adds <obj> to the end of the buffer """
+        payload = pickle.dumps(obj, protocol=pickle.HIGHEST_PROTOCOL)
+        record = struct.pack('<II', len(payload), zlib.crc32(payload)) + payload
+        with self.lock:
+            if self.map is None or self.write_pos + len(record) > len(self.map):
+                self._new_segment(max(self.segment_size, len(record) + 8))
+            self.map[self.write_pos:self.write_pos+len(record)] = record
+            self.write_pos += len(record)
+            self._enforce_budget()
+
+    def peek(self, max_bytes):
+        """
+        Returns a list of (position, obj) of the oldest unconsumed records, up to about <max_bytes> in total
+            (at least one record if there is any). <position> is passed to consume() once the record is used.
+        Stops at the end of the oldest segment.
+        """
+        with self.lock:
+            while True:
+                seg, offset = self.read_pos
+                if seg is None or seg not in self.segments:
+                    return []
+                data = self.map if seg == self.write_seg else self._read_segment(seg)
+                end = self.write_pos if seg == self.write_seg else len(data)
+                records, total = [], 0
+                while offset + 8 <= end and (not records or total < max_bytes):
+                    length, crc = struct.unpack_from('<II', data, offset)
+                    if length == 0 or offset + 8 + length > end:  # end of the records in this segment
+                        break
+                    payload = bytes(data[offset+8:offset+8+length])
+                    if zlib.crc32(payload) != crc:  # partly written when the process stopped
+                        break
+                    offset += 8 + length
+                    total += length
+                    records.append(((seg, offset), pickle.loads(payload)))
+
+                if records or seg == self.write_seg:
+                    return records
+                self._advance(seg)  # nothing more in this older segment - move on to the next
+
+    def consume(self, position):
+        """ Marks all records up to <position> (given by peek()) as used, and deletes finished segments """
+        with self.lock:
+            self.read_pos = position
+            self._save_cursor()
+
+    def _advance(self, seg):
+        """ Deletes segment <seg> and moves the read position to the start of the next one """
+        i = self.segments.index(seg)
+        self._delete(seg)
+        self.read_pos = (self.segments[i], 0) if i < len(self.segments) else (None, 0)
+        self._save_cursor()
+
+    def _new_segment(self, size):
+        """ Creates and opens a new segment file of <size> bytes for writing """
+        seg = self.segments[-1] + 1 if self.segments else 0
+        with open(self._file(seg), 'wb') as f:
+            f.truncate(size)
+        self.segments.append(seg)
+        if self.map is not None:
+            self.map.flush()
+            self.map.close()
+        self._open(seg)
+        self.write_pos = 0
+        if self.read_pos[0] is None:  # everything before was consumed
+            self.read_pos = (seg, 0)
+
+    def _open(self, seg):
+        """ Memory-maps segment <seg> for writing """
+        with open(self._file(seg), 'r+b') as f:
+            self.map = mmap.mmap(f.fileno(), 0)
+        self.write_seg = seg
+
+    def _scan_end(self):
+        """ Finds the end of the valid records in the open segment (after a restart) """
+        offset = 0
+        while offset + 8 <= len(self.map):
+            length, crc = struct.unpack_from('<II', self.map, offset)
+            if length == 0 or offset + 8 + length > len(self.map):
+                break
+            if zlib.crc32(self.map[offset+8:offset+8+length]) != crc:
+                break
+            offset += 8 + length
+        return offset
+
+    def _read_segment(self, seg):
+        """ Returns the contents of an older segment, which is no longer written to """
+        with open(self._file(seg), 'rb') as f:
+            return f.read()
+
+    def _enforce_budget(self):
+        """ Drops the oldest segments while all segments take up more than the budget """
+        while len(self.segments) > 1 and sum(self._file_size(seg) for seg in self.segments) > self.budget:
+            oldest = self.segments[0]
+            if self.read_pos[0] == oldest:
+                self._advance(oldest)
+            else:
+                self._delete(oldest)
+            self.dropped += 1
+            print("Edge buffer {} is over its budget of {} bytes - dropped the oldest segment".format(self.path, self.budget))
+
+    def _delete(self, seg):
+        """ Removes segment <seg> """
+        self.segments.remove(seg)
+        try:
+            os.remove(self._file(seg))
+        except OSError:
+            pass
+
+    def _load_cursor(self):
+        """ Reads the saved read position, or starts at the oldest segment """
+        try:
+            with open(os.path.join(self.path, 'cursor'), 'r') as f:
+                seg, offset = (int(val) for val in f.read().split())
+            if seg in self.segments:
+                return seg, offset
+        except (OSError, ValueError):
+            pass
+        return (self.segments[0] if self.segments else None), 0
+
+    def _save_cursor(self):
+        """ Saves the read position, and deletes segments before it """
+        seg, offset = self.read_pos
+        for old in [s for s in self.segments if seg is not None and s < seg]:
+            self._delete(old)
+        with open(os.path.join(self.path, 'cursor'), 'w') as f:
+            f.write('{} {}'.format(seg if seg is not None else -1, offset))
+
+    def _file(self, seg):
+        return os.path.join(self.path, '{:012d}.seg'.format(seg))
+
+    def _file_size(self, seg):
+        try:
+            return os.path.getsize(self._file(seg))
+        except OSError:
+            return 0
+
+
+class BufferedDatabase(Database):
+    """
+    Database connection for streamers on a device that may lose its connection to the server.
+    Writes that can't reach the database are kept in an EdgeBuffer on disk instead of raising an error,
+        so the streamer keeps acquiring data through network outages (and restarts of the client).
+    A background thread drains the backlog once the database is reachable again,
+        in batches of up to <batch_bytes>, and at no more than <drain_rate> bytes/s
+        so as not to swamp the live server.
+    While there is a backlog, new writes are added to the end of it to keep each stream in order.
+    Draining is idempotent: each batch is written in a single transaction, and if the connection
+        is lost before the result is known, the newest ID of the stream tells whether it was written.
+    <buffer_path> directory of the EdgeBuffer (see buffer_path())
+    <budget> maximum size of the EdgeBuffer in bytes. The oldest data is dropped beyond that.
+    Other keyword options are passed to Database.
+    """
+    def __init__(self, ip, port, password, buffer_path, budget=256*2**20, drain_rate=2**20, batch_bytes=2**20, **options):
+        super().__init__(ip, port, password, **options)
+        self.buffer = EdgeBuffer(buffer_path, budget)
+        self.drain_rate = drain_rate  # maximum bytes/s written from the buffer
+        self.batch_bytes = batch_bytes  # maximum bytes written from the buffer at once
+        self.write_lock = Lock()  # serializes direct writes with draining
+        self.uncertain = None  # (stream, bookmark state, position) of a write that failed without knowing if it was applied
+        self.backlog = Event()  # set when there is data in the buffer
+        if not self.buffer.empty():  # left over from before a restart
+            self.backlog.set()
+        Thread(target=self._drain, name='EdgeBuffer-drain', daemon=True).start()
+
+    def write_data(self, stream, data, chunked=None, channels=None, time_row=None, time_scale=1):
+        """ Extends write_data() to buffer the data if the database can't be reached """
+        if isinstance(data, np.ndarray):
+            data = self.array_columns(data, channels, time_row, time_scale)
+        self._write('data', stream, data, chunked)
+
+    def write_batch(self, batches):
+        """ Extends write_batch() to buffer the data if the database can't be reached. Writes each batch on its own. """
+        for stream, data in batches:
+            self._write('data', stream, data, None)
+
+    def write_snapshot(self, stream, data, static=()):
+        """ Extends write_snapshot() to buffer the snapshot if the database can't be reached """
+        self._write('snapshot', stream, data, static)
+
+    def _write(self, kind, stream, data, option):
+        """ Writes directly if there's no backlog, otherwise adds to the end of it """
+        with self.write_lock:
+            if self.backlog.is_set():
+                self.buffer.append((kind, stream, data, option))
+                return
+            state = self._state(stream)
+            try:
+                self._apply(kind, stream, data, option)
+            except (DatabaseConnectionError, DatabaseTimeoutError, DatabaseBusyLoadingError) as e:
+                print("Database unreachable - buffering data of {}. {}: {}".format(stream, e.__class__.__name__, e))
+                self.uncertain = (stream, state, None)  # it's the first record of the buffer
+                self.buffer.append((kind, stream, data, option))
+                self.backlog.set()
+
+    def _state(self, stream):
+        """ Returns the (millisecond, sequence number) of the last ID written to <stream> """
+        bookmark = self.bookmarks.get(stream)
+        return bookmark.write, bookmark.seq
+
+    def _apply(self, kind, stream, data, option):
+        """
+        Writes a single record to the database.
+        If the write fails, the stream's bookmark is restored so that it gives the same IDs when retried.
+        """
+        bookmark = self.bookmarks.get(stream)
+        state = (bookmark.write, bookmark.seq)
+        try:
+            if kind == 'data':
+                super().write_data(stream, data, option)
+            else:
+                super().write_snapshot(stream, data, option)
+        except Exception:
+            bookmark.write, bookmark.seq = state
+            bookmark.rollup = None  # partial buckets were already fed this data
+            raise
+
+    def _applied(self, stream, state):
+        """
+        Checks whether a write to <stream> that started from bookmark <state> was applied, judging by the
+            stream's newest ID. If so, the bookmark continues from that ID.
+        """
+        last_id = self.last_id(stream)
+        if not last_id:
+            return False
+        ms, _, seq = self.decode(last_id).partition('-')
+        last = (int(ms), int(seq or 0))
+        if state[0] is not None and last <= (state[0], state[1] or 0):  # nothing newer than before the write
+            return False
+        bookmark = self.bookmarks.get(stream)
+        bookmark.write, bookmark.seq = last
+        return True
+
+    def _drain(self):
+        """ Background thread writing the backlog to the database """
+        while not self.exit:
+            self.backlog.wait()
+            with self.write_lock:
+                records = self.buffer.peek(self.batch_bytes)
+                if not records:
+                    self.backlog.clear()
+                    continue
+            try:
+                if self.uncertain:  # the last write may have been applied before the connection was lost
+                    stream, state, position = self.uncertain
+                    if self._applied(stream, state):
+                        with self.write_lock:
+                            self.buffer.consume(position or records[0][0])
+                    self.uncertain = None
+                    continue  # read the buffer again from there
+                written = self._drain_batch(records)
+            except (DatabaseConnectionError, DatabaseTimeoutError, DatabaseBusyLoadingError):
+                time.sleep(5)  # still unreachable
+                continue
+            time.sleep(written / self.drain_rate)  # throttle
+
+    def _drain_batch(self, records):
+        """
+        Writes a batch of records from the buffer, joining consecutive data records of the same stream.
+        Each joined record is written in a single transaction, and only consumed from the buffer once it is.
+        Returns the approximate number of bytes written.
+        """
+        written = 0
+        for position, (kind, stream, data, option) in self._join(records):
+            with self.write_lock:
+                state = self._state(stream)
+                try:
+                    self._apply(kind, stream, data, option)
+                except (DatabaseConnectionError, DatabaseTimeoutError, DatabaseBusyLoadingError):
+                    self.uncertain = (stream, state, position)
+                    raise
+                except DatabaseError as e:  # can never be written - don't hold up the rest of the backlog
+                    print("Dropped buffered data of {} that could not be written. {}: {}".format(stream, e.__class__.__name__, e))
+                self.buffer.consume(position)
+            written += sum(np.asarray(val).nbytes if self.valid_list(val) else 8 for val in data.values())
+        return written
+
+    def _join(self, records):
+        """
+        Joins consecutive data records of the same stream with the same columns into larger batches.
+        Yields (position, record) with the position of the last record joined.
+        """
+        current, position = None, None
+        for pos, record in records:
+            kind, stream, data, option = record
+            if (current and kind == 'data' == current[0] and stream == current[1] and option == current[3]
+                    and data.keys() == current[2].keys() and all(self.valid_list(val) for val in data.values())):
+                current[2] = {key: self._concat(current[2][key], val) for key, val in data.items()}
+            else:
+                if current:
+                    yield position, tuple(current)
+                current = [kind, stream, dict(data), option]
+            position = pos
+        if current:
+            yield position, tuple(current)
+
+    def _concat(self, a, b):
+        """ Joins two columns of a batch """
+        if isinstance(a, np.ndarray) or isinstance(b, np.ndarray):
+            return np.concatenate([np.asarray(a), np.asarray(b)])
+        return list(a) + list(b)
@@ -1,7 +1,8 @@
 from lib.lib import Base, Streamer
-from lib.raspi.pi_lib import configure_port, BytesOutput, BytesOutput2
+from lib.raspi.pi_lib import configure_port, FrameBuffer, BufferedDatabase, buffer_path, AudioRingBuffer
 
 from random import random
+from threading import Thread, Event
 from time import time, sleep
 from os import environ
 import numpy as np
@@ -29,7 +30,7 @@ class TestStreamer(Streamer):
             data['val_3'].append(self.val_3)
             sleep(0.05)
 
-        self.database.write_data(self.id, data)
+        self.write(self.id, data)
 
     def start(self):
         self.val_1 = 0
@@ -40,6 +41,8 @@ class TestStreamer(Streamer):
 class SenseStreamer(Streamer):
     def __init__(self, *args):
         super().__init__(*args)
+        self.db_class = BufferedDatabase  # keep acquiring through network outages
+        self.db_options['buffer_path'] = buffer_path(self.group, self.name)
         try:
             from sense_hat import SenseHat
             self.sense = SenseHat()  # sense hat object
@@ -63,7 +66,7 @@ class SenseStreamer(Streamer):
             data['time'].append(time()*1000)
             sleep(0.1)
 
-        self.database.write_data(self.id, data)
+        self.write(self.id, data)
 
         # get joystick data
         data = {'time': [], 'button': [], 'color': []}
@@ -73,7 +76,7 @@ class SenseStreamer(Streamer):
                 data['button'].append(event.direction)
                 data['color'].append(self.color_map[event.direction])
 
-        self.database.write_data('button:'+self.id, data)
+        self.write('button:'+self.id, data)
         sleep(0.1)
 
     def start(self):
@@ -137,24 +140,28 @@ class LogStreamer(Streamer):
 class VideoStreamer(Streamer):
     def __init__(self, *args):
         super().__init__(*args)
+        self.db_class = BufferedDatabase  # keep acquiring through network outages
+        self.db_options['buffer_path'] = buffer_path(self.group, self.name)
         self.start_time = 0           # time of START
 
-        self.picam_buffer = BytesOutput()  # buffer to hold images from the Picam
+        self.picam_buffer = FrameBuffer()  # buffer to split the output of the Picam into frames
 
     def loop(self):
         """
         Main execution loop
         """
-        if not self.camera.frame.complete or self.camera.frame.frame_type == self.sps:
+        frames = self.picam_buffer.read(timeout=1)  # wait for complete frames
+        if not frames:
             return
-        images = self.picam_buffer.read()  # get most recent frames
 
+        # one entry for each frame
         data = {
-            'time': time()*1000,
-            'frame': images
+            'time': [t*1000 for _, t, _, _ in frames],
+            'frame': [bytes(frame) for frame, _, _, _ in frames],  # the views are reused by the next read
+            'keyframe': [int(keyframe) for _, _, keyframe, _ in frames],
         }
 
-        self.database.write_data(self.id, data)
+        self.write(self.id, data)
 
     def start(self):
         """
@@ -163,10 +170,9 @@ class VideoStreamer(Streamer):
         Extended from base class in pi_lib.py
         """
         # for some reason if the PiCamera object is defined on a different thread, start_recording will hang.
-        from picamera import PiCamera, PiVideoFrameType
+        from picamera import PiCamera
         self.camera = PiCamera(resolution='400x400', framerate=20)
         self.camera.rotation = 180
-        self.sps = PiVideoFrameType.sps_header
 
         # info to send to database
         self.info['framerate'] = self.camera.framerate[0]
@@ -174,6 +180,7 @@ class VideoStreamer(Streamer):
         self.info['height'] = self.camera.resolution.height
 
         # start recording
+        self.picam_buffer = FrameBuffer()
         self.camera.start_recording(self.picam_buffer,
             format='h264', quality=25, profile='constrained', level='4.2',
             intra_period=self.info['framerate'], intra_refresh='both', inline_headers=True, sps_timing=True
@@ -190,11 +197,14 @@ class VideoStreamer(Streamer):
             self.camera.close()  # close camera resources
         except:
             pass
+        self.picam_buffer.close()  # wake up the main loop
 
 
 class AudioStreamer(Streamer):
     def __init__(self, *args):
         super().__init__(*args)
+        self.db_class = BufferedDatabase  # keep acquiring through network outages
+        self.db_options['buffer_path'] = buffer_path(self.group, self.name)
 
         try:
             # unset the DISPLAY environment variable so that PortAudio doesn't try to
@@ -204,10 +214,16 @@ class AudioStreamer(Streamer):
             pass
 
         self.sample_rate = 8000
-        self.blocksize = 1000
+        self.blocksize = 256  # small blocks for low latency - the callback only copies them into the ring buffer
         self.stream = None  # SoundDevice Stream object created in start() and closed in stop()
         self.last_block_time = None  # timestamp of last recorded audio block
 
+        # samples are passed from the audio callback to the encoder through a ring buffer of 2 seconds
+        self.ring = AudioRingBuffer(2*self.sample_rate)
+        self.feeder = None  # encoder feeder thread of the current run
+        self.feeding = None  # Event of the current run, set to stop its feeder thread
+        self.input_overflows = 0  # number of times PortAudio reported an input overflow or underflow
+
         import ffmpeg
 
         self.ffmpeg_process = (
@@ -233,7 +249,7 @@ class AudioStreamer(Streamer):
             'time': time() * 1000,
             'data': audio_data,
         }
-        self.database.write_data(self.id, data)
+        self.write(self.id, data)
         sleep(0.01)
 
     def start(self):
@@ -254,11 +270,22 @@ class AudioStreamer(Streamer):
             # temporary - just to make timestamp array same size as data array
             # t = [abs_time] * frames
             if status.input_overflow or status.input_underflow:
-                print('overflow:', status.input_overflow, 'underflow:', status.input_underflow)
-            self.ffmpeg_process.stdin.write(indata)  # write data to ffmpeg process
+                self.input_overflows += 1
+            self.ring.write(indata)  # only copy - the feeder thread writes to ffmpeg
+
+        # the ring buffer has a single reader - wait for the feeder of the last run to write what is left and exit
+        if self.feeder:
+            self.feeding.set()
+            self.feeder.join()
+
+        # start the encoder feeder before any samples arrive
+        self.ring.clear()
+        self.feeding = Event()
+        self.feeder = Thread(target=self.feed_encoder, args=(self.feeding,), name='AudioFeeder', daemon=True)
+        self.feeder.start()
 
         # SoundDevice stream
-        self.stream = sd.InputStream(channels=1, callback=callback, samplerate=self.sample_rate)
+        self.stream = sd.InputStream(channels=1, callback=callback, samplerate=self.sample_rate, blocksize=self.blocksize, dtype='float32')
         self.stream.start()
         self.start_time = time()
 
@@ -275,6 +302,33 @@ class AudioStreamer(Streamer):
             self.stream.close()
         except:
             pass
+        if self.feeding:
+            self.feeding.set()  # feeder thread writes what is left and exits
+
+    def feed_encoder(self, stopped):
+        """
+        Feeder thread writing the samples in the ring buffer to ffmpeg in large writes.
+        Runs from start() until <stopped> is set by stop(), and reports any overflows.
+        """
+        reported = (0, 0)
+        while True:
+            views = self.ring.peek()
+            count = sum(len(view) for view in views)
+            if count:
+                for view in views:
+                    self.ffmpeg_process.stdin.write(memoryview(view).cast('B'))  # f32le, as ffmpeg expects
+                self.ffmpeg_process.stdin.flush()
+                self.ring.consume(count)
+            elif stopped.is_set():
+                return
+            else:
+                sleep(0.02)  # wait for a few more blocks
+
+            overflows = (self.ring.overflows, self.input_overflows)
+            if overflows != reported:
+                self.debug("Audio overflows - ring buffer: {} ({} samples dropped), PortAudio: {}".format(
+                    self.ring.overflows, self.ring.dropped, self.input_overflows))
+                reported = overflows
 
 
 class SynthEEGStreamer(Streamer):
@@ -301,12 +355,13 @@ class SynthEEGStreamer(Streamer):
         self.info['sample_rate'] = self.freq
         self.info['channels'] = ','.join(self.eeg_channel_names)
 
+        # write each board data chunk as a single database entry
+        self.db_options['chunked'] = True
+        self.db_options['rollup'] = True  # keep min/max/mean levels for zoomed-out and fast playback reads
+
     def loop(self):
         """ Main execution loop """
         sleep(0.25)  # wait a bit for the board to collect another chunk of data
-        data = {}
-        for channel in self.eeg_channel_names:  # lists of channel data
-            data[channel] = []
 
         # attempt to read from board
         # data collected in uV
@@ -315,13 +370,9 @@ class SynthEEGStreamer(Streamer):
         except Exception as e:
             return
 
-        # convert from unix time (in s) to ms
-        data['time'] = list(raw_data[self.time_channel]*1000)
-
-        for i, j in enumerate(self.eeg_channel_indexes):
-            data[self.eeg_channel_names[i]] = list(raw_data[j])
-
-        self.database.write_data(self.id, data)
+        # rows of the board buffer are written as they are, with the time converted from unix time (in s) to ms
+        channels = dict(zip(self.eeg_channel_names, self.eeg_channel_indexes))
+        self.write(self.id, raw_data, channels=channels, time_row=self.time_channel, time_scale=1000)
 
     def start(self):
         """ Extended from base class in pi_lib.py """
@@ -346,6 +397,8 @@ class EEGStreamer(Streamer):
     def __init__(self, *args, dev_path=None):
         """ Dev path is the device path of the dongle"""
         super().__init__(*args)
+        self.db_class = BufferedDatabase  # keep acquiring through network outages
+        self.db_options['buffer_path'] = buffer_path(self.group, self.name)
 
         from brainflow.board_shim import BoardShim, BrainFlowInputParams, BoardIds
 
@@ -368,12 +421,13 @@ class EEGStreamer(Streamer):
         self.info['sample_rate'] = self.freq
         self.info['channels'] = ','.join(self.eeg_channel_names)
 
+        # write each board data chunk as a single database entry
+        self.db_options['chunked'] = True
+        self.db_options['rollup'] = True  # keep min/max/mean levels for zoomed-out and fast playback reads
+
     def loop(self):
         """ Main execution loop """
         sleep(0.25)  # wait a bit for the board to collect another chunk of data
-        data = {}
-        for channel in self.eeg_channel_names:  # lists of channel data
-            data[channel] = []
 
         # attempt to read from board
         # data collected in uV
@@ -382,13 +436,9 @@ class EEGStreamer(Streamer):
         except Exception as e:
             return
 
-        # convert from unix time (in s) to ms
-        data['time'] = list(raw_data[self.time_channel]*1000)
-
-        for i, j in enumerate(self.eeg_channel_indexes):
-            data[self.eeg_channel_names[i]] = list(raw_data[j])
-
-        self.database.write_data(self.id, data)
+        # rows of the board buffer are written as they are, with the time converted from unix time (in s) to ms
+        channels = dict(zip(self.eeg_channel_names, self.eeg_channel_indexes))
+        self.write(self.id, raw_data, channels=channels, time_row=self.time_channel, time_scale=1000)
 
     def start(self):
         """
@@ -429,6 +479,8 @@ class ECGStreamer(Streamer):
     """
     def __init__(self, *args, dev_path):
         super().__init__(*args)
+        self.db_class = BufferedDatabase  # keep acquiring through network outages
+        self.db_options['buffer_path'] = buffer_path(self.group, self.name)
 
         from brainflow.board_shim import BoardShim, BrainFlowInputParams, BoardIds
 
@@ -450,6 +502,10 @@ class ECGStreamer(Streamer):
         self.info['pulse_channels'] = ','.join(self.pulse_channel_names)
         self.info['ecg_channels'] = ','.join(self.ecg_channel_names)
 
+        # write each board data chunk as a single database entry
+        self.db_options['chunked'] = True
+        self.db_options['rollup'] = True  # keep min/max/mean levels for zoomed-out and fast playback reads
+
         # BoardShim.enable_dev_board_logger()
         BoardShim.disable_board_logger()  # disable logger
 
@@ -460,9 +516,6 @@ class ECGStreamer(Streamer):
     def loop(self):
         """ Main execution loop """
         sleep(0.25)  # wait a bit for the board to collect another chunk of data
-        data = {}
-        for channel in self.pulse_channel_names:  # lists of channel data
-            data[channel] = []
 
         # attempt to read from board
         # data collected in uV
@@ -471,16 +524,10 @@ class ECGStreamer(Streamer):
         except Exception as e:
             return
 
-        # convert from unix time (in s) to ms
-        data['time'] = list(raw_data[self.time_channel]*1000)
-
-        for i, j in enumerate(self.pulse_channel_indexes):
-            data[self.pulse_channel_names[i]] = list(raw_data[j])
-
-        for i, j in enumerate(self.ecg_channel_indexes):
-            data[self.ecg_channel_names[i]] = list(raw_data[j])
-
-        self.database.write_data(self.id, data)
+        # rows of the board buffer are written as they are, with the time converted from unix time (in s) to ms
+        channels = dict(zip(self.pulse_channel_names, self.pulse_channel_indexes))
+        channels.update(zip(self.ecg_channel_names, self.ecg_channel_indexes))
+        self.write(self.id, raw_data, channels=channels, time_row=self.time_channel, time_scale=1000)
 
     def start(self):
         """
@@ -0,0 +1,455 @@
+"""
+Shared memory transport between workers running on the same host (see Client with shared_memory=True).
+Each stream written by a worker gets a SharedRing: a ring buffer in a segment of shared memory,
+    with a single writer and any number of readers, each keeping its own read position.
+Workers read new data of each other's streams straight from the rings, rather than from the database,
+    while the database is still written in the background to keep the durable copy.
+"""
+from multiprocessing import shared_memory, resource_tracker
+from threading import Condition, Thread
+import hashlib
+import json
+import time
+import os
+
+import numpy as np
+
+from lib.database import Database, DatabaseConnectionError, DatabaseTimeoutError, DatabaseBusyLoadingError
+
+# layout of the header at the start of each segment, as uint64 values
+MAGIC, CAPACITY, TAIL, HEAD, CLOSED = range(5)
+HEADER = 64  # bytes before the data area
+SIGNATURE = 0x4f53505245595247  # marks a segment as a SharedRing
+
+RECORD = 24  # bytes of each record header: size of the record, number of data points, length of the column names
+WRAP = 2**64 - 1  # number of data points of a record that only pads the end of the data area
+
+
+def segment_name(prefix, stream):
+    """ Name of the shared memory segment of <stream>. Kept short, as some systems allow only 31 characters. """
+    return '{}-{}'.format(prefix, hashlib.sha1(stream.encode()).hexdigest()[:16])
+
+
+def remove_segments(prefix):
+    """ Removes all shared memory segments whose name starts with <prefix>, left by workers that didn't close them """
+    if not os.path.isdir('/dev/shm'):  # only listed on Linux
+        return
+    for name in os.listdir('/dev/shm'):
+        if name.startswith(prefix):
+            try:
+                os.unlink(os.path.join('/dev/shm', name))
+            except OSError:
+                pass
+
+
+def attach_segment(name):
+    """ Attaches to an existing shared memory segment without it being removed when this process exits """
+    try:
+        return shared_memory.SharedMemory(name, track=False)  # python 3.13+
+    except TypeError:
+        segment = shared_memory.SharedMemory(name)
+        resource_tracker.unregister(segment._name, 'shared_memory')  # only the writer may remove it
+        return segment
+
+
+class RingTorn(Exception):
+    """ Raised when a reader was overtaken by the writer while copying data out of a SharedRing """
+
+
+class SharedRing:
+    """
+    Ring buffer of time series in shared memory, written by one process and read by any others.
+    Each write is kept as a record of float64 columns, and all records written are numbered by their
+        byte position (counting up forever), so readers keep their own position like a Bookmark.
+    The writer publishes a record by moving the head past it once it's complete, and moves the tail
+        past the oldest records before overwriting them. Readers check the tail after copying a record
+        out of the ring, so a reader that was lapped never returns overwritten data.
+    <name> name of the shared memory segment (see segment_name()).
+    <capacity> size (bytes) of the data area, to create a new ring for writing.
+        If None, attaches to the existing ring to read it (raises FileNotFoundError if there isn't one).
+    """
+    def __init__(self, name, capacity=None):
+        self.name = name
+        self.writer = capacity is not None
+        if self.writer:
+            capacity -= capacity % 8  # records are aligned to 8 bytes
+            self.segment = shared_memory.SharedMemory(name, create=True, size=HEADER + capacity)
+        else:
+            self.segment = attach_segment(name)
+
+        self.header = np.ndarray(5, dtype=np.uint64, buffer=self.segment.buf)
+        if self.writer:
+            self.header[:] = (SIGNATURE, capacity, 0, 0, 0)
+        elif self.header[MAGIC] != SIGNATURE:
+            self.close()
+            raise FileNotFoundError("Shared memory segment '{}' is not a SharedRing".format(name))
+        self.capacity = int(self.header[CAPACITY])
+        self.data = self.segment.buf[HEADER:HEADER + self.capacity]
+        self.names = {}  # encoded column names: list of names, for both sides
+
+    @property
+    def head(self):
+        """ Position after the newest record """
+        return int(self.header[HEAD])
+
+    @property
+    def tail(self):
+        """ Position of the oldest record that hasn't been overwritten """
+        return int(self.header[TAIL])
+
+    @property
+    def closed(self):
+        """ Whether the writer has closed the ring """
+        return bool(self.header[CLOSED])
+
+    def put(self, columns):
+        """
+        Writes <columns>, a dictionary of equal length 1-D float64 arrays including 'time', as a single record.
+        Returns False if the record is larger than the whole ring, and isn't written.
+        """
+        names = json.dumps(list(columns)).encode()
+        points = len(columns['time'])
+        start = RECORD + len(names) + -len(names) % 8  # column data is aligned to 8 bytes
+        size = start + 8*points*len(columns)
+        if size > self.capacity:
+            return False
+
+        position = self.head
+        offset = position % self.capacity
+        remaining = self.capacity - offset
+        if remaining < size:  # doesn't fit before the end - start again from the beginning
+            self._reclaim(position + remaining, position + remaining + size)
+            if remaining >= RECORD:
+                self._header(offset)[:] = (remaining, WRAP, 0)
+            position += remaining
+            offset = 0
+        else:
+            self._reclaim(position, position + size)
+
+        self._header(offset)[:] = (size, points, len(names))
+        self.data[offset + RECORD:offset + RECORD + len(names)] = names
+        block = np.ndarray((len(columns), points), dtype=np.float64, buffer=self.data, offset=offset + start)
+        for row, column in zip(block, columns.values()):
+            row[:] = column
+        self.header[HEAD] = position + size  # publish
+        return True
+
+    def read(self, position=None):
+        """
+        Returns a tuple (columns, position) of the data written after <position> (None to read all data kept),
+            and the position to read from next time. Columns is a dictionary of 1-D float64 arrays
+            copied out of the ring, joined over all new records, or None if there is nothing new.
+        Records with other columns than the first new one are left for the next read.
+        """
+        while True:
+            tail, head = self.tail, self.head
+            if position is None or position < tail:  # data from before the tail has been overwritten
+                position = tail
+            try:
+                names, parts, end = self._copy(position, head)
+            except RingTorn:
+                position = None
+                continue
+            if self.tail > position:  # overwritten while being copied
+                position = None
+                continue
+            if not parts:
+                return None, end
+            block = parts[0] if len(parts) == 1 else np.concatenate(parts, axis=1)
+            return dict(zip(names, block)), end
+
+    def has_new(self, position):
+        """ Whether anything was written after <position> """
+        return self.head > (position if position is not None else self.tail)
+
+    def close(self):
+        """ Detaches from the ring. The writer also marks it as closed and removes the segment. """
+        if self.segment is None:
+            return
+        if self.writer:
+            self.header[CLOSED] = 1
+        self.header = self.data = None  # release the views, otherwise the segment can't be closed
+        self.segment.close()
+        if self.writer:
+            try:
+                self.segment.unlink()
+            except FileNotFoundError:
+                pass
+        self.segment = None
+
+    def _copy(self, position, head):
+        """
+        Copies records from <position> up to <head>. Returns (column names, list of 2-D arrays, end position).
+        Not meant to be called directly. Used by read().
+        """
+        names, parts = None, []
+        while position < head:
+            offset = position % self.capacity
+            remaining = self.capacity - offset
+            if remaining < RECORD:  # too small for a record - the next one is at the beginning
+                position += remaining
+                continue
+            size, points, length = (int(value) for value in self._header(offset))
+            if size < RECORD or size > remaining:  # header was overwritten after head was read
+                raise RingTorn()
+            if points == WRAP:
+                position += size
+                continue
+
+            key = bytes(self.data[offset + RECORD:offset + RECORD + length])
+            keys = self.names.get(key)
+            if keys is None:
+                try:
+                    keys = self.names[key] = json.loads(key)
+                except ValueError:
+                    raise RingTorn()
+            if names is not None and keys != names:
+                break
+            names = keys
+            start = offset + RECORD + length + -length % 8
+            if start + 8*points*len(keys) > offset + size:
+                raise RingTorn()
+            parts.append(np.ndarray((len(keys), points), dtype=np.float64, buffer=self.data, offset=start).copy())
+            position += size
+        return names, parts, position
+
+    def _header(self, offset):
+        """ Header of the record at <offset> in the data area, as a writable array of 3 uint64 values """
+        return np.ndarray(3, dtype=np.uint64, buffer=self.data, offset=offset)
+
+    def _reclaim(self, start, end):
+        """
+        Moves the tail past all records that writing a new record from position <start> up to <end> will overwrite.
+        Only walks the records before the head, so never reads a header that hasn't been written yet.
+        If every record is overwritten, the tail moves to the new record.
+        """
+        tail, head = self.tail, self.head
+        while tail < head and tail + self.capacity < end:
+            offset = tail % self.capacity
+            remaining = self.capacity - offset
+            tail += remaining if remaining < RECORD else int(self._header(offset)[0])
+        if tail + self.capacity < end or tail >= head:  # nothing before the head is kept
+            tail = start
+        self.header[TAIL] = tail
+
+
+class SharedDatabase(Database):
+    """
+    Database connection of a worker that exchanges time series with other workers on the same host.
+    Numerical time series written by this worker also go into a SharedRing for each stream,
+        where other workers can read them as soon as they're written.
+    All time series are written to the database by a background thread, in the order they were written,
+        so writes return without waiting for the database.
+    New data of a stream with a ring (written by another worker on this host) is read from the ring.
+        Everything else is read from the database as usual, including reads of a <count>, time ranges
+        and snapshots, and all reads of replicas in a consumer group.
+    <prefix> prefix of the names of the rings, unique to the Client that runs the workers.
+    <capacity> size (bytes) of the ring of each stream written.
+    <attach_interval> minimum time (s) between attempts to find the ring of a stream that doesn't have one.
+    <poll_interval> time (s) between checks of the rings for new data while waiting.
+    <max_pending> maximum number of writes waiting for the database. The oldest are dropped beyond that.
+    Other keyword options are passed to Database.
+    Workers close their SharedDatabase when they shut down (see Streamer.cleanup()), which marks their rings as closed
+        so that readers go back to the database until a new ring for the stream is written.
+    """
+    def __init__(self, ip, port, password, prefix, capacity=4*2**20, attach_interval=1, poll_interval=0.0005,
+                 max_pending=10000, **options):
+        super().__init__(ip, port, password, **options)
+        self.prefix = prefix
+        self.capacity = capacity
+        self.attach_interval = attach_interval
+        self.poll_interval = poll_interval
+        self.max_pending = max_pending
+
+        self.writers = {}  # stream: SharedRing written by this worker, or None if it can't have one
+        self.readers = {}  # stream: SharedRing of another worker being read
+        self.positions = {}  # stream: position to read its ring from next
+        self.looked = {}  # stream: time its ring was last looked for
+        self.last_times = {}  # stream: time of the last data point read, so nothing is read twice
+
+        self.pending = []  # (stream, data) waiting to be written to the database
+        self.sending = False  # whether writes taken from self.pending are being written
+        self.cond = Condition()
+        Thread(target=self._persist, name='SharedDatabase-persist', daemon=True).start()
+
+    def write_data(self, stream, data, chunked=None, channels=None, time_row=None, time_scale=1):
+        """ Extends write_data() to put the data in the stream's ring, and write it to the database in the background """
+        if isinstance(data, np.ndarray):
+            data = self.array_columns(data, channels, time_row, time_scale)
+        self._share(stream, data)
+        self._queue([(stream, data)])
+
+    def write_batch(self, batches):
+        """ Extends write_batch() in the same way as write_data() """
+        for stream, data in batches:
+            self._share(stream, data)
+        self._queue(batches)
+
+    def flush(self, timeout=5):
+        """ Waits up to <timeout> seconds for all writes so far to be written to the database """
+        end = time.time() + timeout
+        with self.cond:
+            while (self.pending or self.sending) and time.time() < end:
+                self.cond.wait(end - time.time())
+
+    def close(self):
+        """ Closes all rings, removing the ones written by this worker """
+        for ring in list(self.writers.values()) + list(self.readers.values()):
+            if ring:
+                ring.close()
+        self.writers, self.readers = {}, {}
+
+    def read_data(self, stream, count=None, max_time=None, to_json=False, decode=True, downsample=False, points=1000):
+        """ Extends read_data() to read new data from the stream's ring """
+        if count or downsample or not decode or not self._reader(stream):
+            output = super().read_data(stream, count, max_time, to_json, decode, downsample, points)
+            if output and not to_json and not count and output.get('time'):
+                self.last_times[stream] = output['time'][-1]
+            return output
+        columns = self._take(stream, max_time)
+        if columns is None:
+            return None
+        output = {key: column.tolist() for key, column in columns.items()}
+        if to_json:
+            return json.dumps(output)
+        return output
+
+    def read_array(self, stream, count=None, max_time=None, t0=None, t1=None, columns=None, dtype=np.float64):
+        """ Extends read_array() to read new data from the stream's ring """
+        if count or t0 is not None or t1 is not None or not self._reader(stream):
+            output = super().read_array(stream, count, max_time, t0, t1, columns, dtype)
+            if output is not None and not count and t0 is None and t1 is None and len(output[0]):
+                self.last_times[stream] = output[0][-1]
+            return output
+        output = self._take(stream, max_time)
+        if output is None:
+            return None
+        if columns is None:  # all columns other than 'time' in the order they were written
+            columns = [key for key in output.keys() if key != 'time']
+        data = np.array([output[key] for key in columns], dtype=dtype)
+        return output['time'], data
+
+    def read_columns(self, stream):
+        """ Extends read_columns() to get the columns from the newest data in the stream's ring """
+        ring = self._reader(stream)
+        if not ring or ring.head == ring.tail:
+            return super().read_columns(stream)
+        columns, _ = ring.read(self.positions.get(stream))
+        if columns is None:
+            return super().read_columns(stream)
+        return [key for key in columns.keys() if key != 'time']
+
+    def wait(self, streams, timeout=1):
+        """
+        Extends wait() to wait for new data in the rings of <streams>.
+        If any of <streams> have a ring, the others aren't waited for.
+        """
+        rings = {stream: self._reader(stream) for stream in streams if stream is not None}
+        rings = {stream: ring for stream, ring in rings.items() if ring}
+        if not rings:
+            return super().wait(streams, timeout)
+        end = time.time() + timeout
+        while True:
+            new = [stream for stream, ring in rings.items() if ring.has_new(self.positions.get(stream)) or ring.closed]
+            if new or time.time() >= end:
+                return new
+            time.sleep(self.poll_interval)
+
+    def _share(self, stream, data):
+        """ Puts numerical time series <data> in the ring of <stream>, creating the ring on the first write """
+        if self.consumer:  # replicas in a consumer group write the same streams, and a ring only has one writer
+            return
+        ring = self.writers.get(stream, False)
+        if ring is None:
+            return
+        try:
+            columns = {key: np.atleast_1d(np.asarray(val, dtype=np.float64)) for key, val in data.items()}
+        except (ValueError, TypeError):  # not numerical - only in the database
+            return
+        if 'time' not in columns or any(len(column) != len(columns['time']) for column in columns.values()):
+            return
+        if ring is False:
+            try:
+                ring = SharedRing(segment_name(self.prefix, stream), self.capacity)
+            except FileExistsError:  # another worker writes this stream
+                ring = None
+            self.writers[stream] = ring
+            if ring is None:
+                return
+        if not ring.put(columns):  # larger than the whole ring - readers would miss it, so they go back to the database
+            print("Write to {} is too large for its shared ring of {} bytes - no longer sharing it".format(stream, self.capacity))
+            ring.close()
+            self.writers[stream] = None
+
+    def _reader(self, stream):
+        """ Returns the ring of <stream> written by another worker, or None if it doesn't have one """
+        if self.consumer or stream in self.writers:
+            return None
+        ring = self.readers.get(stream)
+        if ring and ring.closed:  # the writer stopped - look for a new ring later
+            ring.close()
+            del self.readers[stream]
+            self.positions.pop(stream, None)
+            ring = None
+        if ring:
+            return ring
+        if time.time() - self.looked.get(stream, 0) < self.attach_interval:
+            return None
+        self.looked[stream] = time.time()
+        try:
+            ring = SharedRing(segment_name(self.prefix, stream))
+        except FileNotFoundError:
+            return None
+        self.readers[stream] = ring
+        return ring
+
+    def _take(self, stream, max_time=None):
+        """ Reads <stream> from its ring and moves its read position. Returns a dict of columns, or None. """
+        columns, self.positions[stream] = self.readers[stream].read(self.positions.get(stream))
+        if columns is None:
+            return None
+        last = self.last_times.get(stream)
+        if last is not None and columns['time'][0] <= last:  # already read from the database before the ring was found
+            keep = columns['time'] > last
+            if not keep.any():
+                return None
+            columns = {key: column[keep] for key, column in columns.items()}
+        if max_time:  # only the last <max_time> seconds
+            keep = columns['time'] >= columns['time'][-1] - max_time*1000
+            columns = {key: column[keep] for key, column in columns.items()}
+        self.last_times[stream] = columns['time'][-1]
+        return columns
+
+    def _queue(self, batches):
+        """ Adds writes to be written to the database by the background thread """
+        with self.cond:
+            self.pending.extend(batches)
+            dropped = len(self.pending) - self.max_pending
+            if dropped > 0:  # drop the oldest
+                del self.pending[:dropped]
+            self.cond.notify_all()
+        if dropped > 0:
+            print("Database writes are falling behind - dropped the {} oldest writes".format(dropped))
+
+    def _persist(self):
+        """ Background thread writing the pending writes to the database """
+        while not self.exit:
+            with self.cond:
+                while not self.pending:
+                    self.cond.wait()
+                batches, self.pending = self.pending, []
+                self.sending = True
+
+            try:
+                super().write_batch(batches)
+            except (DatabaseConnectionError, DatabaseTimeoutError, DatabaseBusyLoadingError) as e:
+                print("Could not write to database - trying again in 1 second. {}: {}".format(e.__class__.__name__, e))
+                with self.cond:
+                    self.pending[:0] = batches  # in front of anything written since
+                time.sleep(1)
+            except Exception as e:  # database or data error - writing them again wouldn't help
+                print("Failed to write to database - dropped {} writes. {}: {}".format(len(batches), e.__class__.__name__, e))
+            finally:  # always, so that the thread keeps writing and flush() doesn't wait for nothing
+                with self.cond:
+                    self.sending = False
+                    self.cond.notify_all()
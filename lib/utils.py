@@ -1,5 +1,40 @@
+import importlib
+import time
 import numpy as np
 
+# time (s) taken to import each module loaded through lazy_import() in this process
+import_times = {}
+
+
+class LazyModule:
+    """
+    Stands in for a module that is only imported when one of its attributes is first used.
+    Created by lazy_import().
+    """
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr):
+        if self._module is None:  # first use
+            start = time.time()
+            self._module = importlib.import_module(self._name)
+            import_times[self._name] = time.time() - start
+        return getattr(self._module, attr)
+
+    def __repr__(self):
+        return "<lazy module '{}'>".format(self._name)
+
+
+def lazy_import(name):
+    """
+    Returns a stand-in for module <name> that imports it on first use, e.g. signal = lazy_import('scipy.signal')
+    Meant for heavy dependencies of modules that every worker process imports,
+        so that only the workers which actually use them pay for the import time and memory.
+    An ImportError is raised on first use rather than on import.
+    """
+    return LazyModule(name)
+
 
 class MovingAverage:
     """
@@ -31,6 +66,46 @@ class MovingAverage:
         return self.value
 
 
+def minmax_envelope(time, data, points):
+    """
+    Reduces a block of samples to a min/max envelope for plotting.
+    Splits the samples into <points>/2 equal bins, and keeps the minimum and maximum
+        of each bin in the order they occurred, so peaks survive any amount of reduction.
+    <time> 1-D array of sample times
+    <data> 2-D array of shape (channels, samples)
+    <points> maximum number of samples to return.
+    Returns a tuple (time, data) of the same format. If there are already
+        no more than <points> samples, they are returned unchanged.
+    """
+    n = len(time)
+    bins = points // 2
+    if bins < 1 or n <= points:
+        return time, data
+
+    width = -(-n // bins)  # samples per bin (rounded up)
+    bins = -(-n // width)  # number of bins actually needed for that width
+    pad = bins*width - n  # fill the last bin by repeating the last sample
+    blocks = np.pad(data, ((0, 0), (0, pad)), mode='edge').reshape(len(data), bins, width)
+
+    # index of the min and max of each bin for each channel, in the order they occurred
+    i_min = blocks.argmin(axis=2)
+    i_max = blocks.argmax(axis=2)
+    first = np.take_along_axis(blocks, np.minimum(i_min, i_max)[..., np.newaxis], axis=2)[..., 0]
+    second = np.take_along_axis(blocks, np.maximum(i_min, i_max)[..., np.newaxis], axis=2)[..., 0]
+
+    # channels peak at different times, so each bin is given the times of its first and last sample
+    start = np.arange(bins) * width
+    end = np.minimum(start + width - 1, n - 1)
+
+    env_time = np.empty(2*bins, dtype=time.dtype)
+    env_time[0::2] = time[start]
+    env_time[1::2] = time[end]
+    env_data = np.empty((len(data), 2*bins), dtype=data.dtype)
+    env_data[:, 0::2] = first
+    env_data[:, 1::2] = second
+    return env_time, env_data
+
+
 def validate_input(message, expecting, case=False):
     """
     Rudimentary user input validation
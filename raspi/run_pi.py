@@ -1,4 +1,4 @@
-from lib.lib import Client
+from lib.lib import AsyncClient
 from lib.raspi.streamers import *
 
 # Test streams
@@ -13,10 +13,10 @@ audio = AudioStreamer('Audio', 'Audio 1')
 
 sense = SenseStreamer('Raw', 'Sense Hat 1')
 
-# Pass all workers to client
+# Pass all workers to client, which runs them all in this process
 workers = [t1, t2, synth1eeg, video, sense, audio]
 
-client = Client(
+client = AsyncClient(
     workers=workers, name='Raspi #1', debug=1,
     server_ip='signalstream.org', port=443,
     db_port=5001, db_pass='thisisthepasswordtotheredisserver'
@@ -1,21 +1,22 @@
 import numpy as np
-from scipy import signal
 from time import sleep, time
 import json
 import inspect
 
 from threading import Thread
+from concurrent.futures import wait as wait_futures, FIRST_COMPLETED
 
 from lib.lib import Analyzer
-from lib.utils import MovingAverage
-from server.bokeh_layouts.eeg_layout import default_filter_widgets as EEG_FILTER_WIDGETS
-from server.bokeh_layouts.eeg_layout import default_fourier_widgets as EEG_FOURIER_WIDGETS
-from server.bokeh_layouts.ecg_layout import default_filter_widgets as ECG_FILTER_WIDGETS
-from server.bokeh_layouts.ecg_layout import default_fourier_widgets as ECG_FOURIER_WIDGETS
-from server.bokeh_layouts.audio_layout import default_filter_widgets as AUDIO_FILTER_WIDGETS
-from server.bokeh_layouts.audio_layout import default_fourier_widgets as AUDIO_FOURIER_WIDGETS
+from lib.utils import MovingAverage, lazy_import
+from lib.function_pool import FunctionPool, FunctionError, Block, to_columns
+from lib.database import DatabaseError
+from server.bokeh_layouts.defaults import EEG_FILTER_WIDGETS, EEG_FOURIER_WIDGETS
+from server.bokeh_layouts.defaults import ECG_FILTER_WIDGETS, ECG_FOURIER_WIDGETS
+from server.bokeh_layouts.defaults import AUDIO_FILTER_WIDGETS, AUDIO_FOURIER_WIDGETS
 
-import ffmpeg
+# heavy dependencies, only imported by the workers that use them
+signal = lazy_import('scipy.signal')
+ffmpeg = lazy_import('ffmpeg')
 
 
 class TestAnalyzer(Analyzer):
@@ -37,7 +38,7 @@ class TestAnalyzer(Analyzer):
         }
 
         if not any(all_data.values()):  # got no data from any stream
-            sleep(0.5)
+            self.wait_for_data(self.random_11, self.random_12, self.random_21, self.random_22)
             return
 
         # perform some operation on the data.
@@ -55,11 +56,19 @@ class TestAnalyzer(Analyzer):
 
             self.database.write_data(name+':'+self.id, output)
 
-        sleep(0.5)
-
 
 class FunctionAnalyzer(Analyzer):
-    """ Analyzer for running data through arbitrary python functions stored in local/pipelines/ """
+    """
+    Analyzer for running data through arbitrary python functions stored in local/pipelines/
+    The functions are run on a FunctionPool, with a deadline and CPU/memory limits on each call,
+        so a slow or stuck function can't hold up this analyzer or starve the rest of the server.
+    Each target is run independently: new data of a target is sent as soon as its last call is done,
+        whether or not the other targets have any.
+    The average time each function takes is written to the info under 'timing'.
+    If the first function is a block function (see lib/function_pool.py), data is read and sent
+        as numpy arrays rather than lists, and the output of the last one is written back as arrays.
+    Stateful (generator) block functions are refused when running as replicas, which each only get some of the data.
+    """
     def __init__(self, *args):
         super().__init__(*args)
         self.target_ids = []  # stream IDs of the target data streams
@@ -69,8 +78,20 @@ class FunctionAnalyzer(Analyzer):
         # [1] python function for data to be run through before written back to the database
         self.functions = []
 
+        # options of the FunctionPool (see lib/function_pool.py)
+        self.pool_options = {'processes': 2, 'timeout': 5, 'cpu_limit': 5, 'memory_limit': 2**30}
+        self.pool = None  # FunctionPool created in start()
+        self.running = {}  # target name: Future of the call running its last data
+        self.columns = {}  # target name: names of its data columns, for reading it as a Block
+        self.timing = {}  # file name: MovingAverage of the time (s) the function takes
+        self.timing_interval = 5  # time (s) between writes of the timing to the info
+        self.timing_written = 0  # time the timing was last written
+
     def start(self):
         """ streamer start method before loop is executed """
+        if not self.pool:
+            self.pool = FunctionPool(**self.pool_options)
+
         try:  # grab the ID of the target stream
             targets = self.targets[self.group].values()
             self.target_ids = [target['id'] for target in list(targets)]
@@ -83,24 +104,97 @@ class FunctionAnalyzer(Analyzer):
         except Exception as e:
             print("Failed to save custom function info to database: {}: {}".format(e.__class__.__name__, e))
 
+    def stop(self):
+        """ Stops the worker processes """
+        if self.pool:
+            self.pool.close()
+            self.pool = None
+        self.running = {}
+
     def loop(self):
         """ Maine execution loop """
+        idle = []  # IDs of targets without new data
         for name, target in self.targets[self.group].items():
-            data = self.database.read_data(target['id'])
-            if not data:  # if no data read, wait half a sec to loop again
-                sleep(1)
-                return
-
-            for func in self.functions:  # for each pipeline function
-                transform = func[1]  # [0] is the file name containing the function
-                try:  # attempt to run data through custom method
-                    data = transform(data)
-                except Exception as e:
-                    print("Error running custom method '{}': {}: {}".format(transform.__name__, e.__class__.__name__, e))
-
-            # after data has been put through all transforms, write it back to the database
+            future = self.running.get(name)
+            if future:
+                if not future.done():  # still running its last data
+                    continue
+                del self.running[name]
+                self.finish(name, future)
+
+            if self.functions and getattr(self.functions[0][1], 'block', False):
+                data = self.read_block(name, target)
+            else:
+                data = self.database.read_data(target['id'])
+            if not data:
+                idle.append(target['id'])
+                continue
+
+            if not self.functions:  # nothing to run it through
+                self.database.write_data(name+':'+self.id, data)
+                continue
+            calls = [(func.__module__, func.__name__) for _, func in self.functions]
+            self.running[name] = self.pool.submit(calls, data, key=name)
+
+        self.write_timing()
+        if self.running:  # wait for any call to finish, but keep checking the other targets for new data
+            wait_futures(list(self.running.values()), timeout=0.1, return_when=FIRST_COMPLETED)
+        elif idle:  # nothing running and no new data - wait for a target to write more
+            self.wait_for_data(*idle)
+
+    def read_block(self, name, target):
+        """ Reads new data of target <name> as a Block, or returns None if there isn't any """
+        columns = self.columns.get(name)
+        if not columns:  # names are read once, as read_array() doesn't give them
+            columns = self.database.read_columns(target['id'])
+            if not columns:
+                return None
+            self.columns[name] = columns
+
+        try:
+            array = self.database.read_array(target['id'], columns=columns)
+        except DatabaseError:
+            del self.columns[name]  # the stream may have been restarted with other columns
+            raise
+        if array is None:
+            return None
+        try:
+            sample_rate = float(target['sample_rate'])
+        except (KeyError, TypeError, ValueError):
+            sample_rate = None
+        return Block(array[0], array[1], columns, sample_rate)
+
+    def finish(self, name, future):
+        """ Writes the output of a finished call of the functions for target <name> back to the database """
+        try:
+            data, timing, errors = future.result()
+        except FunctionError as e:
+            print("Custom pipeline of [{}] failed: {}".format(self, e))
+            return
+
+        files = {func.__module__: filename for filename, func in self.functions}
+        for module, error in errors.items():
+            print("Error running custom method '{}': {}".format(files.get(module, module), error))
+        for module, seconds in timing.items():
+            filename = files.get(module, module)
+            if filename not in self.timing:
+                self.timing[filename] = MovingAverage(20)
+            self.timing[filename].add(seconds)
+
+        # after data has been put through all transforms, write it back to the database
+        if isinstance(data, Block):  # numpy rows are written without converting each value
+            if len(data.time):
+                self.database.write_data(name+':'+self.id, to_columns(data))
+        elif data:
             self.database.write_data(name+':'+self.id, data)
-        sleep(0.1)  # just to slow it down a bit
+
+    def write_timing(self):
+        """ Writes the average time (s) each function takes to the info, every <timing_interval> seconds """
+        if not self.timing or time() - self.timing_written < self.timing_interval:
+            return
+        self.timing_written = time()
+        timing = {filename: average.value for filename, average in self.timing.items()}
+        self.database.set_info(self.id, {'timing': json.dumps(timing)})
 
     def json(self, lst):
         """ Gets list of updated file names from which to retrieve pipeline functions from """
@@ -115,13 +209,19 @@ class FunctionAnalyzer(Analyzer):
                 exec("import {} as custom".format(import_name))  # import custom py file
                 custom = old_locals['custom']  # get modified copy of local variables
                 members = inspect.getmembers(custom, inspect.isfunction)  # all functions [(name, func), ]
+                members = [member for member in members if member[1].__module__ == custom.__name__]  # not imported ones
                 if len(members) > 1:
                     print("More than 1 function exists in custom algorithm file '{}'".format(filename))
                     continue
                 elif not members:
                     print("No functions defined in custom algorithm file '{}'".format(filename))
                     continue
-                self.functions.append((filename, members[0][1]))  # add that function to the list of available functions
+                func = members[0][1]
+                if self.consumer and getattr(func, 'block', False) and inspect.isgeneratorfunction(func):
+                    # each replica only gets some of the blocks, so the state carried between them would be wrong
+                    print("Stateful block function in '{}' can't be run by replicas of [{}]".format(filename, self))
+                    continue
+                self.functions.append((filename, func))  # add that function to the list of available functions
             except Exception as e:
                 print("Error importing from file '{}': {}: {}".format(filename, e.__class__.__name__, e))
 
@@ -169,38 +269,40 @@ class SignalFilter(SignalAnalyzer):
 
     def loop(self):
         """ Maine execution loop """
-        data = self.database.read_data(self.raw_id)
-        if not data:
-            sleep(0.5)
+        block = self.database.read_array(self.raw_id, columns=self.channels)
+        if block is None:
+            self.wait_for_data(self.raw_id)
             return
-        filtered_data = self.filter(data)  # perform filtering
-        self.database.write_data(self.id, filtered_data)
+        times, data = block
+        filtered = self.filter(data)  # perform filtering
+
+        output = {name: filtered[i] for i, name in enumerate(self.channels)}
+        output['time'] = times
+        self.database.write_data(self.id, output)
 
     def filter(self, data):
-        """ Performs frequency filters on the input dictionary of data """
+        """ Performs frequency filters on the input 2D array of data (channels x samples) """
         # Bandpass filters
         if self.widgets['pass_toggle']:
             if self.pass_update:  # a new filter was requested
                 self.pass_sos = self.create_filter_sos('pass')
                 init = signal.sosfilt_zi(self.pass_sos)  # get initial conditions for this sos
-                self.pass_sos_init = [init] * len(self.channels)  # for each channel
+                self.pass_sos_init = np.repeat(init[:, np.newaxis, :], len(self.channels), axis=1)  # for each channel
                 self.pass_update = False  # filter has been updated
 
-            for i, name in enumerate(self.channels):  # for all EEG data channels
-                # apply filter with initial conditions, and set new initial conditions
-                data[name], self.pass_sos_init[i] = signal.sosfilt(self.pass_sos, data[name], zi=self.pass_sos_init[i])
+            # apply filter to all channels with initial conditions, and set new initial conditions
+            data, self.pass_sos_init = signal.sosfilt(self.pass_sos, data, axis=-1, zi=self.pass_sos_init)
 
         # notch filter
         if self.widgets['stop_toggle']:
             if self.stop_update:  # a new filter was requested
                 self.stop_sos = self.create_filter_sos('stop')
                 init = signal.sosfilt_zi(self.stop_sos)  # get initial conditions for this (b, a)
-                self.stop_sos_init = [init] * len(self.channels)  # for each channel
+                self.stop_sos_init = np.repeat(init[:, np.newaxis, :], len(self.channels), axis=1)  # for each channel
                 self.stop_update = False  # filter has been updated
 
-            for i, name in enumerate(self.channels):  # for all EEG data channels
-                # apply filter with initial conditions, and set new initial conditions
-                data[name], self.stop_sos_init[i] = signal.sosfilt(self.stop_sos, data[name], zi=self.stop_sos_init[i])
+            # apply filter to all channels with initial conditions, and set new initial conditions
+            data, self.stop_sos_init = signal.sosfilt(self.stop_sos, data, axis=-1, zi=self.stop_sos_init)
 
         # TODO: When updating the filter and re-calculating the initial conditions,
         #  all channels get a huge ripple that messes up the FFT and Spectrogram.
@@ -280,18 +382,23 @@ class SignalFourier(SignalAnalyzer):
         self.raw_id = None
         self.filtered_id = None
 
+        # store spectra as float32 arrays, and only keep the last hour of them
+        self.db_options['packed_snapshots'] = True
+        self.db_options['snapshot_max_age'] = 3600
+
     def loop(self):
         """ Maine execution loop """
         # samples needed to read for a given time window
         samples = int(self.widgets['fourier_window'] * self.sample_rate)
-        filtered_data = self.database.read_data(self.filtered_id, count=samples)
-        if not filtered_data:
-            sleep(0.1)
+        block = self.database.read_array(self.filtered_id, count=samples, columns=self.channels)
+        if block is None:
+            self.wait_for_data(self.filtered_id)
             return
+        times, filtered = block
 
-        fourier_data = self.fourier(filtered_data)  # fourier analysis
-        fourier_data['time'] = filtered_data['time'][0]  # use latest time stamp from filtered data
-        self.database.write_snapshot(self.id, fourier_data)
+        fourier_data = self.fourier(filtered)  # fourier analysis
+        fourier_data['time'] = float(times[0])  # use latest time stamp from filtered data
+        self.database.write_snapshot(self.id, fourier_data, static=['frequencies'])
 
         # Slow down rate of performing fourier transforms.
         # They appear to be having a significant impact on CPU usage.
@@ -300,23 +407,18 @@ class SignalFourier(SignalAnalyzer):
         sleep(1)
 
     def fourier(self, data):
-        """ Calculates the FFT of a slice of data """
-        N = len(list(data.values())[0])  # length of each channel in eeg data (should all be the same)
+        """ Calculates the FFT of a slice of data (2D array of channels x samples) """
+        N = data.shape[1]  # length of each channel in eeg data
         freqs = np.fft.fftfreq(N, 1 / self.sample_rate)[:N // 2]  # frequency array
 
         # numpy types are not JSON serializable, so they must be converted to a list
         fourier_dict = {'frequencies': freqs.tolist()}
         # spectro_dict = {'spec_time': [self.spec_time]}
 
-        for name, channel_data in data.items():
-            if name == 'time':
-                continue  # don't perform an FFT on the time series lol
-
-            fft = (np.fft.fft(channel_data)[:N // 2]) / N  # half frequency range and normalize
-            fft = np.sqrt(np.real(fft) ** 2 + np.imag(fft) ** 2)
-
+        fft = np.abs(np.fft.fft(data, axis=1)[:, :N // 2]) / N  # half frequency range and normalize, for all channels
+        for i, name in enumerate(self.channels):
             # set fft column
-            fourier_dict[name] = fft.tolist()
+            fourier_dict[name] = fft[i].tolist()
 
             # Add square of fft to spectrogram slice
             # must be 2D list because this is being put into an image glyph
@@ -395,19 +497,20 @@ class EEGFourier(SignalFourier):
         """ Maine execution loop (Overriding SignalFourier) """
         # samples needed to read for a given time window
         samples = int(self.widgets['fourier_window'] * self.sample_rate)
-        filtered_data = self.database.read_data(self.filtered_id, count=samples)
-        if not filtered_data:
-            sleep(0.5)
+        block = self.database.read_array(self.filtered_id, count=samples, columns=self.channels)
+        if block is None:
+            self.wait_for_data(self.filtered_id)
             return
+        times, filtered = block
 
-        fourier_data = self.fourier(filtered_data)  # fourier analysis
-        fourier_data['time'] = filtered_data['time'][-1]  # use latest time stamp from filtered data.
+        fourier_data = self.fourier(filtered)  # fourier analysis
+        fourier_data['time'] = float(times[-1])  # use latest time stamp from filtered data.
 
         headplot_data = self.headplot(fourier_data)  # headplot spectrogram from fourier
-        headplot_data['time'] = filtered_data['time'][-1]  # use latest time stamp from filtered data
+        headplot_data['time'] = float(times[-1])  # use latest time stamp from filtered data
 
-        self.database.write_snapshot('fourier:' + self.id, fourier_data)
-        self.database.write_snapshot('headplot:' + self.id, headplot_data)
+        self.database.write_snapshot('fourier:' + self.id, fourier_data, static=['frequencies'])
+        self.database.write_snapshot('headplot:' + self.id, headplot_data, static=['x', 'y', 'channel'])
 
         # Slow down rate of performing fourier transforms.
         # They appear to be having a significant impact on CPU usage.
@@ -478,14 +581,14 @@ class PulseAnalyzer(Analyzer):
     def loop(self):
         """ Maine execution loop """
         samples = int(self.window*self.sample_rate)
-        raw = self.database.read_data(self.raw_id, count=samples)
-        if not raw:
-            sleep(0.5)
+        block = self.database.read_array(self.raw_id, count=samples, columns=self.channels[:1])
+        if block is None:
+            self.wait_for_data(self.raw_id)
             return
+        times, raw = block
 
-        pulse_data = raw[self.channels[0]]
-        heart_rate = self.calc_heart_rate(pulse_data)  # perform filtering
-        output = {'heart_rate': heart_rate, 'time': raw['time'][-1]}
+        heart_rate = self.calc_heart_rate(raw[0])  # perform filtering
+        output = {'heart_rate': heart_rate, 'time': float(times[-1])}
         self.database.write_data(self.id, output)
         sleep(0.5)
 
@@ -543,7 +646,7 @@ class AudioDecoder(Analyzer):
             audio_data = b''.join(audio_chunks)  # concatenate all frames
             self.ffmpeg_process.stdin.write(audio_data)
         else:
-            sleep(0.1)
+            self.wait_for_data(self.audio_id)
 
     def read_from_ffmpeg(self):
         """ Meant to be run on a seaprate thread. Write decoded audio to the database """
@@ -605,7 +708,7 @@ class AudioEncoder(Analyzer):
             data = np.expand_dims(np.array(data, dtype='float32'), axis=1)
             self.ffmpeg_process.stdin.write(data)
         else:
-            sleep(0.2)
+            self.wait_for_data(self.audio_id)
 
     def read_from_ffmpeg(self):
         """ Meant to be run on a seaprate thread. Write encoded audio to the database """
@@ -630,14 +733,13 @@ class AudioAnalyzer(Analyzer):
         """ Main execution loop """
         data = self.database.read_data(self.audio_id)  # read raw audio data
         if not data:
-            sleep(1)
+            self.wait_for_data(self.audio_id)
             return
 
         audio = np.array(data['data'])
         data['data'] = audio*5
 
         self.database.write_data(self.id, data)  # write to new data column
-        sleep(0.01)
 
 
 class AudioFilter(SignalFilter):
@@ -5,32 +5,15 @@ from bokeh.plotting import figure
 
 from json import loads
 
+from server.bokeh_layouts.defaults import AUDIO_FILTER_WIDGETS, AUDIO_FOURIER_WIDGETS
 from server.bokeh_layouts.utils import js_request, time_format, plot_sliding_js, plot_priority_js
 
 BACKEND = 'canvas'  # 'webgl' appears to be broken - makes page unresponsive.
 
 # default values of all widgets and figure attributes
-default_filter_widgets = {
-    'pass_toggle': False,
-    'pass_type': 'bandpass',
-    'pass_style': 'Butterworth',
-    'pass_range': (100, 4000),
-    'pass_order': 3,
-    'pass_ripple': (1, 50),
-
-    'stop_toggle': False,
-    'stop_type': 'bandstop',
-    'stop_style': 'Butterworth',
-    'stop_range': (58, 61),
-    'stop_order': 5,
-    'stop_ripple': (1, 50),
-}
-
-default_fourier_widgets = {
-    'fourier_window': 0.2,
-    'spectrogram_range': (-3.0, 1.0),  # color scale range (log)
-    'spectrogram_size': 30,
-}
+default_filter_widgets = AUDIO_FILTER_WIDGETS
+default_fourier_widgets = AUDIO_FOURIER_WIDGETS
+
 
 def create_layout(info):
     """
@@ -0,0 +1,85 @@
+"""
+Default values of the filter and fourier widgets of each layout.
+Kept apart from the layout builders so that analyzers can use them without importing Bokeh.
+"""
+
+# EEG
+EEG_FILTER_WIDGETS = {
+    'pass_toggle': True,
+    'pass_type': 'bandpass',
+    'pass_style': 'Butterworth',
+    'pass_range': (1, 60),
+    'pass_order': 3,
+    'pass_ripple': (1, 50),
+
+    'stop_toggle': True,
+    'stop_type': 'bandstop',
+    'stop_style': 'Butterworth',
+    'stop_range': (59, 60.5),
+    'stop_order': 5,
+    'stop_ripple': (1, 50),
+
+
+}
+
+EEG_FOURIER_WIDGETS = {
+    'fourier_window': 2,
+    'spectrogram_range': (-3.0, 1.0),  # color scale range (log)
+    'spectrogram_size': 30,
+
+    'bands': {'Delta': (1, 4),
+              'Theta': (4, 8),
+              'Alpha': (8, 12),
+              'Beta': (12, 30),
+              'Gamma': (30, 100)}
+}
+
+
+# ECG
+ECG_FILTER_WIDGETS = {
+    'pass_toggle': True,
+    'pass_type': 'bandpass',
+    'pass_style': 'Butterworth',
+    'pass_range': (1, 20),
+    'pass_order': 3,
+    'pass_ripple': (1, 50),
+
+    'stop_toggle': True,
+    'stop_type': 'bandstop',
+    'stop_style': 'Butterworth',
+    'stop_range': (58, 61),
+    'stop_order': 5,
+    'stop_ripple': (1, 50),
+
+
+}
+
+ECG_FOURIER_WIDGETS = {
+    'fourier_window': 2,
+    'spectrogram_range': (-3.0, 1.0),  # color scale range (log)
+    'spectrogram_size': 30,
+}
+
+
+# Audio
+AUDIO_FILTER_WIDGETS = {
+    'pass_toggle': False,
+    'pass_type': 'bandpass',
+    'pass_style': 'Butterworth',
+    'pass_range': (100, 4000),
+    'pass_order': 3,
+    'pass_ripple': (1, 50),
+
+    'stop_toggle': False,
+    'stop_type': 'bandstop',
+    'stop_style': 'Butterworth',
+    'stop_range': (58, 61),
+    'stop_order': 5,
+    'stop_ripple': (1, 50),
+}
+
+AUDIO_FOURIER_WIDGETS = {
+    'fourier_window': 0.2,
+    'spectrogram_range': (-3.0, 1.0),  # color scale range (log)
+    'spectrogram_size': 30,
+}
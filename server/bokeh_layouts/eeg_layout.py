@@ -8,40 +8,14 @@ from bokeh.palettes import viridis, magma
 
 from json import loads
 
+from server.bokeh_layouts.defaults import EEG_FILTER_WIDGETS, EEG_FOURIER_WIDGETS
 from server.bokeh_layouts.utils import js_request, time_format, plot_sliding_js, plot_priority_js
 
 BACKEND = 'canvas'  # 'webgl' appears to be broken - makes page unresponsive.
 
 # default values of all widgets and figure attributes
-default_filter_widgets = {
-    'pass_toggle': True,
-    'pass_type': 'bandpass',
-    'pass_style': 'Butterworth',
-    'pass_range': (1, 60),
-    'pass_order': 3,
-    'pass_ripple': (1, 50),
-
-    'stop_toggle': True,
-    'stop_type': 'bandstop',
-    'stop_style': 'Butterworth',
-    'stop_range': (59, 60.5),
-    'stop_order': 5,
-    'stop_ripple': (1, 50),
-
-
-}
-
-default_fourier_widgets = {
-    'fourier_window': 2,
-    'spectrogram_range': (-3.0, 1.0),  # color scale range (log)
-    'spectrogram_size': 30,
-
-    'bands': {'Delta': (1, 4),
-              'Theta': (4, 8),
-              'Alpha': (8, 12),
-              'Beta': (12, 30),
-              'Gamma': (30, 100)}
-}
+default_filter_widgets = EEG_FILTER_WIDGETS
+default_fourier_widgets = EEG_FOURIER_WIDGETS
 
 
 def create_layout(info):
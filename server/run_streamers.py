@@ -1,4 +1,4 @@
-from lib.lib import Client
+from lib.lib import Client, Pipeline
 from server.analyzers import *
 from lib.raspi.streamers import *
 
@@ -89,14 +89,22 @@ t2 = TestStreamer("Random 2", "Test Group 0")
 synth1 = SynthEEGStreamer('Raw', 'Synth EEG 1')
 
 # Pass all workers to client
+# the no-PI test workers all run on this host, so they pass their data to each other through shared memory
+# custom functions may carry state from one block to the next, so their analyzer isn't run as replicas
 worker_no_pi_test = [t1, t2, t0func, synth1, synth1filt, synth1four, synth1func]
 workers_test = [synth1filt, synth1four, t1func, decoder1, audio1, encoder1, audiofilt1, audiofour1]
-workers = [eegfilt, eegfour, eegfunc, ecgfilt, ecgfour, ecgfunc]
+# each group's analyzers run as one worker, passing the filtered data to the others in memory.
+# Filtered data is always written to the database so that it's saved with the session.
+workers = [
+    Pipeline([eegfilt, eegfour, eegfunc], durable=[eegfilt]),
+    Pipeline([ecgfilt, ecgfour, ecgfunc], durable=[ecgfilt]),
+]
 
 client = Client(
     workers=worker_no_pi_test, name='Local Client', debug=1,
     server_ip='localhost', port=80,  #server_ip='signalstream.org', port=443,
-    db_port=5001, db_pass='thisisthepasswordtotheredisserver'
+    db_port=5001, db_pass='thisisthepasswordtotheredisserver',
+    shared_memory=True,
 )
 
 client.run()
\ No newline at end of file
@@ -0,0 +1,50 @@
+"""
+Playback of session archives (lib/archive.py) through ArchiveDatabase.
+Uses fakeredis to write the recording that is archived.
+"""
+import time
+
+import numpy as np
+import pytest
+import redis
+
+from lib import database
+from lib.archive import write_archive
+
+fakeredis = pytest.importorskip('fakeredis')
+
+
+@pytest.fixture
+def recording(tmp_path, monkeypatch):
+    """ Archive of one minute of a 250 Hz stream with rollups. Returns (save path, file name). """
+    server = fakeredis.FakeServer()
+    monkeypatch.setattr(database.redis, 'ConnectionPool', lambda decode_responses, **options: fakeredis.FakeRedis(
+        server=server, decode_responses=decode_responses).connection_pool)
+    monkeypatch.setattr(database.Database, 'insert_script', lambda self: False)  # fakeredis lua has no struct
+
+    db = database.Database('localhost', 0, None, rollup=True)
+    start = (time.time()*1000 - 600000) // 10000 * 10000
+    times = start + np.arange(60*250) * 4.0
+    for i in range(0, len(times), 250):
+        db.write_data('stream', {'time': times[i:i+250], 'value': np.sin(times[i:i+250] / 300)})
+
+    write_archive(redis.Redis(connection_pool=db.bytes_redis.connection_pool), str(tmp_path / 'session.osa'))
+    return str(tmp_path), 'session.osa'
+
+
+def test_downsampled_playback_reads_rollups_to_the_end(recording):
+    """ Reads from rollup levels move the read position on the raw stream, so later reads keep getting data """
+    save_path, file = recording
+    db = database.ArchiveDatabase(file, save_path)
+    db.playback_speed = 50
+    db.start()
+
+    reads = []
+    for _ in range(8):
+        output = db.read_data('stream', downsample=True, points=1000)
+        reads.append(len(output['time']) if output else 0)
+        time.sleep(0.2)
+    db.shutdown()
+
+    # each read covers 10s of the minute recorded, so all but the last couple reads (past the end) have data
+    assert all(reads[:6]), reads
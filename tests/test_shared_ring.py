@@ -0,0 +1,114 @@
+"""
+Wrapping and lapped readers of SharedRing, and SharedDatabase falling back to the database (lib/shared_ring.py).
+Uses fakeredis for the database.
+"""
+import os
+
+import numpy as np
+import pytest
+
+from lib import database
+from lib.shared_ring import SharedRing, SharedDatabase, remove_segments, RECORD
+
+pytestmark = pytest.mark.skipif(not os.path.isdir('/dev/shm'), reason="needs POSIX shared memory")
+
+
+@pytest.fixture
+def name():
+    """ Unique segment name, removed afterwards """
+    prefix = 'osprey-test-{}'.format(os.getpid())
+    yield prefix + '-ring'
+    remove_segments(prefix)
+
+
+@pytest.fixture
+def databases(name, monkeypatch):
+    """ Writer and reader SharedDatabase on the same fake database, with rings of 4096 bytes """
+    fakeredis = pytest.importorskip('fakeredis')
+    server = fakeredis.FakeServer()
+    monkeypatch.setattr(database.redis, 'ConnectionPool', lambda decode_responses, **options: fakeredis.FakeRedis(
+        server=server, decode_responses=decode_responses).connection_pool)
+    monkeypatch.setattr(database.Database, 'insert_script', lambda self: False)  # fakeredis lua has no struct
+    writer = SharedDatabase('localhost', 0, None, name, capacity=4096)
+    reader = SharedDatabase('localhost', 0, None, name, capacity=4096, attach_interval=0)
+    yield writer, reader
+    reader.close()
+    writer.close()
+
+
+def record(start, points):
+    """ Columns of <points> consecutive data points from time <start> """
+    times = np.arange(start, start + points, dtype=np.float64)
+    return {'time': times, 'value': times * 2}
+
+
+def size(columns):
+    """ Bytes a record of <columns> takes in the ring """
+    names = len('["time", "value"]')
+    return RECORD + names + -names % 8 + 8*len(columns)*len(columns['time'])
+
+
+def test_wrap_larger_than_head(name):
+    ring = SharedRing(name, 1000)
+    try:
+        first, second = record(0, 15), record(15, 46)
+        assert (size(first), size(second)) == (288, 784)
+        assert ring.put(first)
+        assert ring.put(second)  # wraps over the first record, which is longer than where the head is
+        assert (ring.tail, ring.head) == (1000, 1784)
+        columns, position = ring.read()
+        assert np.array_equal(columns['time'], second['time'])
+        assert position == ring.head
+    finally:
+        ring.close()
+
+
+def test_too_large(name):
+    ring = SharedRing(name, 1000)
+    try:
+        assert not ring.put(record(0, 100))
+        assert ring.head == 0
+    finally:
+        ring.close()
+
+
+def test_lapped_reader(name):
+    ring = SharedRing(name, 4096)
+    reader = SharedRing(name)
+    try:
+        rng = np.random.default_rng(0)
+        time, position, last = 0, None, -1
+        for i in range(2000):
+            points = int(rng.integers(1, 60))
+            assert ring.put(record(time, points))
+            time += points
+            assert ring.tail <= ring.head <= ring.tail + ring.capacity
+            if i % int(rng.integers(1, 40)) == 0:  # sometimes falls more than a whole ring behind
+                columns, position = reader.read(position)
+                times = columns['time']
+                assert np.array_equal(columns['value'], times * 2)  # never torn
+                assert np.array_equal(np.diff(times), np.ones(len(times) - 1))  # consecutive within a read
+                assert times[0] > last and times[-1] == time - 1  # only new data, up to the latest
+                last = times[-1]
+        columns, position = reader.read(position)
+        assert columns is None or columns['time'][-1] == time - 1
+        assert reader.read(position)[0] is None
+    finally:
+        reader.close()
+        ring.close()
+
+
+def test_record_larger_than_ring(databases):
+    writer, reader = databases
+    start = 1e12
+    writer.write_data('stream', record(start, 10))
+    writer.flush()
+    assert reader.read_data('stream')['time'][-1] == start + 9
+    assert reader.readers  # read from the ring
+
+    writer.write_data('stream', record(start + 10, 1000))  # doesn't fit in the ring
+    writer.flush()
+    assert writer.writers['stream'] is None
+    times = reader.read_data('stream')['time']
+    assert not reader.readers  # back to the database
+    assert np.allclose(times[-1000:], record(start + 10, 1000)['time'], rtol=0, atol=0.01)  # not lost